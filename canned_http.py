@@ -5,16 +5,23 @@ specified by a script that is provided when the web server is run.
 
 For requests, the script specifies the following parameters:
   * method (required): The HTTP method used, such as GET or POST.
-  * url (required): The URL path requested.
+  * url (required): The URL path requested, or a pattern that it must match.
   * headers (optional): A map of expected HTTP headers. If provided, the headers
-    of a request must be a superset of these headers.
+    of a request must be a superset of these headers. Each value is either a
+    string or a pattern.
+  * query (optional): A map of expected query parameters. If provided, the url
+    is compared to the requested URL without its query string, and the query
+    parameters of a request must be a superset of these parameters. Each value
+    is either a string or a pattern.
   * body (optional): The expected body of the request, such as the data
     submitted in a POST request.
   * body_filename (optional): The filename whose contents should be expected as
-    the body of the request.
+    the body of the request. The file is read when the script is loaded.
   * body_type: (optional): If present, the received body and the expected body
     will be converted to the given type before returning. Currently the only
     valid value is JSON.
+A pattern is a map with the single key regex, glob, or template, whose value is
+a regular expression, a glob, or a path template such as /items/{id}.
 
 For responses, the script specifies the following parameters:
   * status_code (required): The HTTP status code to return, such as 200 or 404.
@@ -22,15 +29,38 @@ For responses, the script specifies the following parameters:
   * headers (optional): A map of HTTP header names and values to return in the
     response.
   * delay (optional): The number of seconds to wait before sending the response,
-    which is useful for simulating long-polling by the server.
+    which is useful for simulating long-polling by the server or the latency of
+    an upstream server. The delay is measured from when the request was
+    received, and may be fractional with sub-millisecond precision.
   * body (optional): The body of the response, such as the HTML to render in the
     browser in response to a GET request.
   * body_filename (optional): The filename whose contents should be used as the
-    body of the response.
+    body of the response. If the status code is 200, ranges of the file can be
+    requested with the Range and If-Range headers.
+  * chunks (optional): An array of chunks to send as the body of the response
+    using chunked transfer encoding. Each chunk is either a string, or a map
+    with a required body and an optional delay, which is the number of seconds
+    to wait before sending the chunk.
+  * template (optional): If true, the body and header values are templates
+    where each {{reference}} is replaced by a part of the request, such as
+    {{path.id}}, {{query.page}}, {{header.X-Request-Id}}, or {{json.user.name}}.
+  * compress (optional): If true, the body is compressed with gzip, or with
+    Brotli if it is installed, when accepted by the client.
+  * bandwidth (optional): The maximum number of bytes per second at which the
+    body is sent.
+  * drip_bytes, drip_delay (optional): The body is sent drip_bytes at a time,
+    waiting drip_delay seconds before each part.
+  * fault (optional): A map that breaks the connection, where type is reset,
+    close, or stall after sending after_bytes bytes of the body, or
+    content_length to send the whole body with the given Content-Length. A
+    stalled connection is held open until the client closes it.
 A response can be omitted altogether, which is useful for simulating
 long-polling where the client must close the connection. If a response is
-present, then exactly one of body and body_filename must be set. Setting both
-or neither is invalid.
+present, then exactly one of body, body_filename, and chunks must be set,
+where body may be empty.
+
+A request body sent by the client with chunked transfer encoding is decoded
+before it is compared to the expected body.
 
 A request and the optional response is called an exchange. The persistent
 connections feature of HTTP 1.1 allows multiple exchanges over a single TCP/IP
@@ -40,31 +70,98 @@ exchanges across a single connection. The script is simply an array of such
 arrays, so that it specifies the number of expected connections, and the order
 of exchanges for each connection.
 
+The script can instead be a map with the key 'connections' for the array of
+connections, and the key 'stubs' for an array of exchanges that may be performed
+any number of times on any connection. Each stub may also specify a count, which
+is the maximum number of times it is performed, and a rate, which is the maximum
+number of times per second it is performed.
+
+To serve a script from within another program, such as a test suite, create a
+CannedServer with the script and start it. A CannedServerPool serves many
+scripts from one process, each on its own port or routed by the Host header or
+path prefix of the first request of each connection on a shared port.
+
+A RecordingProxy, or the --record_to flag, records a script from the exchanges
+between a client and an upstream server.
+
 Author: Michael Parker (michael.g.parker@gmail.com)
 """
 
 import argparse
 import BaseHTTPServer
+import collections
+import email.utils
+import gc
+import httplib
+import itertools
 import json
+import marshal
+import mmap
 import os
+import Queue
+import re
+import socket
 import SocketServer
+import StringIO
+import struct
 import sys
+import threading
 import time
+import urlparse
+import zlib
 
+try:
+  # The optional Brotli library, see https://github.com/google/brotli
+  import brotli
+except ImportError:
+  brotli = None
 
-class Script:
+
+# Expected request bodies in files larger than this are not loaded into memory,
+# but are compared to the request body as it is received from the client.
+_MAX_LOADED_BODY_BYTES = 8 * 1024 * 1024
+# The number of bytes of a request body to compare at a time.
+_COMPARE_CHUNK_BYTES = 64 * 1024
+# The headers of every request or response without headers, which is shared to
+# save memory and so must not be modified.
+_NO_HEADERS = {}
+
+
+class Script(object):
   """A script specifying the expected requests made by the client, and the
   replies sent by the server.
   """
 
-  def __init__(self, connections=()):
+  # Scripts, connections, exchanges, requests, and responses do not have an
+  # instance dictionary, which dominates the memory used by large scripts.
+  __slots__ = ('_connections', '_stubs')
+
+  def __init__(self, connections=(), stubs=()):
     self._connections = tuple(connections)
+    self._stubs = tuple(stubs)
 
-  def __repr__(init):
+  def __repr__(self):
+    if self._stubs:
+      return 'connections=%s, stubs=%s' % (
+          repr(self._connections), repr(self._stubs))
     return 'connections=%s' % repr(self._connections)
 
 
-class Connection:
+class LazyScript(Script):
+  """A script whose connections are created only as the server reaches them,
+  so that the entire script is never in memory.
+
+  The connections of a lazy script can be iterated over only once.
+  """
+
+  __slots__ = ()
+
+  def __init__(self, connections_iter, stubs=()):
+    self._connections = connections_iter
+    self._stubs = tuple(stubs)
+
+
+class Connection(object):
   """A connection from the client to the server.
 
   For HTTP 1.1 all connections are persistent unless declared otherwise,
@@ -72,6 +169,8 @@ class Connection:
   modeled by a Connection containing a sequence of Exchange instances.
   """
 
+  __slots__ = ('_exchanges',)
+
   def __init__(self, exchanges=()):
     self._exchanges = tuple(exchanges)
 
@@ -79,7 +178,7 @@ class Connection:
     return 'exchanges=%s' % repr(self._exchanges)
 
 
-class Exchange:
+class Exchange(object):
   """An exchange, or a request received from the client and an optional reply by
   the server.
 
@@ -90,80 +189,167 @@ class Exchange:
   well-behaved clients should also timeout and disconnect.)
   """
 
+  __slots__ = ('_request', '_response')
+
   @staticmethod
   def _join_parts(string_parts):
     string = ', '.join(('%s: %s' % (key, value) for (key, value) in string_parts))
     return '{%s}' % string
 
-  class Request:
+  class Request(object):
     """A request from the client to the server.
 
     A request must contain a HTTP method and URL. Expected headers and the
     request body, typically only used with POST or PUT, are optional.
     """
 
+    __slots__ = ('_method', '_url', '_headers', '_body', '_body_filename',
+                 '_body_type', '_query', '_expected_body')
+
     @staticmethod
-    def request_with_no_body(method, url, headers=None):
+    def request_with_no_body(method, url, headers=None, query=None):
       """Returns a request with no body, such as for a GET request."""
-      return Exchange.Request(method, url, headers)
+      return Exchange.Request(method, url, headers, query=query)
 
     @staticmethod
-    def request_with_body(method, url, body, body_type=None, headers=None):
+    def request_with_body(method, url, body, body_type=None, headers=None,
+        query=None):
       """Returns a request with the given string as the body."""
-      return Exchange.Request(method, url, headers, body=body, body_type=body_type)
+      return Exchange.Request(method, url, headers, body=body, body_type=body_type,
+          query=query)
 
     @staticmethod
-    def request_from_file(method, url, body_filename, body_type=None, headers=None):
+    def request_from_file(method, url, body_filename, body_type=None, headers=None,
+        query=None):
       """Returns a request with the contents of the given file as the body."""
-      return Exchange.Request(
-          method, url, headers, body_filename=body_filename, body_type=body_type)
+      return Exchange.Request(method, url, headers, body_filename=body_filename,
+          body_type=body_type, query=query)
 
     def __init__(self, method, url, headers=None, body=None, body_filename=None,
-        body_type=None):
+        body_type=None, query=None):
+      # The URL and the values of headers and query parameters are either strings
+      # or Pattern instances. If query is not None, then the URL is compared to
+      # the path of the requested URL, and query is compared to its parameters.
       self._method = method
       self._url = url
-      self._headers = headers or {}
+      self._headers = headers or _NO_HEADERS
+      self._query = query
       self._body = body
       self._body_filename = body_filename
       self._body_type = body_type
 
+      # Load and convert the expected body once, instead of for each request.
+      if body:
+        expected_body = body
+      elif (body_filename and body_type != 'json' and
+            os.path.getsize(body_filename) > _MAX_LOADED_BODY_BYTES):
+        # Compare the file to the request body as it is received.
+        expected_body = None
+      elif body_filename:
+        f = open(body_filename, 'rb')
+        expected_body = f.read()
+        f.close()
+      else:
+        expected_body = None
+      if body_type == 'json' and isinstance(expected_body, basestring):
+        expected_body = json.loads(expected_body)
+      self._expected_body = expected_body
+
     def __repr__(self):
       request_parts = [('method', self._method), ('url', self._url)]
+      if self._query is not None:
+        request_parts.append(('query', self._query))
       if self._headers:
         request_parts.append(('headers', self._headers))
       if self._body:
         request_parts.append(('body', self._body))
       return Exchange._join_parts(request_parts)
 
-  class Response:
+  class Response(object):
     """A response from the server to the client.
 
     A response must contain a HTTP status code, a value for the Content-Type
     header, and a body. The body is either a given string or the contents of a
     given file. Additional headers and a delay before sending the response are
     optional.
+
+    The body may also be throttled by a (bandwidth, drip_bytes, drip_delay)
+    tuple, where bandwidth is the maximum number of bytes per second or None,
+    and the body is written drip_bytes at a time, if not None, after waiting
+    drip_delay seconds before each write.
+
+    A fault may break the response, as a (fault_type, value) tuple. For the
+    types in FAULT_TYPES_AFTER_BYTES, the value is the number of bytes of the
+    body sent before the fault. For FAULT_CONTENT_LENGTH, the value is sent as
+    the Content-Length header instead of the length of the body.
     """
 
+    # Sends a RST to the client.
+    FAULT_RESET = 'reset'
+    # Closes the connection normally.
+    FAULT_CLOSE = 'close'
+    # Sends nothing more until the client closes the connection.
+    FAULT_STALL = 'stall'
+    FAULT_TYPES_AFTER_BYTES = (FAULT_RESET, FAULT_CLOSE, FAULT_STALL)
+    FAULT_CONTENT_LENGTH = 'content_length'
+
+    __slots__ = ('_status_code', '_content_type', '_delay', '_headers', '_body',
+                 '_body_filename', '_chunks', '_templates', '_compress',
+                 '_throttle', '_fault', '_rendered', '_serialized_head')
+
     @staticmethod
-    def response_with_body(status_code, content_type, body, headers=None, delay=0):
+    def response_with_body(status_code, content_type, body, headers=None, delay=0,
+        templated=False, compress=False, throttle=None, fault=None):
       """Returns a response with the given string as the body."""
-      return Exchange.Response(status_code, content_type, delay, headers, body=body)
+      return Exchange.Response(status_code, content_type, delay, headers,
+          body=body, templated=templated, compress=compress, throttle=throttle,
+          fault=fault)
 
     @staticmethod
     def response_from_file(status_code, content_type, body_filename, headers=None,
-        delay=0):
+        delay=0, templated=False, compress=False, throttle=None, fault=None):
       """Returns a response with the contents of the given file as the body."""
       return Exchange.Response(status_code, content_type, delay, headers,
-          body_filename=body_filename)
+          body_filename=body_filename, templated=templated, compress=compress,
+          throttle=throttle, fault=fault)
+
+    @staticmethod
+    def response_with_chunks(status_code, content_type, chunks, headers=None,
+        delay=0, templated=False, throttle=None, fault=None):
+      """Returns a response with the given sequence of (body, delay) pairs sent as
+      chunks of the body.
+      """
+      return Exchange.Response(status_code, content_type, delay, headers,
+          chunks=chunks, templated=templated, throttle=throttle, fault=fault)
 
     def __init__(self, status_code, content_type, delay, headers=None,
-        body=None, body_filename=None):
+        body=None, body_filename=None, chunks=None, templated=False,
+        compress=False, throttle=None, fault=None):
       self._status_code = status_code
       self._content_type = content_type
       self._delay = delay
-      self._headers = headers
+      self._headers = headers or _NO_HEADERS
       self._body = body
       self._body_filename = body_filename
+      self._chunks = tuple(chunks) if chunks else None
+      if templated:
+        # Parse the templates once, instead of for each request. This raises a
+        # ValueError if a template is invalid.
+        body_template = Template(body) if body else None
+        header_templates = tuple(
+            (header_name, Template('%s' % header_value))
+            for header_name, header_value in self._headers.iteritems())
+        self._templates = (body_template, header_templates)
+      else:
+        self._templates = None
+      # Whether the body is compressed with an encoding accepted by the client.
+      self._compress = compress
+      self._throttle = tuple(throttle) if throttle else None
+      self._fault = tuple(fault) if fault else None
+      # Whether the response was rendered from templates for one request.
+      self._rendered = False
+      # Set by _serialized_head when the response is first sent.
+      self._serialized_head = None
 
     def __repr__(self):
       response_parts = [('status_code', self._status_code),
@@ -176,6 +362,16 @@ class Exchange:
         response_parts.append(('body', self._body))
       elif self._body_filename:
         response_parts.append(('body_filename', self._body_filename))
+      elif self._chunks:
+        response_parts.append(('chunks', repr(self._chunks)))
+      if self._templates is not None:
+        response_parts.append(('template', True))
+      if self._compress:
+        response_parts.append(('compress', True))
+      if self._throttle:
+        response_parts.append(('throttle', repr(self._throttle)))
+      if self._fault:
+        response_parts.append(('fault', repr(self._fault)))
       return Exchange._join_parts(response_parts)
 
   def __init__(self, request, response=None):
@@ -189,6 +385,200 @@ class Exchange:
       return '{request=%s}' % repr(self._request)
 
 
+class Pattern(object):
+  """A pattern that the URL, a header value, or a query parameter value of a
+  request must match, instead of being equal to a string.
+
+  A pattern is either a regular expression, a glob where * matches any
+  characters and ? matches any one character, or a path template where each
+  {name} matches one or more characters other than /. The entire value must
+  match. The pattern is compiled when it is created.
+
+  The parameters of a path template and the named groups of a regular expression
+  are captured, and may be referred to by a Template.
+  """
+
+  REGEX = 'regex'
+  GLOB = 'glob'
+  TEMPLATE = 'template'
+  KINDS = (REGEX, GLOB, TEMPLATE)
+
+  __slots__ = ('_kind', '_source', '_regex', '_capture_regex')
+
+  # Matches each {name} in a path template.
+  _TEMPLATE_PARAM_RE = re.compile(r'\{\w+\}')
+
+  def __init__(self, kind, source):
+    """Raises a ValueError if the kind is invalid, or if the source is not a
+    valid regular expression.
+    """
+
+    self._kind = kind
+    self._source = source
+    try:
+      # The group anchors every alternative of a regular expression.
+      self._regex = re.compile(r'(?:%s)\Z' % self.regex_source())
+      if kind == Pattern.TEMPLATE:
+        # Matching without groups allows the pattern to be combined.
+        self._capture_regex = re.compile(
+            r'(?:%s)\Z' % self.regex_source(capture=True))
+      else:
+        self._capture_regex = self._regex
+    except re.error as e:
+      raise ValueError("Invalid %s pattern '%s': %s" % (kind, source, e))
+
+  def regex_source(self, capture=False):
+    """Returns the source of a regular expression that matches the same values,
+    without anchors.
+
+    If capture is True, each parameter of a path template is a named group.
+    """
+
+    if self._kind == Pattern.REGEX:
+      return self._source
+    elif self._kind == Pattern.GLOB:
+      return ''.join(
+          '.*' if c == '*' else '.' if c == '?' else re.escape(c)
+          for c in self._source)
+    elif self._kind == Pattern.TEMPLATE:
+      literals = Pattern._TEMPLATE_PARAM_RE.split(self._source)
+      if not capture:
+        return '[^/]+'.join(re.escape(literal) for literal in literals)
+      params = Pattern._TEMPLATE_PARAM_RE.findall(self._source)
+      parts = [re.escape(literals[0])]
+      for param, literal in zip(params, literals[1:]):
+        parts.append('(?P<%s>[^/]+)' % param[1:-1])
+        parts.append(re.escape(literal))
+      return ''.join(parts)
+    raise ValueError("Invalid pattern kind '%s'" % self._kind)
+
+  def can_combine(self):
+    """Returns whether the pattern can be one alternative of a combined regular
+    expression, which requires that it have no groups or flags of its own.
+    """
+
+    return not self._regex.groups and not self._regex.flags
+
+  def matches(self, value):
+    """Returns whether the given string matches the pattern."""
+
+    return value is not None and self._regex.match(value) is not None
+
+  def captures(self, value):
+    """Returns a map of the values captured by matching the given string."""
+
+    match = self._capture_regex.match(value)
+    return match.groupdict() if match else {}
+
+  def __repr__(self):
+    return '%s:%s' % (self._kind, self._source)
+
+
+class Template(object):
+  """A template for the body or a header value of a response, where each
+  {{reference}} is replaced by a part of the request. A reference is one of:
+
+    method, url, path, body: The method, URL, path without the query string, or
+      body of the request.
+    path.name: The parameter of a path template or the named group of a regular
+      expression matched by the URL.
+    query.name: The value of a query parameter.
+    header.name: The value of a header.
+    json.name: The value of a field of the body parsed as JSON, where name is a
+      sequence of field names and array indexes separated by dots.
+
+  A reference to a missing value is replaced by an empty string. The template is
+  parsed when it is created, so that rendering it only joins strings.
+  """
+
+  __slots__ = ('_source', '_literals', '_references')
+
+  _REFERENCE_RE = re.compile(r'\{\{\s*([\w.-]+)\s*\}\}')
+  _SOURCES = ('method', 'url', 'path', 'body')
+  _NAMED_SOURCES = ('path', 'query', 'header', 'json')
+
+  def __init__(self, source):
+    """Raises a ValueError if the template contains an invalid reference."""
+
+    self._source = source
+    parts = Template._REFERENCE_RE.split(source)
+    # The literals surround the references, so there is one more literal. They
+    # are encoded like the values of references, so rendering joins only byte
+    # strings.
+    self._literals = tuple(
+        literal.encode('utf-8') if isinstance(literal, unicode) else literal
+        for literal in parts[0::2])
+    references = []
+    for reference in parts[1::2]:
+      reference_source, _, key = reference.partition('.')
+      if not (reference_source in Template._SOURCES and not key or
+              reference_source in Template._NAMED_SOURCES and key):
+        raise ValueError("Invalid template reference '%s'" % reference)
+      references.append((reference_source, key))
+    self._references = tuple(references)
+
+  def render(self, context):
+    """Returns the string for the request of the given _TemplateContext."""
+
+    literals = self._literals
+    if not self._references:
+      return literals[0]
+    strings = [literals[0]]
+    for i, reference in enumerate(self._references, 1):
+      strings.append(context.value(reference))
+      strings.append(literals[i])
+    return ''.join(strings)
+
+  def __repr__(self):
+    return self._source
+
+
+def _value_matches(expected_value, value):
+  """Returns whether the given received value equals the given expected string,
+  or matches the given expected Pattern instance.
+  """
+
+  if isinstance(expected_value, Pattern):
+    return expected_value.matches(value)
+  return expected_value == value
+
+
+def _url_matches(request, url):
+  """Returns whether the given received URL matches the URL of the given
+  Exchange.Request, ignoring any query string if the request specifies query
+  parameters.
+  """
+
+  if request._query is not None:
+    url = url.partition('?')[0]
+  return _value_matches(request._url, url)
+
+
+class Stub(object):
+  """An exchange that may be performed any number of times, on any connection,
+  and between the exchanges of the script.
+
+  If count is not None, the stub is performed at most that many times. If rate
+  is not None, the stub is performed at most that many times per second, and a
+  request beyond that rate must instead match the script.
+  """
+
+  __slots__ = ('_exchange', '_count', '_rate')
+
+  def __init__(self, exchange, count=None, rate=None):
+    self._exchange = exchange
+    self._count = count
+    self._rate = rate
+
+  def __repr__(self):
+    stub_parts = [('exchange', repr(self._exchange))]
+    if self._count is not None:
+      stub_parts.append(('count', self._count))
+    if self._rate is not None:
+      stub_parts.append(('rate', self._rate))
+    return Exchange._join_parts(stub_parts)
+
+
 class DirectorError(Exception):
   """An exception raised if the Director encountered an unexpected request or
   event in a Script.
@@ -204,18 +594,543 @@ class DirectorError(Exception):
     return self._message
 
 
+def _verify_body_stream(request, body, connection_index, exchange_index):
+  """Raises a DirectorError if the given stream of the body received from the
+  client does not match the expected body of the given Exchange.Request.
+
+  The stream is compared a chunk at a time, so that the body is never entirely
+  in memory, and the comparison stops at the first byte that differs.
+  """
+
+  if request._expected_body is None:
+    expected_body = open(request._body_filename, 'rb')
+  else:
+    expected_body = StringIO.StringIO(request._expected_body)
+  try:
+    offset = 0
+    while True:
+      chunk = body.read(_COMPARE_CHUNK_BYTES)
+      # If the stream has ended, the expected body must also end.
+      expected_chunk = expected_body.read(len(chunk) or 1)
+      if chunk != expected_chunk:
+        for i, (c, expected_c) in enumerate(zip(chunk, expected_chunk)):
+          if c != expected_c:
+            offset += i
+            break
+        else:
+          offset += min(len(chunk), len(expected_chunk))
+        raise DirectorError(
+            "Expected 'body' value differs from the received value at byte %s "
+            "for connection %s, exchange %s" %
+            (offset, connection_index, exchange_index))
+      elif not chunk:
+        return
+      offset += len(chunk)
+  finally:
+    expected_body.close()
+
+
+def _verify_request(request, method, url, headers, body,
+    connection_index, exchange_index):
+  """Raises a DirectorError if the given values received from the client do not
+  match the expected Exchange.Request.
+
+  The body is either a string, None, or a stream with a read method.
+  """
+
+  # Assert that the method is correct.
+  if method != request._method:
+    raise DirectorError(
+        "Expected 'method' value '%s', received '%s' for connection %s, exchange %s" %
+        (request._method, method, connection_index, exchange_index))
+  # Assert that the URL is correct.
+  if not _url_matches(request, url):
+    raise DirectorError(
+        "Expected 'url' value '%s', received '%s' for connection %s, exchange %s" %
+        (request._url, url, connection_index, exchange_index))
+  # Assert that the query parameters are correct.
+  if request._query is not None:
+    query = urlparse.parse_qs(url.partition('?')[2], keep_blank_values=True)
+    for name, expected_value in request._query.iteritems():
+      values = query.get(name, None)
+      value = values[0] if values else None
+      if not _value_matches(expected_value, value):
+        raise DirectorError(
+            "Expected value '%s' for query parameter '%s', "
+            "received '%s' for connection %s, exchange %s" %
+            (expected_value, name, value, connection_index, exchange_index))
+  # Assert that the optional body is correct.
+  expected_body = request._expected_body
+  if isinstance(body, basestring) or body is None:
+    if expected_body is None and request._body_filename:
+      # The expected body was not loaded, so compare it as a stream.
+      body = StringIO.StringIO(body or '')
+  elif request._body_type == 'json' or (
+      expected_body is None and not request._body_filename):
+    # Read the entire body from the stream.
+    body = body.read() or None
+  if hasattr(body, 'read'):
+    _verify_body_stream(request, body, connection_index, exchange_index)
+  else:
+    if request._body_type == 'json' and body:
+      # Convert the body to JSON, like the expected body.
+      try:
+        body = json.loads(body)
+      except ValueError:
+        raise DirectorError(
+            "Expected JSON 'body', received '%s' for connection %s, exchange %s" %
+            (body, connection_index, exchange_index))
+    if body != expected_body:
+      raise DirectorError(
+          "Expected 'body' value '%s', received '%s' for connection %s, exchange %s" %
+          (expected_body, body, connection_index, exchange_index))
+  # Assert that the headers are correct.
+  for header_name, expected_header_value in request._headers.iteritems():
+    # Class rfc822.Message performs a case insensitive search on header names.
+    header_value = headers.get(header_name, None)
+    if not _value_matches(expected_header_value, header_value):
+      raise DirectorError(
+          "Expected value '%s' for header name '%s', "
+          "received '%s' for connection %s, exchange %s" %
+          (expected_header_value, header_name, header_value,
+           connection_index, exchange_index))
+
+
+# The maximum number of patterns combined into one regular expression, which is
+# below the limit of 100 groups.
+_MAX_COMBINED_PATTERNS = 99
+
+
+class _TemplateContext(object):
+  """The parts of a received request that a Template may refer to, which are
+  parsed only if they are referred to.
+  """
+
+  def __init__(self, request, method, url, headers, body):
+    self._request = request
+    self._method = method
+    self._url = url
+    self._headers = headers
+    self._body = body
+    # Maps each source of named values to the parsed values.
+    self._parsed = {}
+
+  def _named_values(self, source):
+    named_values = self._parsed.get(source, None)
+    if named_values is not None:
+      return named_values
+    path, _, query_string = self._url.partition('?')
+    if source == 'path':
+      expected_url = self._request._url
+      if isinstance(expected_url, Pattern):
+        if self._request._query is None:
+          named_values = expected_url.captures(self._url)
+        else:
+          named_values = expected_url.captures(path)
+      else:
+        named_values = {}
+    elif source == 'query':
+      named_values = dict((name, values[0]) for name, values in
+          urlparse.parse_qs(query_string, keep_blank_values=True).iteritems())
+    elif source == 'json':
+      try:
+        named_values = json.loads(self._body or 'null')
+      except ValueError:
+        named_values = None
+    self._parsed[source] = named_values
+    return named_values
+
+  def value(self, reference):
+    """Returns the string for the given (source, key) reference."""
+
+    source, key = reference
+    if source == 'method':
+      value = self._method
+    elif source == 'url':
+      value = self._url
+    elif source == 'path' and not key:
+      value = self._url.partition('?')[0]
+    elif source == 'body':
+      value = self._body
+    elif source == 'header':
+      value = self._headers.get(key, None)
+    elif source == 'json':
+      # Each part of the key is a field name or an array index.
+      value = self._named_values(source)
+      for part in key.split('.'):
+        if isinstance(value, dict):
+          value = value.get(part, None)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+          value = value[int(part)]
+        else:
+          value = None
+          break
+      if value is not None and not isinstance(value, basestring):
+        value = json.dumps(value)
+    else:
+      value = self._named_values(source).get(key, None)
+    if value is None:
+      return ''
+    elif isinstance(value, unicode):
+      return value.encode('utf-8')
+    return value
+
+
+def _render_response(exchange, method, url, headers, body):
+  """Returns the response of the given Exchange for the given request, which has
+  been verified.
+
+  If the response has templates, a new response is returned with each template
+  rendered for the request, where the body is either a string or None.
+  """
+
+  response = exchange._response
+  if response is None or response._templates is None:
+    return response
+  context = _TemplateContext(exchange._request, method, url, headers, body)
+  body_template, header_templates = response._templates
+  rendered_headers = dict((header_name, template.render(context))
+                          for header_name, template in header_templates)
+  if body_template is not None:
+    rendered = Exchange.Response(response._status_code, response._content_type,
+        response._delay, rendered_headers, body=body_template.render(context),
+        compress=response._compress, throttle=response._throttle,
+        fault=response._fault)
+  else:
+    rendered = Exchange.Response(response._status_code, response._content_type,
+        response._delay, rendered_headers, body=response._body,
+        body_filename=response._body_filename, chunks=response._chunks,
+        compress=response._compress, throttle=response._throttle,
+        fault=response._fault)
+  rendered._rendered = True
+  return rendered
+
+
+def _perform_exchange(exchange, method, url, headers, body,
+    connection_index, exchange_index):
+  """Raises a DirectorError if the given values received from the client do not
+  match the request of the given Exchange, and otherwise returns its response
+  rendered for the request.
+  """
+
+  response = exchange._response
+  if response is not None and response._templates is not None and (
+      hasattr(body, 'read')):
+    # A template may refer to the body, so read it before it is verified.
+    body = body.read() or None
+  _verify_request(exchange._request, method, url, headers, body,
+      connection_index, exchange_index)
+  return _render_response(exchange, method, url, headers, body)
+
+
+class _PatternDispatch(object):
+  """A table of entries indexed by URL patterns, where the patterns are combined
+  so that the patterns matching a URL are found by matching one regular
+  expression for every _MAX_COMBINED_PATTERNS patterns.
+  """
+
+  def __init__(self):
+    # The distinct patterns in the order they were added, and a deque of the
+    # entries for each.
+    self._patterns = []
+    self._entries = []
+    # Maps the kind and source of each pattern to its index in _patterns.
+    self._indexes = {}
+    # Each batch is a list of the pattern indexes in a combined regular
+    # expression, and the compiled expression, or None if it must be compiled
+    # again. A pattern that cannot be combined is in a batch by itself.
+    self._batches = []
+
+  def add(self, pattern, entry):
+    """Adds the given entry for the given Pattern instance."""
+
+    key = (pattern._kind, pattern._source)
+    i = self._indexes.get(key, None)
+    if i is None:
+      i = len(self._patterns)
+      self._indexes[key] = i
+      self._patterns.append(pattern)
+      self._entries.append(collections.deque())
+      last_batch = self._batches[-1] if self._batches else None
+      if (pattern.can_combine() and last_batch and
+          len(last_batch[0]) < _MAX_COMBINED_PATTERNS and
+          self._patterns[last_batch[0][0]].can_combine()):
+        last_batch[0].append(i)
+        last_batch[1] = None
+      else:
+        self._batches.append([[i], None])
+    self._entries[i].append(entry)
+
+  def remove(self, pattern, entry):
+    """Removes the given entry added for the given Pattern instance."""
+
+    i = self._indexes[(pattern._kind, pattern._source)]
+    self._entries[i].remove(entry)
+
+  def _matching_indexes(self, url):
+    """Yields the indexes of the patterns that match the given URL, in order."""
+
+    for batch in self._batches:
+      indexes, regex = batch
+      if regex is None:
+        if len(indexes) == 1:
+          regex = self._patterns[indexes[0]]._regex
+        else:
+          # Each pattern is one group in an optional lookahead, so a single
+          # match sets the group of every pattern that matches.
+          regex = re.compile(''.join(
+              r'(?:(?=(%s)\Z))?' % self._patterns[i].regex_source()
+              for i in indexes))
+        batch[1] = regex
+      match = regex.match(url)
+      if len(indexes) == 1:
+        if match is not None:
+          yield indexes[0]
+        continue
+      if match.lastindex is None:
+        continue
+      for i, group in itertools.izip(indexes, match.groups()):
+        if group is not None:
+          yield i
+
+  def candidates(self, urls):
+    """Returns the entries for the patterns that match any of the given URLs."""
+
+    candidates = []
+    seen_indexes = set()
+    for url in urls:
+      for i in self._matching_indexes(url):
+        if i not in seen_indexes:
+          seen_indexes.add(i)
+          candidates.extend(self._entries[i])
+    return candidates
+
+  def entries(self):
+    """Yields all entries."""
+
+    for entries in self._entries:
+      for entry in entries:
+        yield entry
+
+
+class _RouteTable(object):
+  """A table of entries indexed by the method and URL of their requests, so that
+  the entries that a request may match are found by a single lookup.
+
+  Requests with a URL pattern are indexed by a _PatternDispatch for each method.
+  """
+
+  def __init__(self):
+    # Maps each (method, url) to a deque of entries, in the order they were
+    # added.
+    self._routes = {}
+    # Maps each method to the _PatternDispatch of its URL patterns.
+    self._patterns = {}
+    self._size = 0
+
+  def add(self, request, entry):
+    """Adds the given entry for the given Exchange.Request."""
+
+    if isinstance(request._url, Pattern):
+      dispatch = self._patterns.get(request._method, None)
+      if dispatch is None:
+        dispatch = _PatternDispatch()
+        self._patterns[request._method] = dispatch
+      dispatch.add(request._url, entry)
+    else:
+      key = (request._method, request._url)
+      entries = self._routes.get(key, None)
+      if entries is None:
+        entries = collections.deque()
+        self._routes[key] = entries
+      entries.append(entry)
+    self._size += 1
+
+  def candidates(self, method, url):
+    """Returns the entries whose requests may have the given method and URL.
+
+    Entries with the exact URL are returned in the order that they were added,
+    followed by entries with a matching URL pattern.
+    """
+
+    path = url.partition('?')[0]
+    # Requests with query parameters are indexed by the path alone.
+    urls = (url, path) if path != url else (url,)
+    candidates = []
+    for url in urls:
+      candidates.extend(self._routes.get((method, url), ()))
+    dispatch = self._patterns.get(method, None)
+    if dispatch is not None:
+      candidates.extend(dispatch.candidates(urls))
+    return candidates
+
+  def remove(self, request, entry):
+    """Removes the given entry added for the given Exchange.Request."""
+
+    if isinstance(request._url, Pattern):
+      self._patterns[request._method].remove(request._url, entry)
+    else:
+      key = (request._method, request._url)
+      entries = self._routes[key]
+      entries.remove(entry)
+      if not entries:
+        del self._routes[key]
+    self._size -= 1
+
+  def entries(self):
+    """Returns all entries in sorted order."""
+
+    entries = [entry for entries in self._routes.itervalues()
+               for entry in entries]
+    for dispatch in self._patterns.itervalues():
+      entries.extend(dispatch.entries())
+    return sorted(entries)
+
+  def __len__(self):
+    return self._size
+
+
+class _StubTable(object):
+  """The stubs of a script indexed by their method and URL, so that the stubs
+  that a request may match are found by a single lookup.
+  """
+
+  def __init__(self, stubs):
+    # Guards all following fields, which are shared by the connection threads.
+    self._lock = threading.Lock()
+    # Contains a [stub_index, stub, remaining count, tokens, time of last
+    # refill] entry for each stub. An entry is removed once its count is
+    # exhausted.
+    self._routes = _RouteTable()
+    # The number of stubs with a count that is not yet exhausted.
+    self._num_limited = 0
+    self._has_unlimited = False
+    now = time.time()
+    for stub_index, stub in enumerate(stubs, 1):
+      tokens = max(stub._rate, 1) if stub._rate is not None else None
+      self._routes.add(
+          stub._exchange._request, [stub_index, stub, stub._count, tokens, now])
+      if stub._count is None:
+        self._has_unlimited = True
+      else:
+        self._num_limited += 1
+
+  def has_candidates(self, method, url):
+    """Returns whether any stub with the given method and URL may be performed."""
+
+    if not self._routes:
+      return False
+    with self._lock:
+      return bool(self._routes.candidates(method, url))
+
+  def match(self, method, url, headers, body):
+    """Returns the (stub_index, exchange) pair of the first stub that matches the
+    given request and may be performed, or None if there is no such stub.
+
+    The body is either a string or None.
+    """
+
+    with self._lock:
+      now = time.time()
+      for entry in self._routes.candidates(method, url):
+        stub_index, stub, remaining, tokens, refill_time = entry
+        if tokens is not None:
+          # Refill the bucket, which holds at most a second of tokens.
+          tokens = min(max(stub._rate, 1),
+                       tokens + (now - refill_time) * stub._rate)
+          entry[3] = tokens
+          entry[4] = now
+          if tokens < 1:
+            continue
+        try:
+          _verify_request(stub._exchange._request, method, url, headers, body,
+              'stub', stub_index)
+        except DirectorError:
+          continue
+        if tokens is not None:
+          entry[3] = tokens - 1
+        if remaining is not None:
+          entry[2] = remaining - 1
+          if remaining == 1:
+            self._routes.remove(stub._exchange._request, entry)
+            self._num_limited -= 1
+        return stub_index, stub._exchange
+    return None
+
+  def is_done(self):
+    """Returns whether every stub has been performed as many times as its count.
+
+    If any stub has no count, this is never true.
+    """
+
+    return not self._has_unlimited and not self._num_limited
+
+
+def _match_stub(stubs, method, url, headers, body):
+  """Returns the (stub_index, exchange) pair of the stub in the given _StubTable
+  that matches the given request or None, and the body of the request.
+
+  If a stub may match the request, a stream of the body is read entirely so that
+  it can also be compared to the script, and the returned body is the string
+  that was read.
+  """
+
+  if not stubs.has_candidates(method, url):
+    return None, body
+  if hasattr(body, 'read'):
+    body = body.read() or None
+  return stubs.match(method, url, headers, body), body
+
+
+class _StubCursor:
+  """An opened connection that is not bound to a connection of the script,
+  because the script has ended, and so may only perform stubs.
+  """
+
+  def __init__(self, stubs):
+    self._stubs = stubs
+    # The connection and exchange indexes of the last request received.
+    self._exchange_indexes = None
+
+  def got_request(self, method, url, headers={}, body=None):
+    """Called by the web server when the client sends an HTTP request on this
+    connection.
+
+    Returns the reply to send back.
+    """
+
+    stub, body = _match_stub(self._stubs, method, url, headers, body)
+    if stub is None:
+      raise DirectorError(
+          "Client sent request with method '%s' and URL '%s' that matches no "
+          "stub after the script ended" % (method, url))
+    stub_index, exchange = stub
+    self._exchange_indexes = ('stub', stub_index)
+    return _render_response(exchange, method, url, headers, body)
+
+  def connection_closed(self):
+    """Called by the web server when the client closes this connection."""
+
+    pass
+
+
 class Director:
   """Class that ensures that connections established and requests sent by the
   client follow the provided Script instance.
 
+  Stubs may be performed on any connection, before or between the exchanges of
+  the script, and on connections opened after the script has ended.
+
   If the script is not followed, a DirectorError is raised.
   """
 
-  class _Event:
+  class _Event(object):
     """An event that the server expects to generate as part of the script.
     
     This class is simply to make verifying a Script easier.
     """
+
+    __slots__ = ('_type', '_connection_index', '_exchange_index', '_exchange')
     _CONNECTION_OPENED = 'connection_opened'
     _CONNECTION_CLOSED = 'connection_closed'
     _GOT_REQUEST = 'got_request'
@@ -250,18 +1165,25 @@ class Director:
   def __init__(self, script):
     self._next_event = None
     self._next_event_ready = False
+    self._events_iter = Director._events(script)
+    self._stubs = _StubTable(script._stubs)
+    # The connection and exchange indexes of the last request received.
+    self._exchange_indexes = None
+
+  @staticmethod
+  def _events(script):
+    """Converts the given Script into a sequence of _Event instances.
+
+    Each event is created only as it is reached, so that the script may be a
+    LazyScript.
+    """
 
-    # Convert the given Script into a sequence of DirectorEvent instances.
-    events = []
     for connection_index, connection in enumerate(script._connections, 1):
-      events.append(
-          Director._Event.connection_opened_event(connection_index))
+      yield Director._Event.connection_opened_event(connection_index)
       for exchange_index, exchange in enumerate(connection._exchanges, 1):
-        events.append(
-            Director._Event.exchange_event(connection_index, exchange_index, exchange))
-      events.append(
-          Director._Event.connection_closed_event(connection_index))
-    self._events_iter = iter(events)
+        yield Director._Event.exchange_event(
+            connection_index, exchange_index, exchange)
+      yield Director._Event.connection_closed_event(connection_index)
 
   def _ready_next_event(self):
     if not self._next_event_ready:
@@ -276,12 +1198,20 @@ class Director:
     self._next_event_ready = False
 
   def connection_opened(self):
-    """Called by the web server when the client opens a connection."""
+    """Called by the web server when the client opens a connection.
+
+    Returns the object whose got_request and connection_closed methods must be
+    called for the opened connection. Because connections are performed in
+    order, this is the Director itself.
+    """
 
     self._ready_next_event()
     if self._next_event is None:
-      raise DirectorError('Client opened a connection after the script ended.')
+      if self._stubs.is_done():
+        raise DirectorError('Client opened a connection after the script ended.')
+      return _StubCursor(self._stubs)
     self._finish_current_event()
+    return self
 
   def connection_closed(self):
     """Called by the web server when the client closes the connection.""" 
@@ -301,6 +1231,12 @@ class Director:
     the client to close the connection.
     """
 
+    stub, body = _match_stub(self._stubs, method, url, headers, body)
+    if stub is not None:
+      stub_index, exchange = stub
+      self._exchange_indexes = ('stub', stub_index)
+      return _render_response(exchange, method, url, headers, body)
+
     self._ready_next_event()
     if self._next_event._type == Director._Event._CONNECTION_CLOSED:
       raise DirectorError(
@@ -308,189 +1244,626 @@ class Director:
           "connection %s" % (method, url, self._next_event._connection_index))
 
     exchange = self._next_event._exchange
-    request = exchange._request
-    # Assert that the method is correct.
-    if method != request._method:
-      raise DirectorError(
-          "Expected 'method' value '%s', received '%s' for connection %s, exchange %s" %
-          (request._method, method, self._next_event._connection_index,
-           self._next_event._exchange_index))
-    # Assert that the URL is correct.
-    if url != request._url:
-      raise DirectorError(
-          "Expected 'url' value '%s', received '%s' for connection %s, exchange %s" %
-          (request._url, url, self._next_event._connection_index,
-           self._next_event._exchange_index))
-    # Create the expected body.
-    if request._body:
-      expected_body = request._body
-    elif request._body_filename:
-      f = open(request._body_filename, 'rb')
-      expected_body = f.read()
-      f.close()
-    else:
-      expected_body = None
-    if request._body_type == 'json':
-      # Convert the body and expected body to JSON if needed.
-      if body:
-        body = json.loads(body)
-      if expected_body:
-        expected_body = json.loads(expected_body)
-    # Assert that the optional body is correct.
-    if body != expected_body:
-      raise DirectorError(
-          "Expected 'body' value '%s', received '%s' for connection %s, exchange %s" %
-          (expected_body, body, self._next_event._connection_index,
-           self._next_event._exchange_index))
-    # Assert that the headers are correct.
-    for header_name, expected_header_value in request._headers.iteritems():
-      # Class rfc822.Message performs a case insensitive search on header names.
-      header_value = headers.get(header_name, None)
-      if expected_header_value != header_value:
-        raise DirectorError(
-            "Expected value '%s' for header name '%s', "
-            "received '%s' for connection %s, exchange %s" %
-            (expected_header_value, header_name, header_value,
-             self._next_event._connection_index, self._next_event._exchange_index))
-
+    response = _perform_exchange(exchange, method, url, headers, body,
+        self._next_event._connection_index, self._next_event._exchange_index)
+    self._exchange_indexes = (
+        self._next_event._connection_index, self._next_event._exchange_index)
     self._finish_current_event()
-    return exchange._response
+    return response
 
   def is_done(self):
     """Returns whether the script has been fully run by the client."""
 
     self._ready_next_event()
-    return self._next_event is None
+    return self._next_event is None and self._stubs.is_done()
 
 
-class ScriptParseError(Exception):
-  """An exception raised if elements of a Script could not be parsed."""
+class ConcurrentDirector:
+  """Class that ensures that connections established and requests sent by the
+  client follow the provided Script instance, while allowing the client to
+  perform the connections of the script in parallel.
 
-  def __init__(self, message):
-    self._message = message
+  Each connection opened by the client is bound to a connection of the script,
+  either in the order that the connections are opened, or by the first request
+  sent on the connection. The exchanges on each connection must follow the
+  script, but exchanges on different connections may be interleaved. Stubs may be
+  performed on any connection.
 
-  def __str__(self):
-    return repr(self)
+  If the script is not followed, a DirectorError is raised.
+  """
 
-  def __repr__(self):
-    return self._message
+  BIND_BY_ORDER = 'order'
+  BIND_BY_REQUEST = 'request'
 
+  class _Cursor:
+    """The position of an opened connection within its connection of the
+    script.
+    """
 
-def script_from_data(script_data, base_dir=None):
-  """Returns a Script instance parsed from the given Python objects.
-  """
+    def __init__(self, director, connection_index=None, connection=None):
+      self._director = director
+      self._connection_index = connection_index
+      self._exchanges = connection._exchanges if connection else None
+      # The index into _exchanges of the next expected exchange.
+      self._next_exchange = 0
+      # The connection and exchange indexes of the last request received.
+      self._exchange_indexes = None
 
-  if not base_dir:
-    base_dir = os.getcwd()
+    def _bind(self, connection_index, connection):
+      self._connection_index = connection_index
+      self._exchanges = connection._exchanges
 
-  connections = []
-  for i, connection_data in enumerate(script_data, 1):
-    exchanges = []
-    reached_no_reply = False
-    for j, exchange_data in enumerate(connection_data, 1):
-      if reached_no_reply:
-        raise ScriptParseError(
-            "Reply missing for exchange preceding connection %s, exchange %s" % (i, j))
-
-      request_data = exchange_data.get('request', None)
-      if request_data is None:
-        raise ScriptParseError(
-            "Missing 'request' key for connection %s, exchange %s" % (i, j))
-      # Get and validate the required method.
-      method = request_data.get('method', None)
-      if method is None:
-        raise ScriptParseError(
-            "Missing 'method' key for request in connection %s, exchange %s" % (i, j))
-      method_upper = method.upper()
-      if method_upper not in ('HEAD', 'GET', 'PUT', 'POST', 'DELETE'):
-        raise ScriptParseError(
-            "Invalid method '%s' for request in connection %s, exchange %s" %
-            (method, i, j))
-      # Get the required URL.
-      url = request_data.get('url', None)
-      if not url:
-        raise ScriptParseError(
-            "Missing 'url' key for request in connection %s, exchange %s" % (i, j))
-      # Get the optional headers and body.
-      headers = request_data.get('headers', {})
-      body = request_data.get('body', None)
-      body_filename = request_data.get('body_filename', None)
-      body_type = request_data.get('body_type', None)
-      if body_type:
-        body_type = body_type.lower()
-        if body_type != 'json':
-          raise ScriptParseError(
-              "Invalid body type '%s' for request in connection %s, exchange %s" %
-              (body_type, i, j))
-      # Create the request.
-      if body and body_filename:
-        raise ScriptParseError(
-              "Found both 'body' and 'body_filename' keys for request in "
-              "connection %s, exchange %s" % (i, j))
-      elif body:
-        # Create the request with the given body.
-        request = Exchange.Request.request_with_body(
-            method, url, body, body_type, headers)
-      elif body_filename:
-        # Create the request with a body from the given filename.
-        if not os.path.isabs(body_filename):
-          body_filename = os.path.normpath(os.path.join(base_dir, body_filename))
-        request = Exchange.Request.request_from_file(
-            method, url, body_filename, body_type, headers)
-      else:
-        # Create a request with no body.
-        request = Exchange.Request.request_with_no_body(method, url, headers)
-
-      response_data = exchange_data.get('response', None)
-      if response_data:
-        # Get the required status code.
-        status_code = response_data.get('status_code', None)
-        if not status_code:
-          raise ScriptParseError(
-              "Missing 'status_code' key for response in connection %s, exchange %s" %
-              (i, j))
-        # Get the required content type.
-        content_type = response_data.get('content_type', None)
-        if not content_type:
-          raise ScriptParseError(
-              "Missing 'content_type' key for response in connection %s, exchange %s" %
-              (i, j))
-        # Get the optional headers and delay.
-        headers = response_data.get('headers', {})
-        delay = response_data.get('delay', 0)
-
-        body = response_data.get('body', None)
-        body_filename = response_data.get('body_filename', None)
-        if body and body_filename:
-          raise ScriptParseError(
-              "Found both 'body' and 'body_filename' keys for response in "
-              "connection %s, exchange %s" % (i, j))
-        elif body:
-          # Create the response with the given body.
-          response = Exchange.Response.response_with_body(
-              status_code, content_type, body, headers, delay)
-        elif body_filename:
-          if not os.path.isabs(body_filename):
-            body_filename = os.path.normpath(os.path.join(base_dir, body_filename))
-          # Create the response with a body from the given filename.
-          response = Exchange.Response.response_from_file(
-              status_code, content_type, body_filename, headers, delay)
-        else:
-          raise ScriptParseError(
-              "Missing both 'body' and 'body_filename' keys for response in "
-              "connection %s, exchange %s" % (i, j))
-      else:
-        # There is no response for this request.
-        reached_no_reply = True
-        response = None
+    def got_request(self, method, url, headers={}, body=None):
+      """Called by the web server when the client sends an HTTP request on this
+      connection.
+
+      Returns the reply to send back, or None if the server should wait for the
+      client to close the connection.
+      """
+
+      stub, body = _match_stub(
+          self._director._stubs, method, url, headers, body)
+      if stub is not None:
+        stub_index, exchange = stub
+        self._exchange_indexes = ('stub', stub_index)
+        return _render_response(exchange, method, url, headers, body)
+
+      if self._exchanges is None:
+        self._director._bind_by_request(self, method, url)
+      if self._next_exchange == len(self._exchanges):
+        raise DirectorError(
+            "Client sent request with method '%s' and URL '%s' instead of closing "
+            "connection %s" % (method, url, self._connection_index))
+
+      exchange = self._exchanges[self._next_exchange]
+      response = _perform_exchange(exchange, method, url, headers, body,
+          self._connection_index, self._next_exchange + 1)
+      self._next_exchange += 1
+      self._exchange_indexes = (self._connection_index, self._next_exchange)
+      return response
+
+    def connection_closed(self):
+      """Called by the web server when the client closes this connection."""
+
+      if self._exchanges is None:
+        if self._exchange_indexes is not None:
+          # Only stubs were performed, so the cursor is never bound.
+          self._director._cursor_closed(unbound=True)
+          return
+        self._director._bind_by_request(self)
+      self._director._cursor_closed()
+      if self._next_exchange < len(self._exchanges):
+        raise DirectorError(
+            'Client closed connection %s instead of performing exchange %s' %
+            (self._connection_index, self._next_exchange + 1))
+
+  def __init__(self, script, bind_by=BIND_BY_ORDER):
+    if bind_by not in (ConcurrentDirector.BIND_BY_ORDER,
+                       ConcurrentDirector.BIND_BY_REQUEST):
+      raise ValueError("Invalid bind_by value '%s'" % bind_by)
+    self._bind_by = bind_by
+    self._stubs = _StubTable(script._stubs)
+    # Guards all following fields, which are shared by the connection threads.
+    self._lock = threading.Lock()
+    # Yields the (connection_index, connection) pairs of the script, which are
+    # created only as they are needed if the script is a LazyScript.
+    self._connections_iter = enumerate(script._connections, 1)
+    # The pairs taken from _connections_iter but not yet bound to a cursor.
+    self._unbound = []
+    # The number of opened cursors not yet bound to a connection of the script.
+    self._num_opened_unbound = 0
+    # The number of opened cursors not yet closed.
+    self._num_open = 0
+
+  def _has_unbound(self, i):
+    """Returns whether there are more than i unbound connections, taking
+    connections from the script as needed.
+
+    The caller must hold the lock.
+    """
+
+    while len(self._unbound) <= i:
+      try:
+        self._unbound.append(next(self._connections_iter))
+      except StopIteration:
+        return False
+    return True
+
+  def _bind_by_request(self, cursor, method=None, url=None):
+    """Binds the given cursor to the first unbound connection of the script
+    that begins with the given method and URL, or that has no exchanges if no
+    method and URL are given.
+    """
+
+    with self._lock:
+      i = 0
+      while self._has_unbound(i):
+        connection_index, connection = self._unbound[i]
+        exchanges = connection._exchanges
+        if method is None:
+          matches = not exchanges
+        else:
+          matches = (exchanges and
+                     exchanges[0]._request._method == method and
+                     _url_matches(exchanges[0]._request, url))
+        if matches:
+          del self._unbound[i]
+          self._num_opened_unbound -= 1
+          cursor._bind(connection_index, connection)
+          return
+        i += 1
+    if method is None:
+      raise DirectorError(
+          'Client closed a connection without sending a request, '
+          'but every remaining connection expects a request')
+    raise DirectorError(
+        "Client sent request with method '%s' and URL '%s' that does not begin "
+        "any remaining connection" % (method, url))
+
+  def _cursor_closed(self, unbound=False):
+    with self._lock:
+      self._num_open -= 1
+      if unbound:
+        self._num_opened_unbound -= 1
+
+  def connection_opened(self):
+    """Called by the web server when the client opens a connection.
+
+    Returns the object whose got_request and connection_closed methods must be
+    called for the opened connection.
+    """
+
+    with self._lock:
+      # Each opened cursor not yet bound will be bound to an unbound connection.
+      if not self._has_unbound(self._num_opened_unbound):
+        if self._stubs.is_done():
+          raise DirectorError('Client opened a connection after the script ended.')
+        return _StubCursor(self._stubs)
+      self._num_open += 1
+      if self._bind_by == ConcurrentDirector.BIND_BY_ORDER:
+        connection_index, connection = self._unbound.pop(0)
+        return ConcurrentDirector._Cursor(self, connection_index, connection)
+      self._num_opened_unbound += 1
+    return ConcurrentDirector._Cursor(self)
+
+  def is_done(self):
+    """Returns whether the script has been fully run by the client."""
+
+    with self._lock:
+      return (not self._num_open and not self._has_unbound(0) and
+              self._stubs.is_done())
+
+
+class UnorderedDirector:
+  """Class that ensures that the requests sent by the client are those in the
+  provided Script instance, but in any order and over any connections.
+
+  Pending exchanges are indexed by method and URL. A request is matched to the
+  first pending exchange with its method and URL whose headers and body also
+  match. If no pending exchange matches, a DirectorError is raised. The
+  exchanges that were never matched are returned by unconsumed.
+
+  Request bodies are read entirely before they are matched, because a request
+  may be compared to several pending exchanges. Stubs are matched before the
+  exchanges of the script.
+  """
+
+  class _Cursor:
+    """An opened connection, which records the exchange matched by its last
+    request.
+    """
+
+    def __init__(self, director):
+      self._director = director
+      # The connection and exchange indexes of the last request received.
+      self._exchange_indexes = None
+
+    def got_request(self, method, url, headers={}, body=None):
+      """Called by the web server when the client sends an HTTP request on this
+      connection.
+
+      Returns the reply to send back, or None if the server should wait for the
+      client to close the connection.
+      """
+
+      stub, body = _match_stub(
+          self._director._stubs, method, url, headers, body)
+      if stub is not None:
+        stub_index, exchange = stub
+        self._exchange_indexes = ('stub', stub_index)
+        return _render_response(exchange, method, url, headers, body)
+
+      if hasattr(body, 'read'):
+        body = body.read() or None
+      connection_index, exchange_index, exchange = self._director._match(
+          method, url, headers, body)
+      self._exchange_indexes = (connection_index, exchange_index)
+      return _render_response(exchange, method, url, headers, body)
+
+    def connection_closed(self):
+      """Called by the web server when the client closes this connection."""
+
+      self._director._cursor_closed()
+
+  def __init__(self, script):
+    # Guards all following fields, which are shared by the connection threads.
+    self._lock = threading.Lock()
+    # Yields the (connection_index, connection) pairs of the script, which are
+    # created only as they are needed if the script is a LazyScript.
+    self._connections_iter = enumerate(script._connections, 1)
+    self._routes = _RouteTable()
+    # The number of opened cursors not yet closed.
+    self._num_open = 0
+    self._stubs = _StubTable(script._stubs)
+
+  def _add_next_connection(self):
+    """Adds the exchanges of the next connection of the script to the route
+    table, and returns whether there was such a connection.
+
+    The caller must hold the lock.
+    """
+
+    try:
+      connection_index, connection = next(self._connections_iter)
+    except StopIteration:
+      return False
+    for exchange_index, exchange in enumerate(connection._exchanges, 1):
+      self._routes.add(
+          exchange._request, (connection_index, exchange_index, exchange))
+    return True
+
+  def _match(self, method, url, headers, body):
+    with self._lock:
+      first_error = None
+      # The (connection_index, exchange_index) of each candidate that did not
+      # match, so that it is not verified again.
+      failed = set()
+      # Add connections of the script until an exchange matches the request, as
+      # a later connection may match even if some candidate does not.
+      while True:
+        for entry in self._routes.candidates(method, url):
+          connection_index, exchange_index, exchange = entry
+          if (connection_index, exchange_index) in failed:
+            continue
+          try:
+            _verify_request(exchange._request, method, url, headers, body,
+                connection_index, exchange_index)
+          except DirectorError as e:
+            first_error = first_error or e
+            failed.add((connection_index, exchange_index))
+            continue
+          self._routes.remove(exchange._request, entry)
+          return entry
+        if not self._add_next_connection():
+          break
+      if first_error:
+        raise first_error
+      raise DirectorError(
+          "Client sent request with method '%s' and URL '%s' that matches no "
+          "remaining exchange" % (method, url))
+
+  def _cursor_closed(self):
+    with self._lock:
+      self._num_open -= 1
+
+  def connection_opened(self):
+    """Called by the web server when the client opens a connection.
+
+    Returns the object whose got_request and connection_closed methods must be
+    called for the opened connection.
+    """
+
+    with self._lock:
+      self._num_open += 1
+    return UnorderedDirector._Cursor(self)
+
+  def is_done(self):
+    """Returns whether every exchange of the script has been matched, and every
+    connection has been closed.
+    """
+
+    with self._lock:
+      return (not self._num_open and not self._routes and
+              not self._add_next_connection() and self._stubs.is_done())
+
+  def unconsumed(self):
+    """Returns the (connection_index, exchange_index, exchange) entries of the
+    script that were never matched by a request.
+    """
+
+    with self._lock:
+      while self._add_next_connection():
+        pass
+      return self._routes.entries()
+
+
+class ScriptParseError(Exception):
+  """An exception raised if elements of a Script could not be parsed."""
+
+  def __init__(self, message):
+    self._message = message
+
+  def __str__(self):
+    return repr(self)
+
+  def __repr__(self):
+    return self._message
+
+
+def script_from_data(script_data, base_dir=None):
+  """Returns a Script instance parsed from the given Python objects.
+
+  The objects are either the array of connections, or a map with the optional
+  keys 'connections', which is the array of connections, and 'stubs', which is
+  the array of stubs.
+  """
+
+  if not base_dir:
+    base_dir = os.getcwd()
+
+  if isinstance(script_data, dict):
+    connections_data = script_data.get('connections', None) or []
+    stubs_data = script_data.get('stubs', None) or []
+  else:
+    connections_data = script_data
+    stubs_data = []
+  connections = []
+  for i, connection_data in enumerate(connections_data, 1):
+    connections.append(_connection_from_data(connection_data, i, base_dir))
+  stubs = []
+  for i, stub_data in enumerate(stubs_data, 1):
+    stubs.append(_stub_from_data(stub_data, i, base_dir))
+  return Script(connections, stubs)
+
+def _connection_from_data(connection_data, i, base_dir):
+  """Returns a Connection instance parsed from the given Python objects, which
+  specify connection i of the script.
+  """
+
+  exchanges = []
+  reached_no_reply = False
+  for j, exchange_data in enumerate(connection_data, 1):
+    if reached_no_reply:
+      raise ScriptParseError(
+          "Reply missing for exchange preceding connection %s, exchange %s" % (i, j))
+    exchange = _exchange_from_data(
+        exchange_data, 'connection %s, exchange %s' % (i, j), base_dir)
+    reached_no_reply = exchange._response is None
+    exchanges.append(exchange)
+
+  return Connection(exchanges)
+
+def _stub_from_data(stub_data, i, base_dir):
+  """Returns a Stub instance parsed from the given Python objects, which specify
+  stub i of the script.
+  """
+
+  location = 'stub %s' % i
+  exchange = _exchange_from_data(stub_data, location, base_dir)
+  if exchange._response is None:
+    raise ScriptParseError("Missing 'response' key for %s" % location)
+  count = stub_data.get('count', None)
+  if count is not None and (
+      not isinstance(count, (int, long)) or isinstance(count, bool) or count < 1):
+    raise ScriptParseError("Invalid count '%s' for %s" % (count, location))
+  rate = stub_data.get('rate', None)
+  if rate is not None and (
+      not isinstance(rate, (int, long, float)) or isinstance(rate, bool) or
+      rate <= 0):
+    raise ScriptParseError("Invalid rate '%s' for %s" % (rate, location))
+  return Stub(exchange, count, rate)
+
+def _value_from_data(value_data, name, location):
+  """Returns the string or Pattern instance parsed from the given Python
+  objects, which specify the value of the given name in the given location.
+
+  A pattern is a map with a single key, which is its kind.
+  """
+
+  if not isinstance(value_data, dict):
+    return value_data
+  if len(value_data) != 1 or value_data.keys()[0] not in Pattern.KINDS:
+    raise ScriptParseError(
+        "Invalid pattern for %s in %s, expected a map with one of the keys %s" %
+        (name, location, ', '.join("'%s'" % kind for kind in Pattern.KINDS)))
+  kind, source = value_data.items()[0]
+  try:
+    return Pattern(kind, source)
+  except ValueError as e:
+    raise ScriptParseError("%s for %s in %s" % (e, name, location))
+
+def _throttle_from_data(response_data, location):
+  """Returns the (bandwidth, drip_bytes, drip_delay) tuple that throttles the
+  body of the given response data, or None if it is not throttled.
+  """
+
+  bandwidth = response_data.get('bandwidth', None)
+  drip_bytes = response_data.get('drip_bytes', None)
+  drip_delay = response_data.get('drip_delay', 0)
+  if bandwidth is not None and (
+      not isinstance(bandwidth, (int, long, float)) or bandwidth <= 0):
+    raise ScriptParseError("Invalid 'bandwidth' key for response in %s, "
+        "expected a positive number of bytes per second" % location)
+  if drip_bytes is not None and (
+      not isinstance(drip_bytes, (int, long)) or drip_bytes <= 0):
+    raise ScriptParseError("Invalid 'drip_bytes' key for response in %s, "
+        "expected a positive number of bytes" % location)
+  if not isinstance(drip_delay, (int, long, float)) or drip_delay < 0:
+    raise ScriptParseError("Invalid 'drip_delay' key for response in %s, "
+        "expected a number of seconds" % location)
+  if drip_delay and drip_bytes is None:
+    raise ScriptParseError(
+        "Found 'drip_delay' without 'drip_bytes' for response in %s" % location)
+  if bandwidth is None and drip_bytes is None:
+    return None
+  return (bandwidth, drip_bytes, drip_delay)
+
+def _fault_from_data(response_data, location):
+  """Returns the (fault_type, value) tuple of the fault of the given response
+  data, or None if it has no fault.
+  """
+
+  fault_data = response_data.get('fault', None)
+  if fault_data is None:
+    return None
+  if not isinstance(fault_data, dict):
+    raise ScriptParseError(
+        "Invalid 'fault' key for response in %s, expected a map" % location)
+  fault_type = fault_data.get('type', None)
+  if fault_type in Exchange.Response.FAULT_TYPES_AFTER_BYTES:
+    value_name = 'after_bytes'
+    value = fault_data.get(value_name, 0)
+  elif fault_type == Exchange.Response.FAULT_CONTENT_LENGTH:
+    if response_data.get('chunks', None):
+      raise ScriptParseError("Fault type '%s' cannot be used with 'chunks' for "
+          "response in %s" % (fault_type, location))
+    value_name = 'content_length'
+    value = fault_data.get(value_name, None)
+  else:
+    raise ScriptParseError(
+        "Invalid fault type '%s' for response in %s" % (fault_type, location))
+  if not isinstance(value, (int, long)) or value < 0:
+    raise ScriptParseError("Invalid '%s' key of fault for response in %s, "
+        "expected a number of bytes" % (value_name, location))
+  return (fault_type, value)
+
+def _exchange_from_data(exchange_data, location, base_dir):
+  """Returns an Exchange instance parsed from the given Python objects, where
+  location names the exchange in errors.
+  """
+
+  request_data = exchange_data.get('request', None)
+  if request_data is None:
+    raise ScriptParseError("Missing 'request' key for %s" % location)
+  # Get and validate the required method.
+  method = request_data.get('method', None)
+  if method is None:
+    raise ScriptParseError("Missing 'method' key for request in %s" % location)
+  method_upper = method.upper()
+  if method_upper not in ('HEAD', 'GET', 'PUT', 'POST', 'DELETE'):
+    raise ScriptParseError(
+        "Invalid method '%s' for request in %s" % (method, location))
+  # Get the required URL.
+  url = request_data.get('url', None)
+  if not url:
+    raise ScriptParseError("Missing 'url' key for request in %s" % location)
+  url = _value_from_data(url, "'url' key", location)
+  # Get the optional headers, query parameters, and body.
+  # The maps are copied, so that the given data can be parsed again.
+  headers = {}
+  for header_name, header_value in request_data.get('headers', {}).iteritems():
+    headers[header_name] = _value_from_data(
+        header_value, "header '%s'" % header_name, location)
+  query = request_data.get('query', None)
+  if query is not None:
+    if not isinstance(query, dict):
+      raise ScriptParseError(
+          "Invalid 'query' key for request in %s, expected a map" % location)
+    query = dict(
+        (name, _value_from_data(value, "query parameter '%s'" % name, location))
+        for name, value in query.iteritems())
+  body = request_data.get('body', None)
+  body_filename = request_data.get('body_filename', None)
+  body_type = request_data.get('body_type', None)
+  if body_type:
+    body_type = body_type.lower()
+    if body_type != 'json':
+      raise ScriptParseError(
+          "Invalid body type '%s' for request in %s" % (body_type, location))
+  # Create the request.
+  if body and body_filename:
+    raise ScriptParseError(
+        "Found both 'body' and 'body_filename' keys for request in %s" % location)
+  try:
+    if body:
+      # Create the request with the given body.
+      request = Exchange.Request.request_with_body(
+          method, url, body, body_type, headers, query)
+    elif body_filename:
+      # Create the request with a body from the given filename.
+      if not os.path.isabs(body_filename):
+        body_filename = os.path.normpath(os.path.join(base_dir, body_filename))
+      request = Exchange.Request.request_from_file(
+          method, url, body_filename, body_type, headers, query)
+    else:
+      # Create a request with no body.
+      request = Exchange.Request.request_with_no_body(method, url, headers, query)
+  except (IOError, OSError, ValueError) as e:
+    raise ScriptParseError(
+        "Could not load body for request in %s: %s" % (location, e))
 
-      exchange = Exchange(request, response)
-      exchanges.append(exchange)
+  response_data = exchange_data.get('response', None)
+  if response_data:
+    # Get the required status code.
+    status_code = response_data.get('status_code', None)
+    if not status_code:
+      raise ScriptParseError(
+          "Missing 'status_code' key for response in %s" % location)
+    # Get the required content type.
+    content_type = response_data.get('content_type', None)
+    if not content_type:
+      raise ScriptParseError(
+          "Missing 'content_type' key for response in %s" % location)
+    # Get the optional headers, delay, and whether the body and headers are
+    # templates.
+    headers = response_data.get('headers', {})
+    delay = response_data.get('delay', 0)
+    templated = bool(response_data.get('template', False))
+    compress = bool(response_data.get('compress', False))
+    throttle = _throttle_from_data(response_data, location)
+    fault = _fault_from_data(response_data, location)
 
-    connection = Connection(exchanges)
-    connections.append(connection)
+    body = response_data.get('body', None)
+    body_filename = response_data.get('body_filename', None)
+    chunks_data = response_data.get('chunks', None)
+    if len([key for key in (body is not None, body_filename, chunks_data)
+            if key]) > 1:
+      raise ScriptParseError(
+          "Found more than one of 'body', 'body_filename', and 'chunks' keys "
+          "for response in %s" % location)
+    elif not (body is not None or body_filename or chunks_data):
+      raise ScriptParseError(
+          "Missing all of 'body', 'body_filename', and 'chunks' keys for "
+          "response in %s" % location)
+    elif chunks_data:
+      chunks = []
+      for k, chunk_data in enumerate(chunks_data, 1):
+        if isinstance(chunk_data, dict):
+          chunk_body = chunk_data.get('body', None)
+          chunk_delay = chunk_data.get('delay', 0)
+        else:
+          chunk_body = chunk_data
+          chunk_delay = 0
+        if not chunk_body:
+          raise ScriptParseError(
+              "Missing 'body' for chunk %s of response in %s" % (k, location))
+        chunks.append((str(chunk_body), chunk_delay))
+    try:
+      if chunks_data:
+        # Create the response with the given chunks.
+        response = Exchange.Response.response_with_chunks(
+            status_code, content_type, chunks, headers, delay, templated,
+            throttle, fault)
+      elif body is not None:
+        # Create the response with the given body, which may be empty.
+        response = Exchange.Response.response_with_body(status_code,
+            content_type, body, headers, delay, templated, compress, throttle,
+            fault)
+      else:
+        if not os.path.isabs(body_filename):
+          body_filename = os.path.normpath(os.path.join(base_dir, body_filename))
+        # Create the response with a body from the given filename.
+        response = Exchange.Response.response_from_file(status_code,
+            content_type, body_filename, headers, delay, templated, compress,
+            throttle, fault)
+    except ValueError as e:
+      raise ScriptParseError(
+          "Invalid template for response in %s: %s" % (location, e))
+  else:
+    # There is no response for this request.
+    response = None
 
-  return Script(connections)
+  return Exchange(request, response)
 
 def script_from_json_string(json_string, base_dir=None):
   """Returns a Script instance parsed from the given string containing JSON.
@@ -538,124 +1911,2348 @@ def script_from_yaml_file(yaml_filename):
   return script_from_yaml_string(
       yaml_string, _dirname_for_filename(yaml_filename))
 
+def script_from_jsonl_file(jsonl_filename):
+  """Returns a LazyScript instance that reads each connection from the given
+  filename in JSON Lines format as the connection is reached.
 
-class DirectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
-  """A request handler that uses the given Director instance to verify the
-  script.
+  Each non-empty line of the file is an array of the exchanges of a connection.
   """
 
-  @staticmethod
-  def set_director(director):
-    """Sets the director for use over the lifetime of the web server."""
-    DirectorRequestHandler._director = director
+  def connections():
+    base_dir = _dirname_for_filename(jsonl_filename)
+    f = open(jsonl_filename, 'r')
+    try:
+      i = 0
+      for line in f:
+        if not line.strip():
+          continue
+        i += 1
+        try:
+          connection_data = json.loads(line)
+        except ValueError as e:
+          raise ScriptParseError(
+              "Invalid JSON for connection %s: %s" % (i, e))
+        yield _connection_from_data(connection_data, i, base_dir)
+    finally:
+      f.close()
 
-    DirectorRequestHandler._script_error = False
-    DirectorRequestHandler._script_done = False
+  return LazyScript(connections())
 
-  def setup(self):
-    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+# Identifies a file written by compile_script, and the version of its format.
+_COMPILED_SCRIPT_MAGIC = 'canned_http compiled script'
+_COMPILED_SCRIPT_VERSION = 7
 
-    # Allow persistent connections.
-    self.protocol_version = 'HTTP/1.1'
+def _compiled_value(value):
+  """Returns the given string, or a (kind, source) tuple for a Pattern."""
 
-  def handle_request(self):
-    # Get the HTTP method and URL of the request.
-    method = self.command
-    url = self.path
-    headers = self.headers
-    # Get the body of the request.
-    content_length = self.headers.get('Content-Length', None)
-    if content_length:
-      content_length = int(content_length)
-      body = self.rfile.read(content_length)
-      if not body:
-        body = None
+  if isinstance(value, Pattern):
+    return (value._kind, value._source)
+  return value
+
+def _compiled_values(values):
+  """Returns the given map of values, or None, with each value compiled."""
+
+  if not values or not any(
+      isinstance(value, Pattern) for value in values.itervalues()):
+    return values
+  return dict((name, _compiled_value(value)) for name, value in values.iteritems())
+
+def _value_from_compiled(value):
+  if isinstance(value, tuple):
+    return Pattern(*value)
+  return value
+
+def _values_from_compiled(values):
+  # Most maps have no patterns, and are used without being copied.
+  if not values or not any(
+      isinstance(value, tuple) for value in values.itervalues()):
+    return values
+  return dict(
+      (name, _value_from_compiled(value)) for name, value in values.iteritems())
+
+def _compiled_exchange_data(exchange):
+  """Returns the (request_data, response_data) tuples for the given Exchange."""
+
+  request = exchange._request
+  request_data = (request._method, _compiled_value(request._url),
+      _compiled_values(request._headers), request._body, request._body_filename,
+      request._body_type, _compiled_values(request._query))
+  response = exchange._response
+  if response:
+    response_data = (response._status_code, response._content_type,
+        response._delay, response._headers, response._body,
+        response._body_filename, response._chunks,
+        response._templates is not None, response._compress, response._throttle,
+        response._fault)
+  else:
+    response_data = None
+  return (request_data, response_data)
+
+def compile_script(script, compiled_filename):
+  """Writes the given Script instance to the given filename in a compiled form,
+  which script_from_compiled_file can read much faster than the YAML or JSON
+  that it was parsed from.
+  """
+
+  connections_data = []
+  for connection in script._connections:
+    connections_data.append(tuple(_compiled_exchange_data(exchange)
+                                  for exchange in connection._exchanges))
+  stubs_data = []
+  for stub in script._stubs:
+    stubs_data.append(
+        (_compiled_exchange_data(stub._exchange), stub._count, stub._rate))
+
+  f = open(compiled_filename, 'wb')
+  marshal.dump((_COMPILED_SCRIPT_MAGIC, _COMPILED_SCRIPT_VERSION,
+                tuple(connections_data), tuple(stubs_data)),
+               f)
+  f.close()
+
+def script_from_compiled_file(compiled_filename):
+  """Reads the contents of the given filename written by compile_script and
+  returns a Script instance.
+
+  The script was validated when it was compiled, and so it is not validated
+  again.
+  """
+
+  # Collecting garbage while creating many objects that are never garbage would
+  # otherwise dominate the time to load a large script.
+  gc_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    return _script_from_compiled_file(compiled_filename)
+  finally:
+    if gc_enabled:
+      gc.enable()
+
+def _script_from_compiled_file(compiled_filename):
+  f = open(compiled_filename, 'rb')
+  try:
+    compiled_data = marshal.load(f)
+    magic, version = compiled_data[:2]
+  except (EOFError, ValueError, TypeError):
+    raise ScriptParseError(
+        "File '%s' does not contain a compiled script" % compiled_filename)
+  finally:
+    f.close()
+  if magic != _COMPILED_SCRIPT_MAGIC:
+    raise ScriptParseError(
+        "File '%s' does not contain a compiled script" % compiled_filename)
+  elif version != _COMPILED_SCRIPT_VERSION:
+    raise ScriptParseError(
+        "Compiled script '%s' has version %s, expected version %s; compile it again" %
+        (compiled_filename, version, _COMPILED_SCRIPT_VERSION))
+
+  _, _, connections_data, stubs_data = compiled_data
+  connections = []
+  for exchanges_data in connections_data:
+    connections.append(Connection(
+        _exchange_from_compiled_data(exchange_data)
+        for exchange_data in exchanges_data))
+  stubs = []
+  for exchange_data, count, rate in stubs_data:
+    stubs.append(Stub(_exchange_from_compiled_data(exchange_data), count, rate))
+  return Script(connections, stubs)
+
+def _exchange_from_compiled_data(exchange_data):
+  """Returns the Exchange for the tuples returned by _compiled_exchange_data."""
+
+  request_data, response_data = exchange_data
+  method, url, headers, body, body_filename, body_type, query = request_data
+  request = Exchange.Request(method, _value_from_compiled(url),
+      _values_from_compiled(headers), body, body_filename, body_type,
+      _values_from_compiled(query))
+  if response_data:
+    (status_code, content_type, delay, headers, body, body_filename,
+     chunks, templated, compress, throttle, fault) = response_data
+    response = Exchange.Response(status_code, content_type, delay, headers,
+        body, body_filename, chunks, templated, compress, throttle, fault)
+  else:
+    response = None
+  return Exchange(request, response)
+
+
+# The content encodings that responses may be compressed with, in order of
+# preference, and the extension of a file containing a precompressed body.
+_ENCODING_EXTENSIONS = collections.OrderedDict()
+if brotli is not None:
+  _ENCODING_EXTENSIONS['br'] = '.br'
+_ENCODING_EXTENSIONS['gzip'] = '.gz'
+
+def _compress(encoding, contents):
+  """Returns the given string compressed with the given content encoding."""
+
+  if isinstance(contents, unicode):
+    contents = contents.encode('utf-8')
+  if encoding == 'br':
+    return brotli.compress(contents)
+  # Write a gzip header and trailer around the deflated contents.
+  compressor = zlib.compressobj(
+      zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(contents) + compressor.flush()
+
+def _negotiate_encoding(accept_encoding):
+  """Returns the most preferred content encoding in _ENCODING_EXTENSIONS that is
+  accepted by the given value of an Accept-Encoding header, or None if no such
+  encoding is accepted.
+  """
+
+  if not accept_encoding:
+    return None
+  qvalues = {}
+  for coding in accept_encoding.split(','):
+    coding, _, params = coding.partition(';')
+    coding = coding.strip().lower()
+    qvalue = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        qvalue = float(params[2:])
+      except ValueError:
+        qvalue = 0.0
+    qvalues[coding] = qvalue
+  best_encoding = None
+  best_qvalue = 0.0
+  for encoding in _ENCODING_EXTENSIONS:
+    qvalue = qvalues.get(encoding, qvalues.get('*', 0.0))
+    if qvalue > best_qvalue:
+      best_encoding = encoding
+      best_qvalue = qvalue
+  return best_encoding
+
+
+class BodyCache:
+  """A cache of the contents of the files that are used as the bodies of
+  responses.
+
+  Contents are keyed by filename and modification time, so a file that is
+  modified while the server runs is read again. If the cached contents exceed
+  the given byte budget, the least recently used contents are evicted. Files
+  larger than the given maximum file size are never cached.
+
+  The cache also contains the bodies of responses compressed with each content
+  encoding, so that each body is compressed only once.
+  """
+
+  DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+  DEFAULT_MAX_FILE_BYTES = 8 * 1024 * 1024
+
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES,
+      max_file_bytes=DEFAULT_MAX_FILE_BYTES):
+    self._max_bytes = max_bytes
+    self._max_file_bytes = min(max_file_bytes, max_bytes)
+    # Guards all following fields, which are shared by the connection threads.
+    self._lock = threading.Lock()
+    # Maps each filename to its modification time and contents, and each
+    # (encoding, filename) or (encoding, body) to the modification time of the
+    # file or None and the compressed contents, ordered from least to most
+    # recently used.
+    self._entries = collections.OrderedDict()
+    self._num_bytes = 0
+
+  def _get_entry(self, key, mtime):
+    """Returns the contents for the given key if they have the given
+    modification time, or None.
+    """
+
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        if entry[0] == mtime:
+          # Reinsert the entry as the most recently used.
+          self._entries[key] = entry
+          return entry[1]
+        self._num_bytes -= len(entry[1])
+    return None
+
+  def _put_entry(self, key, mtime, contents):
+    with self._lock:
+      if key not in self._entries:
+        self._entries[key] = (mtime, contents)
+        self._num_bytes += len(contents)
+        # Evict the least recently used contents until within the budget.
+        while self._num_bytes > self._max_bytes:
+          _, (_, evicted_contents) = self._entries.popitem(last=False)
+          self._num_bytes -= len(evicted_contents)
+
+  def get(self, filename):
+    """Returns the contents of the given file, or None if the file is too large
+    to cache and must be read by the caller.
+    """
+
+    fs = os.stat(filename)
+    contents = self._get_entry(filename, fs.st_mtime)
+    if contents is not None:
+      return contents
+    if fs.st_size > self._max_file_bytes:
+      return None
+
+    f = open(filename, 'rb')
+    contents = f.read()
+    f.close()
+    self._put_entry(filename, fs.st_mtime, contents)
+    return contents
+
+  def get_compressed(self, encoding, body=None, filename=None):
+    """Returns the given body, or the contents of the given file, compressed
+    with the given content encoding, or None if the file is too large to cache.
+    """
+
+    if filename is not None:
+      key = (encoding, filename)
+      mtime = os.stat(filename).st_mtime
     else:
-      body = None
+      key = (encoding, body)
+      mtime = None
+    compressed = self._get_entry(key, mtime)
+    if compressed is not None:
+      return compressed
 
-    response = DirectorRequestHandler._director.got_request(method, url, headers, body)
+    if filename is not None:
+      contents = self.get(filename)
+      if contents is None:
+        return None
+    else:
+      contents = body
+    compressed = _compress(encoding, contents)
+    self._put_entry(key, mtime, compressed)
+    return compressed
 
-    if response:
-      time.sleep(response._delay)
+  def preload(self, script):
+    """Caches the contents of the files used as the bodies of responses in the
+    given Script instance.
+    """
 
-      # Get the body of the response.
-      if response._body:
-        body = response._body
-        file_size = len(body)
+    exchanges = itertools.chain(
+        (exchange for connection in script._connections
+         for exchange in connection._exchanges),
+        (stub._exchange for stub in script._stubs))
+    for exchange in exchanges:
+      response = exchange._response
+      if response and response._body_filename:
+        try:
+          self.get(response._body_filename)
+        except (IOError, OSError):
+          # Report the missing file if the response is sent.
+          pass
+
+
+class Metrics:
+  """Histograms of the time spent in each phase of serving each exchange.
+
+  The histograms are labeled by phase, connection index, and exchange index, and
+  can be exported in the Prometheus text format or as JSON. The servers of a
+  CannedServerPool each record into a view returned by for_script, so that their
+  histograms are also labeled by script.
+  """
+
+  # Parsing the request line and headers.
+  PARSE_HEADERS = 'parse_headers'
+  # Reading the request body and verifying the request against the script.
+  VERIFY_REQUEST = 'verify_request'
+  # Waiting for the delay of the response.
+  DELAY = 'delay'
+  # Getting the body of the response from the script, cache, or file.
+  LOAD_BODY = 'load_body'
+  # Writing the response to the socket.
+  WRITE_RESPONSE = 'write_response'
+
+  # The upper bounds of the histogram buckets, in seconds.
+  BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+             0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Maps each (script, phase, connection_index, exchange_index) to its
+    # histogram, which is the count for each bucket followed by the sum of all
+    # times. The script is None unless recorded by a view from for_script.
+    self._histograms = {}
+    self._script = None
+
+  def for_script(self, script):
+    """Returns a Metrics instance that records into the histograms of this
+    instance, labeled by the given script name, and exports only those
+    histograms.
+    """
+
+    metrics = Metrics()
+    metrics._lock = self._lock
+    metrics._histograms = self._histograms
+    metrics._script = script
+    return metrics
+
+  def observe(self, phase, connection_index, exchange_index, seconds):
+    """Records the number of seconds spent in the given phase of serving the
+    given exchange.
+    """
+
+    key = (self._script, phase, connection_index, exchange_index)
+    with self._lock:
+      histogram = self._histograms.get(key, None)
+      if histogram is None:
+        histogram = [0] * (len(Metrics.BUCKETS) + 1) + [0.0]
+        self._histograms[key] = histogram
+      # Buckets are not cumulative until exported.
+      for i, bucket in enumerate(Metrics.BUCKETS):
+        if seconds <= bucket:
+          break
       else:
-        f = open(response._body_filename, 'rb')
-        fs = os.fstat(f.fileno())
-        body = f.read()
-        file_size = fs.st_size
-        f.close()
+        i = len(Metrics.BUCKETS)
+      histogram[i] += 1
+      histogram[-1] += seconds
 
-      # Send the headers of the response.
-      self.send_response(response._status_code)
-      self.send_header('Content-Type', response._content_type)
-      self.send_header('Content-Length', file_size)
-      for header_name, header_value in response._headers.iteritems():
-        self.send_header(header_name, header_value)
-      self.end_headers()
+  def _sorted_histograms(self):
+    with self._lock:
+      return sorted((key, list(histogram))
+                    for key, histogram in self._histograms.iteritems()
+                    if self._script is None or key[0] == self._script)
 
-      # Send the body to conclude the response.
-      self.wfile.write(body)
+  def to_prometheus(self):
+    """Returns the histograms in the Prometheus text format."""
 
-    DirectorRequestHandler._script_done = DirectorRequestHandler._director.is_done()
+    lines = [
+        '# HELP canned_http_phase_seconds Time spent in each phase of serving '
+        'an exchange.',
+        '# TYPE canned_http_phase_seconds histogram',
+    ]
+    for (script, phase, connection_index, exchange_index), histogram in (
+        self._sorted_histograms()):
+      labels = 'phase="%s",connection="%s",exchange="%s"' % (
+          phase, connection_index, exchange_index)
+      if script is not None:
+        labels = 'script="%s",%s' % (script, labels)
+      count = 0
+      for bucket, bucket_count in zip(Metrics.BUCKETS + ('+Inf',), histogram):
+        count += bucket_count
+        lines.append('canned_http_phase_seconds_bucket{%s,le="%s"} %s' %
+            (labels, bucket, count))
+      lines.append('canned_http_phase_seconds_sum{%s} %r' % (labels, histogram[-1]))
+      lines.append('canned_http_phase_seconds_count{%s} %s' % (labels, count))
+    return '\n'.join(lines) + '\n'
 
-  def do_HEAD(self):
-    self.handle_request()
+  def to_json_data(self):
+    """Returns the histograms as Python objects that can be converted to JSON."""
+
+    histograms = []
+    for (script, phase, connection_index, exchange_index), histogram in (
+        self._sorted_histograms()):
+      histogram_data = {
+          'phase': phase,
+          'connection': connection_index,
+          'exchange': exchange_index,
+          'buckets': dict(zip(
+              [str(bucket) for bucket in Metrics.BUCKETS] + ['+Inf'],
+              histogram[:-1])),
+          'sum': histogram[-1],
+          'count': sum(histogram[:-1]),
+      }
+      if script is not None:
+        histogram_data['script'] = script
+      histograms.append(histogram_data)
+    return histograms
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A request handler that returns the histograms of the given Metrics instance
+  in the Prometheus text format for GET requests to /metrics.
+  """
+
+  @staticmethod
+  def set_metrics(metrics):
+    """Sets the metrics for use over the lifetime of the web server."""
+    MetricsRequestHandler._metrics = metrics
 
   def do_GET(self):
-    self.handle_request()
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    body = MetricsRequestHandler._metrics.to_prometheus()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', len(body))
+    self.end_headers()
+    self.wfile.write(body)
 
-  def do_POST(self):
-    self.handle_request()
+  def log_message(self, format, *args):
+    # Do not intersperse scrapes with the requests of the script.
+    pass
 
-  def do_PUT(self):
-    self.handle_request()
 
-  def do_DELETE(self):
-    self.handle_request()
+# The time before the deadline of a delay at which _sleep_until stops sleeping
+# and begins yielding, because time.sleep can oversleep by a scheduler quantum.
+_SLEEP_UNTIL_YIELD_SECONDS = 0.002
 
-  def handle(self):
-    try:
-      DirectorRequestHandler._director.connection_opened()
-      BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
-      DirectorRequestHandler._director.connection_closed()
-      DirectorRequestHandler._script_done = DirectorRequestHandler._director.is_done()
-    except DirectorError as e:
-      # Exceptions raised from handle_request will also be caught here.
-      print >> sys.stderr, 'ERROR: ', repr(e)
-      DirectorRequestHandler._script_error = True
+def _sleep_until(deadline):
+  """Returns once time.time() has reached the given deadline."""
 
-if __name__ == '__main__':
-  arg_parser = argparse.ArgumentParser()
-  arg_parser.add_argument('--port', type=int, required=False, default=8080,
-      help='Port the web server should run on')
-  arg_parser.add_argument('--json_filename', type=str, required=False, default='',
-      help='JSON input file for expected requests and replies')
-  arg_parser.add_argument('--yaml_filename', type=str, required=False, default='',
-      help='YAML input file for expected requests and replies')
-  parsed_args = arg_parser.parse_args()
+  while True:
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return
+    elif remaining > _SLEEP_UNTIL_YIELD_SECONDS:
+      time.sleep(remaining - _SLEEP_UNTIL_YIELD_SECONDS)
+    else:
+      time.sleep(0)
 
-  # Create the script from the provided filename.
-  if parsed_args.json_filename and parsed_args.yaml_filename:
-    print >> sys.stderr, 'Cannot specify both --json_filename and --yaml_filename.'
-    sys.exit(0)
-  elif parsed_args.json_filename:
-    script = script_from_json_file(parsed_args.json_filename)
-  elif parsed_args.yaml_filename:
-    script = script_from_yaml_file(parsed_args.yaml_filename)
-  else:
-    print >> sys.stderr, 'Must specify either --json_filename or --yaml_filename.'
-    sys.exit(0)
 
-  # Create the Director instance and begin serving.
-  director = Director(script)
-  DirectorRequestHandler.set_director(director)
-  # Serve on the specified port until the script is finished or not followed.
-  server = SocketServer.TCPServer(("", parsed_args.port), DirectorRequestHandler)
-  while (not DirectorRequestHandler._script_done and
-         not DirectorRequestHandler._script_error):
-    server.handle_request()
+# The most bytes written at a time by a throttled response, which writes about
+# 20 times per second at its bandwidth otherwise.
+_THROTTLE_MAX_SLICE_BYTES = 16 * 1024
+
+def _throttle_slice_bytes(bandwidth):
+  """Returns the number of bytes to write at a time for the given bandwidth."""
+  return max(1, min(_THROTTLE_MAX_SLICE_BYTES, int(bandwidth / 20)))
+
+
+class _TokenBucket(object):
+  """A token bucket that limits the number of bytes written per second, which
+  can be shared by the threads of many connections.
+
+  Each thread takes the tokens for the bytes it will write, and then waits until
+  the time they are available. No thread is needed to refill the bucket.
+  """
+
+  def __init__(self, bandwidth):
+    self._bandwidth = float(bandwidth)
+    # A full bucket allows writing one slice without waiting.
+    self._capacity = _throttle_slice_bytes(bandwidth)
+    self._lock = threading.Lock()
+    self._tokens = self._capacity
+    self._time = time.time()
+
+  def take(self, num_bytes, now):
+    """Takes the given number of tokens, and returns the time at which they are
+    available, which is later than now if the bucket has too few tokens.
+    """
+
+    with self._lock:
+      self._tokens = min(self._capacity,
+          self._tokens + (now - self._time) * self._bandwidth)
+      self._time = now
+      # Tokens that are not yet available are owed by the next writers.
+      self._tokens -= num_bytes
+      if self._tokens >= 0:
+        return now
+      return now - self._tokens / self._bandwidth
+
+
+class _ThrottledWriter(object):
+  """Writes the body of a response in slices, waiting before each slice until
+  the token buckets of the response and the server have enough tokens, and for
+  any drip delay.
+
+  The wait is spent in the thread that serves the connection, and so throttling
+  does not need any more threads.
+  """
+
+  def __init__(self, wfile, buckets, slice_bytes, slice_delay):
+    self._wfile = wfile
+    self._buckets = buckets
+    self._slice_bytes = slice_bytes
+    self._slice_delay = slice_delay
+
+  def write(self, data):
+    for offset in xrange(0, len(data), self._slice_bytes):
+      data_slice = data[offset:offset + self._slice_bytes]
+      now = time.time()
+      write_time = now + self._slice_delay
+      for bucket in self._buckets:
+        write_time = max(write_time, bucket.take(len(data_slice), now))
+      if write_time > now:
+        # Unlike a scripted delay, this does not need to be precise.
+        time.sleep(write_time - now)
+      self._wfile.write(data_slice)
+
+
+class _FaultInjected(Exception):
+  """Raised by _FaultWriter once the body of a response is cut short."""
+
+
+class _FaultWriter(object):
+  """Writes the body of a response until the given number of bytes have been
+  written, and then raises _FaultInjected.
+  """
+
+  def __init__(self, wfile, num_bytes):
+    self._wfile = wfile
+    self._remaining = num_bytes
+
+  def write(self, data):
+    if len(data) < self._remaining:
+      self._wfile.write(data)
+      self._remaining -= len(data)
+      return
+    if self._remaining:
+      self._wfile.write(data[:self._remaining])
+      self._remaining = 0
+    raise _FaultInjected()
+
+
+class DelayDrift:
+  """Statistics on how much the actual delays before sending responses differed
+  from the delays specified by the script.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._count = 0
+    self._total_drift = 0.0
+    self._max_drift = 0.0
+
+  def add(self, scripted_delay, actual_delay):
+    """Records the actual delay for a response with the given scripted delay."""
+
+    drift = actual_delay - scripted_delay
+    with self._lock:
+      self._count += 1
+      self._total_drift += drift
+      self._max_drift = max(self._max_drift, drift)
+
+  def __repr__(self):
+    with self._lock:
+      if not self._count:
+        return 'no delayed responses'
+      return ('%s delayed responses, mean drift %.3f ms, max drift %.3f ms' %
+          (self._count, 1000 * self._total_drift / self._count,
+           1000 * self._max_drift))
+
+
+class _BodyReader:
+  """Reads the body of a request with the given length from the client."""
+
+  def __init__(self, rfile, length):
+    self._rfile = rfile
+    self._remaining = length
+
+  def read(self, size=-1):
+    """Returns up to size bytes of the body, or the rest of the body if size is
+    negative. Returns an empty string once the body has been read.
+    """
+
+    if size < 0 or size > self._remaining:
+      size = self._remaining
+    if not size:
+      return ''
+    data = self._rfile.read(size)
+    # If the client closed the connection, then there is no more to read.
+    self._remaining = self._remaining - len(data) if data else 0
+    return data
+
+
+class _ChunkedBodyReader:
+  """Reads the body of a request sent with chunked transfer encoding from the
+  client.
+  """
+
+  def __init__(self, rfile):
+    self._rfile = rfile
+    self._chunk_remaining = 0
+    self._done = False
+
+  def _next_chunk(self):
+    if self._chunk_remaining == 0 and not self._done:
+      # Read the size of the next chunk, ignoring any chunk extensions.
+      line = self._rfile.readline()
+      try:
+        self._chunk_remaining = int(line.split(';', 1)[0].strip(), 16)
+      except ValueError:
+        raise DirectorError("Invalid chunk size line '%s'" % line.strip())
+      if self._chunk_remaining == 0:
+        # Read the optional trailer headers and the final line.
+        while line.strip():
+          line = self._rfile.readline()
+        self._done = True
+
+  def read(self, size=-1):
+    """Returns up to size bytes of the body, or the rest of the body if size is
+    negative. Returns an empty string once the body has been read.
+    """
+
+    data = []
+    while size != 0:
+      self._next_chunk()
+      if self._done:
+        break
+      read_size = self._chunk_remaining
+      if size > 0:
+        read_size = min(read_size, size)
+        size -= read_size
+      chunk = self._rfile.read(read_size)
+      if len(chunk) != read_size:
+        raise DirectorError('Client closed connection in the middle of a chunk')
+      data.append(chunk)
+      self._chunk_remaining -= read_size
+      if self._chunk_remaining == 0:
+        # Read the line ending that follows the data of the chunk.
+        self._rfile.readline()
+    return ''.join(data)
+
+
+# The number of bytes of a file to send at a time if os.sendfile is missing.
+_SEND_FILE_CHUNK_BYTES = 256 * 1024
+# Bodies no larger than this are sent with the head of the response in a single
+# write, instead of copying larger bodies into a new string.
+_COMBINE_BODY_BYTES = 64 * 1024
+# The value of the Server header of every response.
+_SERVER_VERSION = '%s %s' % (BaseHTTPServer.BaseHTTPRequestHandler.server_version,
+                             BaseHTTPServer.BaseHTTPRequestHandler.sys_version)
+
+# The value of the Date header, which is formatted again only once per second.
+_http_date_cache = (None, None)
+
+def _http_date():
+  """Returns the current time formatted for the Date header."""
+
+  global _http_date_cache
+  second = int(time.time())
+  cached_second, date = _http_date_cache
+  if cached_second != second:
+    date = email.utils.formatdate(second, usegmt=True)
+    _http_date_cache = (second, date)
+  return date
+
+def _format_head(status_code, content_type, content_length, content_encoding,
+    vary, headers, extra_headers=()):
+  """Returns the status line and headers of a response as a (prefix, suffix,
+  close_connection) tuple, where the value of the Date header must be written
+  between the prefix and suffix.
+
+  If content_length is None, the body is sent with chunked transfer encoding.
+  The headers are a map written after the given sequence of (name, value)
+  extra_headers. The close_connection value is whether a Connection header
+  closes the connection, or None if there is no Connection header.
+  """
+
+  reason = BaseHTTPServer.BaseHTTPRequestHandler.responses.get(
+      status_code, ('',))[0]
+  prefix = 'HTTP/1.1 %d %s\r\nServer: %s\r\nDate: ' % (
+      status_code, reason, _SERVER_VERSION)
+  lines = ['', 'Content-Type: %s' % content_type]
+  if content_length is None:
+    lines.append('Transfer-Encoding: chunked')
+  else:
+    lines.append('Content-Length: %s' % content_length)
+  if content_encoding is not None:
+    lines.append('Content-Encoding: %s' % content_encoding)
+  if vary:
+    lines.append('Vary: Accept-Encoding')
+  for header_name, header_value in extra_headers:
+    lines.append('%s: %s' % (header_name, header_value))
+  close_connection = None
+  for header_name, header_value in headers.iteritems():
+    lines.append('%s: %s' % (header_name, header_value))
+    if header_name.lower() == 'connection':
+      # Like BaseHTTPRequestHandler.send_header.
+      if header_value.lower() == 'close':
+        close_connection = True
+      elif header_value.lower() == 'keep-alive':
+        close_connection = False
+  lines.extend(('', ''))
+  return str(prefix), str('\r\n'.join(lines)), close_connection
+
+
+def _serialized_head(response, content_length, content_encoding=None,
+    extra_headers=()):
+  """Returns the status line and headers of the given Exchange.Response as a
+  (prefix, suffix, close_connection) tuple, like _format_head.
+
+  The tuple is built once and kept by the response for as long as the content
+  length, content encoding and extra headers are unchanged.
+  """
+
+  key = (content_length, content_encoding, extra_headers)
+  serialized_head = response._serialized_head
+  if serialized_head is not None and serialized_head[0] == key:
+    return serialized_head[1:]
+
+  prefix, suffix, close_connection = _format_head(response._status_code,
+      response._content_type, content_length, content_encoding,
+      response._compress, response._headers, extra_headers)
+  response._serialized_head = (key, prefix, suffix, close_connection)
+  return prefix, suffix, close_connection
+
+
+def _file_headers(stat_result):
+  """Returns the headers that allow requesting ranges of a file with the given
+  result of os.stat, as a tuple of (name, value) pairs.
+  """
+
+  return (('Accept-Ranges', 'bytes'),
+          ('ETag', '"%x-%x"' % (stat_result.st_size,
+                                int(stat_result.st_mtime * 1000))),
+          ('Last-Modified',
+           email.utils.formatdate(stat_result.st_mtime, usegmt=True)))
+
+
+def _parse_ranges(range_header, file_size):
+  """Returns the ranges of a file with the given size that are requested by the
+  given value of a Range header, as a list of (offset, count) pairs.
+
+  Ranges that begin after the end of the file are omitted, so the list is empty
+  if no range can be satisfied. If the header is invalid or not in bytes, then
+  None is returned and the header must be ignored.
+  """
+
+  unit, _, range_specs = range_header.partition('=')
+  if unit.strip().lower() != 'bytes':
+    return None
+  ranges = []
+  num_range_specs = 0
+  for range_spec in range_specs.split(','):
+    range_spec = range_spec.strip()
+    if not range_spec:
+      continue
+    num_range_specs += 1
+    first, separator, last = (part.strip() for part in range_spec.partition('-'))
+    if not separator or not (first.isdigit() or (not first and last.isdigit())):
+      return None
+    if last and not last.isdigit():
+      return None
+    if first:
+      # The range is from the first byte position to the last, inclusive.
+      first = int(first)
+      if last and int(last) < first:
+        return None
+      if first >= file_size:
+        continue
+      last = min(int(last), file_size - 1) if last else file_size - 1
+    else:
+      # The range is a suffix of the file with the given length.
+      suffix_length = int(last)
+      if not suffix_length:
+        continue
+      first = max(file_size - suffix_length, 0)
+      last = file_size - 1
+    ranges.append((first, last - first + 1))
+  if not num_range_specs:
+    return None
+  return ranges
+
+
+class DirectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A request handler that uses the Director instance of the CannedServer it
+  belongs to to verify the script.
+
+  On the shared port of a CannedServerPool, the CannedServer is chosen by the
+  first request of the connection.
+  """
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    # The director and body cache are kept by the server, which is None until
+    # the connection is routed if the port is shared.
+    self._canned_server = getattr(self.server, 'canned_server', None)
+    self._path_prefix = None
+
+    # Allow persistent connections.
+    self.protocol_version = 'HTTP/1.1'
+    # The head and body of a response are sent together if possible, so do not
+    # delay sending the last segment of a response until the client sends an ACK.
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def parse_request(self):
+    start_time = time.time()
+    parsed = BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+    self._parse_headers_seconds = time.time() - start_time
+    return parsed
+
+  def handle_request(self):
+    # Any delay is measured from when the request was received.
+    received_time = time.time()
+    if self._cursor is None:
+      # Route the connection by its first request.
+      self._canned_server, self._path_prefix = (
+          self.server.canned_server_pool._route(
+              self.headers.get('Host', ''), self.path))
+      self._open_cursor()
+    # Get the HTTP method and URL of the request.
+    method = self.command
+    url = self.path
+    if self._path_prefix and url.startswith(self._path_prefix):
+      url = url[len(self._path_prefix):]
+      if not url.startswith('/'):
+        url = '/' + url
+    headers = self.headers
+    # Get the body of the request, which is read as it is verified.
+    content_length = self.headers.get('Content-Length', None)
+    transfer_encoding = self.headers.get('Transfer-Encoding', '')
+    if transfer_encoding.lower() == 'chunked':
+      body = _ChunkedBodyReader(self.rfile)
+    elif content_length and int(content_length):
+      body = _BodyReader(self.rfile, int(content_length))
+    else:
+      body = None
+
+    response = self._cursor.got_request(method, url, headers, body)
+    verified_time = time.time()
+    metrics = self._canned_server._metrics
+    if metrics:
+      connection_index, exchange_index = self._cursor._exchange_indexes
+      metrics.observe(Metrics.PARSE_HEADERS, connection_index, exchange_index,
+          self._parse_headers_seconds)
+      metrics.observe(Metrics.VERIFY_REQUEST, connection_index, exchange_index,
+          verified_time - received_time)
+
+    if response:
+      if response._delay:
+        # Only the thread serving this connection waits for the delay.
+        _sleep_until(received_time + response._delay)
+        self._canned_server._delay_drift.add(
+            response._delay, time.time() - received_time)
+      delayed_time = time.time()
+
+      # Get the body of the response.
+      body_file = None
+      file_size = None
+      content_encoding = None
+      file_headers = ()
+      ranges = None
+      if response._chunks:
+        # The chunks are sent after the headers.
+        body = None
+      else:
+        range_header = headers.get('Range', None)
+        if (range_header and response._body_filename and
+            response._status_code == 200):
+          ranges = self._requested_ranges(
+              response._body_filename, range_header, headers.get('If-Range'))
+        if ranges is None:
+          if response._compress:
+            content_encoding = _negotiate_encoding(
+                headers.get('Accept-Encoding', None))
+          body, body_file, file_size, content_encoding = self._load_body(
+              response, content_encoding)
+          if (response._body_filename and content_encoding is None and
+              response._status_code == 200):
+            file_headers = _file_headers(os.stat(response._body_filename))
+      loaded_time = time.time()
+
+      self._body_writer = self._throttled_writer(response)
+      fault = response._fault
+      if fault and fault[0] in Exchange.Response.FAULT_TYPES_AFTER_BYTES:
+        self._body_writer = _FaultWriter(self._body_writer or self.wfile, fault[1])
+      try:
+        if ranges is not None:
+          self._send_ranges(response, *ranges)
+        else:
+          self._send_response(response, body, body_file, file_size,
+              content_encoding, file_headers)
+      except _FaultInjected:
+        # The body was cut short.
+        pass
+      if fault and fault[0] in Exchange.Response.FAULT_TYPES_AFTER_BYTES:
+        self._break_connection(fault[0])
+
+      if metrics:
+        metrics.observe(Metrics.DELAY, connection_index, exchange_index,
+            delayed_time - verified_time)
+        metrics.observe(Metrics.LOAD_BODY, connection_index, exchange_index,
+            loaded_time - delayed_time)
+        metrics.observe(Metrics.WRITE_RESPONSE, connection_index, exchange_index,
+            time.time() - loaded_time)
+
+    self._canned_server._director_updated(self._director)
+
+  def _send_response(self, response, body, body_file, file_size,
+      content_encoding, file_headers):
+    """Sends the given response, whose body was loaded by _load_body."""
+
+    if (response._fault and
+        response._fault[0] == Exchange.Response.FAULT_CONTENT_LENGTH):
+      content_length = response._fault[1]
+    else:
+      content_length = file_size
+    # Send the head of the response, which was serialized when the response was
+    # first sent, with only the Date header added.
+    self.log_request(response._status_code)
+    prefix, suffix, close_connection = _serialized_head(
+        response, content_length, content_encoding, file_headers)
+    if close_connection is not None:
+      self.close_connection = close_connection
+    head = prefix + _http_date() + suffix
+    if (body is not None and file_size <= _COMBINE_BODY_BYTES and
+        not self._body_writer):
+      # Send the head and body in a single write.
+      self.wfile.write(head + body)
+    else:
+      self.wfile.write(head)
+      # Send the body to conclude the response.
+      if response._chunks:
+        self._send_chunks(response._chunks)
+      elif body_file:
+        try:
+          self._send_file(body_file, 0, file_size)
+        finally:
+          body_file.close()
+      else:
+        self._write_body(body)
+
+  def _break_connection(self, fault_type):
+    """Breaks the connection after the body of a response with the given type
+    of fault was cut short.
+    """
+
+    self.close_connection = True
+    self.wfile.flush()
+    if fault_type == Exchange.Response.FAULT_RESET:
+      # Closing the socket with a linger time of zero sends a RST instead of a
+      # FIN. The files of the socket refer to it, so they are closed first.
+      self.connection.setsockopt(
+          socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+      self.rfile.close()
+      self.wfile.close()
+      self.connection.close()
+    elif fault_type == Exchange.Response.FAULT_STALL:
+      # Ignore anything the client sends until it closes the connection.
+      try:
+        while self.connection.recv(_SEND_FILE_CHUNK_BYTES):
+          pass
+      except socket.error:
+        pass
+
+  def _load_body(self, response, content_encoding):
+    """Returns the body of the given response as a (body, body_file, file_size,
+    content_encoding) tuple.
+
+    If the given content encoding is not None, the body is compressed with it,
+    using a file with the extension of the encoding next to the file of the body
+    if it exists. If the body cannot be compressed, the returned content
+    encoding is None. If the body is too large to cache, then body is None and
+    body_file is the open file to send.
+    """
+
+    body_cache = self._canned_server._body_cache
+    filename = response._body_filename
+    if content_encoding is not None:
+      if filename:
+        compressed_filename = filename + _ENCODING_EXTENSIONS[content_encoding]
+        if os.path.exists(compressed_filename):
+          # The body was compressed ahead of time.
+          return self._load_file(compressed_filename) + (content_encoding,)
+      if response._rendered and not filename:
+        # A rendered body is unique to its request, so caching it would only
+        # evict the bodies of other responses.
+        compressed = _compress(content_encoding, response._body)
+      else:
+        compressed = body_cache.get_compressed(
+            content_encoding, response._body, filename)
+      if compressed is not None:
+        return compressed, None, len(compressed), content_encoding
+    if response._body is not None:
+      return response._body, None, len(response._body), None
+    return self._load_file(filename) + (None,)
+
+  def _load_file(self, filename):
+    """Returns the contents of the given file as a (body, body_file, file_size)
+    tuple, where body_file is the open file to send if it is too large to cache.
+    """
+
+    body = self._canned_server._body_cache.get(filename)
+    if body is None:
+      # The file is too large to cache, so send it without reading it.
+      body_file = open(filename, 'rb')
+      return None, body_file, os.fstat(body_file.fileno()).st_size
+    return body, None, len(body)
+
+  def _requested_ranges(self, filename, range_header, if_range):
+    """Returns the ranges of the given file requested by the given values of the
+    Range and If-Range headers, as a (body_file, file_size, file_headers,
+    ranges) tuple where ranges is a list of (offset, count) pairs.
+
+    If the entire file must be sent instead, because the Range header is invalid
+    or the If-Range header does not match the file, None is returned.
+    """
+
+    body_file = open(filename, 'rb')
+    stat_result = os.fstat(body_file.fileno())
+    file_headers = _file_headers(stat_result)
+    ranges = _parse_ranges(range_header, stat_result.st_size)
+    if ranges is not None and if_range is not None:
+      # Send the ranges only if the file is unchanged.
+      if if_range.strip() not in (file_headers[1][1], file_headers[2][1]):
+        ranges = None
+    if ranges is None:
+      body_file.close()
+      return None
+    return body_file, stat_result.st_size, file_headers, ranges
+
+  def _send_ranges(self, response, body_file, file_size, file_headers, ranges):
+    """Sends the given ranges of the given open file of the body of the given
+    response, as (offset, count) pairs, and then closes the file.
+
+    A single range is sent as the body of a 206 response, while multiple ranges
+    are sent as the parts of a multipart/byteranges body. If there are no
+    ranges, a 416 response is sent.
+    """
+
+    try:
+      parts = ()
+      if not ranges:
+        status_code = 416
+        content_type = response._content_type
+        content_length = 0
+        file_headers += (('Content-Range', 'bytes */%s' % file_size),)
+      elif len(ranges) == 1:
+        status_code = 206
+        content_type = response._content_type
+        offset, count = ranges[0]
+        content_length = count
+        file_headers += (('Content-Range', 'bytes %s-%s/%s' % (
+            offset, offset + count - 1, file_size)),)
+      else:
+        status_code = 206
+        boundary = os.urandom(12).encode('hex')
+        content_type = 'multipart/byteranges; boundary=%s' % boundary
+        parts = [('\r\n--%s\r\nContent-Type: %s\r\n'
+                  'Content-Range: bytes %s-%s/%s\r\n\r\n' % (
+                      boundary, response._content_type,
+                      offset, offset + count - 1, file_size), offset, count)
+                 for offset, count in ranges]
+        last_boundary = '\r\n--%s--\r\n' % boundary
+        content_length = len(last_boundary) + sum(
+            len(part_head) + count for part_head, offset, count in parts)
+
+      self.log_request(status_code)
+      prefix, suffix, close_connection = _format_head(status_code, content_type,
+          content_length, None, response._compress, response._headers,
+          file_headers)
+      if close_connection is not None:
+        self.close_connection = close_connection
+      self.wfile.write(prefix + _http_date() + suffix)
+      if not parts:
+        if ranges:
+          self._send_file(body_file, *ranges[0])
+      else:
+        for part_head, offset, count in parts:
+          self._write_body(part_head)
+          self._send_file(body_file, offset, count)
+        self._write_body(last_boundary)
+    finally:
+      body_file.close()
+
+  def _throttled_writer(self, response):
+    """Returns the _ThrottledWriter for the body of the given response, or None
+    if neither the response nor the server limits its bandwidth.
+    """
+
+    server_bucket = self._canned_server._bucket
+    if response._throttle is None and server_bucket is None:
+      return None
+    bandwidth, drip_bytes, drip_delay = response._throttle or (None, None, 0)
+    buckets = []
+    if bandwidth:
+      buckets.append(_TokenBucket(bandwidth))
+    if server_bucket:
+      buckets.append(server_bucket)
+    if drip_bytes:
+      slice_bytes = drip_bytes
+    else:
+      slice_bytes = min(bucket._capacity for bucket in buckets)
+    return _ThrottledWriter(self.wfile, buckets, slice_bytes, drip_delay)
+
+  def _write_body(self, data):
+    """Writes the given part of the body, throttling it if required."""
+
+    if self._body_writer:
+      self._body_writer.write(data)
+    else:
+      self.wfile.write(data)
+
+  def _send_chunks(self, chunks):
+    """Sends the given sequence of (body, delay) pairs as chunks of the body,
+    waiting for the delay of each chunk before sending it.
+    """
+
+    for chunk_body, chunk_delay in chunks:
+      if chunk_delay:
+        _sleep_until(time.time() + chunk_delay)
+      self._write_body('%x\r\n%s\r\n' % (len(chunk_body), chunk_body))
+    # Send the last chunk, which is empty.
+    self._write_body('0\r\n\r\n')
+
+  def _send_file(self, f, offset, count):
+    """Sends count bytes of the given file beginning at the given offset,
+    without copying the file into memory.
+    """
+
+    if self._body_writer:
+      # Read the file one slice at a time for the writer.
+      f.seek(offset)
+      while count > 0:
+        data = f.read(min(count, _SEND_FILE_CHUNK_BYTES))
+        if not data:
+          raise IOError('File %s was truncated while sending' % f.name)
+        self._body_writer.write(data)
+        count -= len(data)
+      return
+    self.wfile.flush()
+    if hasattr(os, 'sendfile'):
+      while count > 0:
+        sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, count)
+        if not sent:
+          raise IOError('File %s was truncated while sending' % f.name)
+        offset += sent
+        count -= sent
+    elif count > 0:
+      # Send slices of a memory map of the file, which are not copied.
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        end = offset + count
+        while offset < end:
+          chunk_size = min(_SEND_FILE_CHUNK_BYTES, end - offset)
+          self.connection.sendall(buffer(m, offset, chunk_size))
+          offset += chunk_size
+      finally:
+        m.close()
+
+  def do_HEAD(self):
+    self.handle_request()
+
+  def do_GET(self):
+    self.handle_request()
+
+  def do_POST(self):
+    self.handle_request()
+
+  def do_PUT(self):
+    self.handle_request()
+
+  def do_DELETE(self):
+    self.handle_request()
+
+  def _open_cursor(self):
+    # The connection follows the script of the server when it was opened, even
+    # if the script is replaced before it is closed.
+    self._director = self._canned_server._director
+    self._cursor = self._director.connection_opened()
+
+  def handle(self):
+    self._cursor = None
+    try:
+      if self._canned_server is not None:
+        self._open_cursor()
+      try:
+        BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+      except socket.error:
+        # A client that resets the connection has closed it, such as a client
+        # closing with unread body remaining after a content_length fault.
+        pass
+      if self._cursor is not None:
+        self._cursor.connection_closed()
+        self._canned_server._director_updated(self._director)
+    except (DirectorError, ScriptParseError) as e:
+      # Exceptions raised from handle_request will also be caught here. A
+      # ScriptParseError is raised when a LazyScript reaches an invalid
+      # connection.
+      if self._canned_server is not None:
+        self._canned_server._director_failed(self._director, e)
+      else:
+        self.server.canned_server_pool._routing_failed(e)
+
+class _ReusePortTCPServer(SocketServer.TCPServer):
+  """A TCPServer that shares its port with the servers of other processes, with
+  the kernel distributing connections among them.
+  """
+
+  def server_bind(self):
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    SocketServer.TCPServer.server_bind(self)
+
+
+class _ReusePortThreadingTCPServer(
+    SocketServer.ThreadingMixIn, _ReusePortTCPServer):
+  pass
+
+
+class CannedServer(object):
+  """A server that follows a script, which can be run within another program
+  such as a test suite.
+
+  The server binds its port when it is created, where a port of 0 binds an
+  unused port, and serves from a background thread once started. Its script can
+  be replaced or restarted between tests without binding the port again, and
+  the result of following the script is returned as a map instead of printed.
+  Any number of servers can run in one process.
+  """
+
+  def __init__(self, script, port=0, host='localhost', concurrent=False,
+      unordered=False, bind_by=ConcurrentDirector.BIND_BY_ORDER,
+      body_cache=None, metrics=None, reuse_port=False,
+      handler_class=DirectorRequestHandler, bandwidth=None, bucket=None):
+    """Creates a server for the given script.
+
+    The concurrent, unordered, bind_by and bandwidth arguments are like the
+    command line flags of the same names. If body_cache is None, a BodyCache
+    instance with the default limits is used. If metrics is not None, the time
+    spent serving each exchange is recorded. If port is None, no port is bound,
+    and the server instead follows the connections that a CannedServerPool
+    routes to it. If bucket is not None, it is a _TokenBucket shared with other
+    servers that limits the bodies of their responses together, instead of
+    bandwidth.
+    """
+
+    self._concurrent = concurrent or unordered
+    self._unordered = unordered
+    self._bind_by = bind_by
+    self._body_cache = body_cache or BodyCache()
+    self._metrics = metrics
+    self._lock = threading.Lock()
+    self._finished = threading.Event()
+    # Called whenever the script is finished or not followed.
+    self._finished_callback = None
+    # Limits the bandwidth of the bodies of all responses together.
+    if bucket is None and bandwidth:
+      bucket = _TokenBucket(bandwidth)
+    self._bucket = bucket
+    self._thread = None
+    self.set_script(script)
+
+    if port is None:
+      self._server = None
+      return
+    if self._concurrent:
+      if reuse_port:
+        server_class = _ReusePortThreadingTCPServer
+      else:
+        server_class = SocketServer.ThreadingTCPServer
+    else:
+      if reuse_port:
+        server_class = _ReusePortTCPServer
+      else:
+        server_class = SocketServer.TCPServer
+    self._server = server_class((host, port), handler_class)
+    self._server.canned_server = self
+    if self._concurrent:
+      self._server.daemon_threads = True
+      # Periodically stop waiting for connections to check if the script is done.
+      self._server.timeout = 0.1
+
+  @property
+  def port(self):
+    """The port that the server is bound to, or None."""
+    if self._server is None:
+      return None
+    return self._server.server_address[1]
+
+  def set_script(self, script):
+    """Replaces the script of the server, which begins with the next connection.
+
+    Connections that are open continue to follow the replaced script, but no
+    longer affect the result.
+    """
+
+    if self._unordered:
+      director = UnorderedDirector(script)
+    elif self._concurrent:
+      director = ConcurrentDirector(script, self._bind_by)
+    else:
+      director = Director(script)
+    with self._lock:
+      self._script = script
+      self._director = director
+      self._done = False
+      self._errors = []
+      self._delay_drift = DelayDrift()
+      self._finished.clear()
+
+  def reset(self):
+    """Begins the script of the server again, like set_script."""
+
+    if isinstance(self._script, LazyScript):
+      # Its connections were consumed by the previous director.
+      raise ValueError('A LazyScript cannot be reset')
+    self.set_script(self._script)
+
+  def _director_updated(self, director):
+    with self._lock:
+      if director is not self._director or not director.is_done():
+        return
+      self._done = True
+      self._finished.set()
+    if self._finished_callback:
+      self._finished_callback()
+
+  def _director_failed(self, director, e):
+    with self._lock:
+      if director is not self._director:
+        return
+      self._errors.append(e)
+      self._finished.set()
+    if self._finished_callback:
+      self._finished_callback()
+
+  def start(self):
+    """Serves from a background thread until stopped, and returns this server."""
+
+    if self._server is None:
+      return self
+    self._thread = threading.Thread(
+        target=self._server.serve_forever, args=(0.1,))
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def serve_until_finished(self):
+    """Serves from the calling thread until the script is finished or not
+    followed.
+    """
+
+    while not self._finished.is_set():
+      self._server.handle_request()
+
+  def wait(self, timeout=None):
+    """Waits until the script is finished or not followed, or until the given
+    number of seconds elapse, and returns the result.
+    """
+
+    self._finished.wait(timeout)
+    return self.result()
+
+  def stop(self):
+    """Stops serving and closes the port."""
+
+    if self._thread:
+      self._server.shutdown()
+      self._thread.join()
+      self._thread = None
+    if self._server is not None:
+      self._server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def result(self):
+    """Returns the result of following the current script as a map.
+
+    The map contains whether the script was finished, whether it was not
+    followed, the DirectorError or ScriptParseError instances raised if it was
+    not followed, the exchanges not performed if the server is unordered, the
+    DelayDrift of the delayed responses, and the recorded metrics if any.
+    """
+
+    with self._lock:
+      if self._unordered:
+        unconsumed = list(self._director.unconsumed())
+      else:
+        unconsumed = []
+      return {
+          'done': self._done,
+          'error': bool(self._errors),
+          'errors': list(self._errors),
+          'unconsumed': unconsumed,
+          'delay_drift': self._delay_drift,
+          'metrics': self._metrics.to_json_data() if self._metrics else None,
+      }
+
+
+class CannedServerPool(object):
+  """Serves the scripts of many CannedServer instances from one process, which
+  share one body cache.
+
+  Each script is served either on its own port, or on the shared port of the
+  pool. A connection to the shared port follows the first script whose Host
+  header and path prefix match the first request of the connection.
+  """
+
+  def __init__(self, port=0, host='localhost', body_cache=None, metrics=None,
+      handler_class=DirectorRequestHandler, bandwidth=None):
+    """Creates a pool whose shared port is the given port, where a port of 0
+    binds an unused port, and a port of None binds no shared port. If bandwidth
+    is not None, it limits the bodies of the responses of all scripts together.
+    """
+
+    self._host = host
+    self._bucket = _TokenBucket(bandwidth) if bandwidth else None
+    self._body_cache = body_cache or BodyCache()
+    self._metrics = metrics
+    self._handler_class = handler_class
+    self._servers = []
+    # Each route is a (host_header, path_prefix, server) tuple.
+    self._routes = []
+    # Guards the errors of routing, and is notified when a server finishes.
+    self._condition = threading.Condition()
+    self._errors = []
+    self._started = False
+    self._thread = None
+    if port is None:
+      self._server = None
+    else:
+      # The connections to every routed script are served in parallel.
+      self._server = SocketServer.ThreadingTCPServer((host, port), handler_class)
+      self._server.daemon_threads = True
+      self._server.canned_server_pool = self
+
+  @property
+  def port(self):
+    """The shared port of the pool, or None."""
+    if self._server is None:
+      return None
+    return self._server.server_address[1]
+
+  def add(self, script, port=None, host_header=None, path_prefix=None,
+      concurrent=False, unordered=False,
+      bind_by=ConcurrentDirector.BIND_BY_ORDER, name=None):
+    """Adds a CannedServer for the given script to the pool and returns it.
+
+    If port is not None, the script is served on that port, where 0 binds an
+    unused port. Otherwise it is served on the shared port, to connections
+    whose first request has the given Host header, ignoring its port, and a
+    path beginning with the given prefix, where either can be None to match any
+    request. The prefix is removed from the URL of each request before it is
+    verified. Scripts on the shared port are always served concurrently.
+
+    The metrics of the script are labeled by the given name, or else by the
+    number of the script in the pool, starting from 1.
+    """
+
+    if port is None:
+      if self._server is None:
+        raise ValueError('The pool has no shared port')
+      concurrent = True
+    elif host_header is not None or path_prefix is not None:
+      raise ValueError('A script on its own port cannot be routed by Host '
+                       'header or path prefix')
+    metrics = None
+    if self._metrics:
+      if name is None:
+        name = str(len(self._servers) + 1)
+      metrics = self._metrics.for_script(name)
+    server = CannedServer(script, port, self._host, concurrent, unordered,
+        bind_by, self._body_cache, metrics, handler_class=self._handler_class,
+        bucket=self._bucket)
+    server._finished_callback = self._server_finished
+    self._servers.append(server)
+    if port is None:
+      if host_header is not None:
+        host_header = host_header.lower()
+      if path_prefix is not None:
+        path_prefix = path_prefix.rstrip('/')
+      self._routes.append((host_header, path_prefix, server))
+    if self._started:
+      server.start()
+    return server
+
+  def _route(self, host_header, path):
+    """Returns the (server, path_prefix) pair for a connection whose first
+    request has the given Host header and path, or raises a DirectorError.
+    """
+
+    host_header = host_header.lower()
+    host_name = host_header
+    if ':' in host_header and not host_header.endswith(']'):
+      # Remove the port, but not from an IPv6 address in brackets.
+      host_name = host_header.rsplit(':', 1)[0]
+    for route_host_header, path_prefix, server in self._routes:
+      if (route_host_header is not None and
+          route_host_header not in (host_header, host_name)):
+        continue
+      if path_prefix and not (path == path_prefix or
+          path.startswith(path_prefix + '/') or
+          path.startswith(path_prefix + '?')):
+        continue
+      return server, path_prefix
+    raise DirectorError('No script for Host header %r and path %r' % (
+        host_header, path))
+
+  def _routing_failed(self, e):
+    with self._condition:
+      self._errors.append(e)
+      self._condition.notify_all()
+
+  def _server_finished(self):
+    with self._condition:
+      self._condition.notify_all()
+
+  def _is_finished(self):
+    if self._errors:
+      return True
+    all_done = True
+    for server in self._servers:
+      if server._errors:
+        return True
+      all_done = all_done and server._done
+    return all_done
+
+  def start(self):
+    """Serves every script from background threads until stopped, and returns
+    this pool.
+    """
+
+    self._started = True
+    if self._server is not None:
+      self._thread = threading.Thread(
+          target=self._server.serve_forever, args=(0.1,))
+      self._thread.daemon = True
+      self._thread.start()
+    for server in self._servers:
+      server.start()
+    return self
+
+  def wait(self, timeout=None):
+    """Waits until every script is finished or any script is not followed, or
+    until the given number of seconds elapse, and returns the result.
+    """
+
+    if timeout is not None:
+      deadline = time.time() + timeout
+    with self._condition:
+      while not self._is_finished():
+        if timeout is None:
+          # A timeout allows a KeyboardInterrupt while waiting.
+          self._condition.wait(0.1)
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self._condition.wait(remaining)
+    return self.result()
+
+  def stop(self):
+    """Stops serving and closes every port."""
+
+    self._started = False
+    if self._thread:
+      self._server.shutdown()
+      self._thread.join()
+      self._thread = None
+    if self._server is not None:
+      self._server.server_close()
+    for server in self._servers:
+      server.stop()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def result(self):
+    """Returns the result of following every script as a map.
+
+    The map contains whether every script was finished, whether any script was
+    not followed, the DirectorError instances raised for connections that
+    matched no route, and the result of each server in the order they were
+    added.
+    """
+
+    results = [server.result() for server in self._servers]
+    with self._condition:
+      errors = list(self._errors)
+    return {
+        'done': all(result['done'] for result in results),
+        'error': bool(errors) or any(result['error'] for result in results),
+        'errors': errors,
+        'results': results,
+    }
+
+
+# Headers that apply to a single connection, which a proxy does not forward.
+_HOP_BY_HOP_HEADERS = frozenset(('connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade'))
+# Response headers that are not recorded, because they are written by the
+# server that replays the response.
+_UNRECORDED_RESPONSE_HEADERS = _HOP_BY_HOP_HEADERS | frozenset(
+    ('content-length', 'content-type', 'date', 'server'))
+
+def _header_items(message):
+  """Returns the headers of the given mimetools.Message as (name, value) pairs,
+  keeping the case of each name.
+  """
+
+  items = []
+  for line in message.headers:
+    if line[:1] in (' ', '\t') and items:
+      # The line continues the value of the previous header.
+      header_name, header_value = items[-1]
+      items[-1] = (header_name, '%s %s' % (header_value, line.strip()))
+    elif ':' in line:
+      header_name, header_value = line.split(':', 1)
+      items.append((header_name.strip(), header_value.strip()))
+  return items
+
+
+class _RecordedBody(object):
+  """The body of a recorded request or response, which is kept in the script
+  unless it is larger than the maximum size or is not UTF-8 text. Otherwise it
+  is written to a file by the writer thread of the RecordingProxy as it is
+  received.
+  """
+
+  def __init__(self, proxy, filename):
+    self._proxy = proxy
+    self._filename = filename
+    self._parts = []
+    self._num_bytes = 0
+    self._in_file = False
+
+  def add(self, data):
+    if self._in_file:
+      self._proxy._queue.put(('body', self._filename, data))
+      return
+    self._parts.append(data)
+    self._num_bytes += len(data)
+    if self._num_bytes > self._proxy._max_body_bytes:
+      self._write_parts()
+
+  def _write_parts(self):
+    self._proxy._queue.put(('body', self._filename, ''.join(self._parts)))
+    self._parts = None
+    self._in_file = True
+
+  def data(self):
+    """Returns a map with either the body key or the body_filename key of the
+    body in a script, and finishes the body.
+    """
+
+    if not self._in_file:
+      body = ''.join(self._parts)
+      try:
+        return {'body': body.decode('utf-8')}
+      except UnicodeDecodeError:
+        self._write_parts()
+    # The file is closed before the exchange naming it is recorded.
+    self._proxy._queue.put(('body', self._filename, None))
+    return {'body_filename': os.path.relpath(
+        self._filename, os.path.dirname(self._proxy._script_filename))}
+
+
+class RecordingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A request handler that forwards each request to the upstream server of
+  the RecordingProxy it belongs to, and records the exchange.
+  """
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    # Allow persistent connections, whose exchanges are recorded together.
+    self.protocol_version = 'HTTP/1.1'
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._proxy = self.server.recording_proxy
+
+  def handle(self):
+    self._connection_index = self._proxy._connection_opened()
+    self._exchange_index = 0
+    self._upstream = httplib.HTTPConnection(*self._proxy._upstream)
+    try:
+      BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+    finally:
+      self._upstream.close()
+      self._proxy._queue.put(('connection_closed', self._connection_index))
+
+  def _recorded_body(self, part):
+    filename = os.path.join(self._proxy._body_dir, 'connection%s_exchange%s_%s' % (
+        self._connection_index, self._exchange_index, part))
+    return _RecordedBody(self._proxy, filename)
+
+  def handle_request(self):
+    self._exchange_index += 1
+    # Read the entire body of the request, which is forwarded with a
+    # Content-Length header.
+    content_length = self.headers.get('Content-Length', None)
+    transfer_encoding = self.headers.get('Transfer-Encoding', '')
+    if transfer_encoding.lower() == 'chunked':
+      body = _ChunkedBodyReader(self.rfile).read()
+    elif content_length and int(content_length):
+      body = _BodyReader(self.rfile, int(content_length)).read()
+    else:
+      body = None
+    request_headers = dict((header_name, header_value)
+        for header_name, header_value in _header_items(self.headers)
+        if header_name.lower() not in _HOP_BY_HOP_HEADERS and
+            header_name.lower() != 'content-length')
+
+    try:
+      self._upstream.request(self.command, self.path, body, request_headers)
+      upstream_response = self._upstream.getresponse()
+    except (socket.error, httplib.HTTPException) as e:
+      self._upstream.close()
+      self.send_error(502, 'Could not reach upstream server: %s' % e)
+      return
+
+    # Send the head of the response, with a Content-Length header if the
+    # upstream server sent one, and otherwise with chunked transfer encoding.
+    status_code = upstream_response.status
+    content_type = upstream_response.getheader(
+        'Content-Type', 'application/octet-stream')
+    response_headers = dict((header_name, header_value)
+        for header_name, header_value in _header_items(upstream_response.msg)
+        if header_name.lower() not in _UNRECORDED_RESPONSE_HEADERS)
+    has_body = (self.command != 'HEAD' and status_code >= 200 and
+                status_code not in (204, 304))
+    length_header = upstream_response.getheader('Content-Length', None)
+    if length_header is not None:
+      response_length = int(length_header)
+    elif has_body:
+      response_length = None
+    else:
+      response_length = 0
+    prefix, suffix, _ = _format_head(status_code, content_type,
+        response_length, None, False, response_headers)
+    self.log_request(status_code)
+    self.wfile.write(prefix + _http_date() + suffix)
+
+    # Send the body as it is received, and record it.
+    response_body = self._recorded_body('response')
+    if has_body:
+      while True:
+        data = upstream_response.read(_SEND_FILE_CHUNK_BYTES)
+        if not data:
+          break
+        if response_length is None:
+          self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        else:
+          self.wfile.write(data)
+        response_body.add(data)
+      if response_length is None:
+        self.wfile.write('0\r\n\r\n')
+    else:
+      upstream_response.read()
+
+    request_data = {'method': self.command, 'url': self.path}
+    if body:
+      request_body = self._recorded_body('request')
+      request_body.add(body)
+      request_data.update(request_body.data())
+    response_data = {'status_code': status_code, 'content_type': content_type}
+    if response_headers:
+      response_data['headers'] = response_headers
+    response_data.update(response_body.data())
+    self._proxy._queue.put(('exchange', self._connection_index,
+        {'request': request_data, 'response': response_data}))
+
+  def do_HEAD(self):
+    self.handle_request()
+
+  def do_GET(self):
+    self.handle_request()
+
+  def do_POST(self):
+    self.handle_request()
+
+  def do_PUT(self):
+    self.handle_request()
+
+  def do_DELETE(self):
+    self.handle_request()
+
+
+class RecordingProxy(object):
+  """A proxy that forwards each request to an upstream server, and records the
+  exchanges as a script.
+
+  Each connection to the proxy is recorded as a connection of the script, whose
+  format is chosen by the extension of its filename of .json, .yaml, .jsonl, or
+  .compiled. Bodies larger than max_body_bytes, or that are not UTF-8 text, are
+  written to files in a directory next to the script. The script and the bodies
+  are written by a background thread, so that recording delays the proxied
+  responses as little as possible.
+  """
+
+  DEFAULT_MAX_BODY_BYTES = 64 * 1024
+
+  def __init__(self, upstream_host, upstream_port, script_filename, port=0,
+      host='localhost', max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+      handler_class=RecordingRequestHandler):
+    extension = os.path.splitext(script_filename)[1].lower()
+    if extension == '.yml':
+      extension = '.yaml'
+    if extension not in ('.json', '.yaml', '.jsonl', '.compiled'):
+      raise ValueError('Unknown format of script %s' % script_filename)
+    self._format = extension
+    self._upstream = (upstream_host, upstream_port)
+    self._script_filename = os.path.abspath(script_filename)
+    self._body_dir = os.path.splitext(self._script_filename)[0] + '_bodies'
+    self._max_body_bytes = max_body_bytes
+    self._lock = threading.Lock()
+    self._num_connections = 0
+    # Holds the messages for the writer thread, or None once stopped.
+    self._queue = Queue.Queue()
+    self._writer_thread = threading.Thread(target=self._write)
+    self._writer_thread.daemon = True
+    self._writer_thread.start()
+    self._thread = None
+    self._server = SocketServer.ThreadingTCPServer((host, port), handler_class)
+    self._server.daemon_threads = True
+    self._server.recording_proxy = self
+
+  @property
+  def port(self):
+    """The port that the proxy is bound to."""
+    return self._server.server_address[1]
+
+  def _connection_opened(self):
+    """Returns the index of a new connection to the proxy."""
+
+    with self._lock:
+      self._num_connections += 1
+      return self._num_connections
+
+  def start(self):
+    """Proxies from a background thread until stopped, and returns this proxy."""
+
+    self._thread = threading.Thread(
+        target=self._server.serve_forever, args=(0.1,))
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self):
+    """Stops proxying, and returns once the script is written.
+
+    Exchanges that are still being proxied are not recorded.
+    """
+
+    if self._thread:
+      self._server.shutdown()
+      self._thread.join()
+      self._thread = None
+    self._server.server_close()
+    if self._writer_thread:
+      self._queue.put(None)
+      self._writer_thread.join()
+      self._writer_thread = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def _write(self):
+    """Writes the recorded bodies and exchanges until stopped, and then writes
+    the script.
+    """
+
+    body_files = {}
+    # Maps the index of each connection to the data of its exchanges.
+    connections = {}
+    if self._format == '.jsonl':
+      # Each connection is written as soon as it is closed.
+      jsonl_file = open(self._script_filename, 'w')
+    else:
+      jsonl_file = None
+    while True:
+      message = self._queue.get()
+      if message is None:
+        break
+      elif message[0] == 'body':
+        _, filename, data = message
+        f = body_files.get(filename, None)
+        if f is None:
+          if not os.path.isdir(self._body_dir):
+            os.makedirs(self._body_dir)
+          f = body_files[filename] = open(filename, 'wb')
+        if data is None:
+          f.close()
+          del body_files[filename]
+        else:
+          f.write(data)
+      elif message[0] == 'exchange':
+        _, connection_index, exchange_data = message
+        connections.setdefault(connection_index, []).append(exchange_data)
+      elif message[0] == 'connection_closed':
+        connection_index = message[1]
+        if jsonl_file and connection_index in connections:
+          jsonl_file.write('%s\n' % json.dumps(connections.pop(connection_index)))
+
+    for f in body_files.itervalues():
+      f.close()
+    script_data = [connections[connection_index]
+                   for connection_index in sorted(connections)]
+    if jsonl_file:
+      for connection_data in script_data:
+        jsonl_file.write('%s\n' % json.dumps(connection_data))
+      jsonl_file.close()
+    elif self._format == '.compiled':
+      compile_script(script_from_data(script_data,
+          os.path.dirname(self._script_filename)), self._script_filename)
+    else:
+      f = open(self._script_filename, 'w')
+      if self._format == '.json':
+        json.dump(script_data, f, indent=2)
+      else:
+        # The PyYAML library, see http://pyyaml.org/
+        import yaml
+        yaml.safe_dump(script_data, f, default_flow_style=False)
+      f.close()
+
+
+def _record(parsed_args):
+  """Records the exchanges proxied to the upstream server until interrupted."""
+
+  upstream_host, _, upstream_port = parsed_args.upstream.partition(':')
+  proxy = RecordingProxy(upstream_host, int(upstream_port or 80),
+      parsed_args.record_to, parsed_args.port, '',
+      parsed_args.record_max_body_bytes)
+  print >> sys.stderr, 'Recording to %s, press Ctrl-C to stop.' % (
+      parsed_args.record_to)
+  proxy.start()
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+  proxy.stop()
+  print >> sys.stderr, 'Recorded %s connections.' % proxy._num_connections
+
+
+def _partition_script(script, worker_index, num_workers):
+  """Returns the Script containing every num_workers-th connection of the given
+  script, beginning with the connection at index worker_index.
+  """
+
+  connections = itertools.islice(
+      script._connections, worker_index, None, num_workers)
+  if isinstance(script, LazyScript):
+    return LazyScript(connections, script._stubs)
+  return Script(connections, script._stubs)
+
+
+def _metrics_for_args(parsed_args):
+  """Returns the Metrics instance to record if the given command line arguments
+  require one, or None, and begins serving it if --metrics_port is set.
+  """
+
+  if not parsed_args.metrics_port and not parsed_args.metrics_json_filename:
+    return None
+  metrics = Metrics()
+  if parsed_args.metrics_port:
+    MetricsRequestHandler.set_metrics(metrics)
+    metrics_server = SocketServer.ThreadingTCPServer(
+        ("", parsed_args.metrics_port), MetricsRequestHandler)
+    metrics_server.daemon_threads = True
+    metrics_thread = threading.Thread(target=metrics_server.serve_forever)
+    metrics_thread.daemon = True
+    metrics_thread.start()
+  return metrics
+
+
+def _print_result(result):
+  """Prints the errors, unconsumed exchanges and delay drift in the given result
+  of a CannedServer.
+  """
+
+  for error in result['errors']:
+    print >> sys.stderr, 'ERROR: ', repr(error)
+  for connection_index, exchange_index, exchange in result['unconsumed']:
+    print >> sys.stderr, 'UNCONSUMED: connection %s, exchange %s: %s' % (
+        connection_index, exchange_index, repr(exchange))
+  if result['delay_drift']._count:
+    print >> sys.stderr, 'Delays: ', repr(result['delay_drift'])
+
+
+def _serve_script(script, parsed_args, body_cache, reuse_port=False):
+  """Serves the given script until it is finished or not followed.
+
+  Returns a map with whether the script was finished, whether it was not
+  followed, and the recorded metrics if any.
+  """
+
+  metrics = _metrics_for_args(parsed_args)
+  server = CannedServer(script, parsed_args.port, '', parsed_args.concurrent,
+      parsed_args.unordered, parsed_args.bind_by, body_cache, metrics, reuse_port,
+      bandwidth=parsed_args.bandwidth)
+  # Serve on the specified port until the script is finished or not followed.
+  try:
+    server.serve_until_finished()
+  except KeyboardInterrupt:
+    # A script with a stub that has no count runs until it is interrupted.
+    pass
+  server.stop()
+  result = server.result()
+  _print_result(result)
+  return {
+      'done': result['done'],
+      'error': result['error'],
+      'metrics': result['metrics'],
+  }
+
+
+def _script_from_filename(filename):
+  """Returns the Script in the given file, in the format of its extension."""
+
+  extension = os.path.splitext(filename)[1].lower()
+  if extension == '.json':
+    return script_from_json_file(filename)
+  elif extension in ('.yaml', '.yml'):
+    return script_from_yaml_file(filename)
+  elif extension == '.jsonl':
+    return script_from_jsonl_file(filename)
+  elif extension == '.compiled':
+    return script_from_compiled_file(filename)
+  raise ScriptParseError('Unknown format of script %s' % filename)
+
+
+def _pool_entries_from_data(pool_data, base_dir):
+  """Returns the scripts of a pool file parsed as Python objects, as a list of
+  (script, port, host_header, path_prefix, concurrent, unordered, bind_by)
+  tuples of the arguments to CannedServerPool.add.
+  """
+
+  if not isinstance(pool_data, list):
+    raise ScriptParseError('Pool must be an array of scripts')
+  entries = []
+  for i, entry_data in enumerate(pool_data, 1):
+    if not isinstance(entry_data, dict) or 'script' not in entry_data:
+      raise ScriptParseError(
+          'Script %s of pool must be a map with a script filename' % i)
+    port = entry_data.get('port', None)
+    host_header = entry_data.get('host', None)
+    path_prefix = entry_data.get('path_prefix', None)
+    if port is not None and (host_header is not None or path_prefix is not None):
+      raise ScriptParseError('Script %s of pool cannot have both a port and a '
+                             'host or path_prefix' % i)
+    bind_by = entry_data.get('bind_by', ConcurrentDirector.BIND_BY_ORDER)
+    if bind_by not in (ConcurrentDirector.BIND_BY_ORDER,
+                       ConcurrentDirector.BIND_BY_REQUEST):
+      raise ScriptParseError('Invalid bind_by for script %s of pool' % i)
+    script = _script_from_filename(
+        os.path.join(base_dir, entry_data['script']))
+    entries.append((script, port, host_header, path_prefix,
+        bool(entry_data.get('concurrent', False)),
+        bool(entry_data.get('unordered', False)), bind_by))
+  return entries
+
+
+def _serve_pool(parsed_args, body_cache):
+  """Serves the scripts of the given pool file from one process until every
+  script is finished or any script is not followed.
+
+  Returns a map with whether every script was finished, whether any script was
+  not followed, and the recorded metrics if any.
+  """
+
+  pool_filename = parsed_args.pool_filename
+  f = open(pool_filename, 'r')
+  pool_string = f.read()
+  f.close()
+  if pool_filename.lower().endswith('.json'):
+    pool_data = json.loads(pool_string)
+  else:
+    # The PyYAML library, see http://pyyaml.org/
+    import yaml
+    pool_data = yaml.safe_load(pool_string)
+  entries = _pool_entries_from_data(
+      pool_data, _dirname_for_filename(pool_filename))
+
+  metrics = _metrics_for_args(parsed_args)
+  # Only bind the shared port if a script is routed on it.
+  if any(entry[1] is None for entry in entries):
+    shared_port = parsed_args.port
+  else:
+    shared_port = None
+  pool = CannedServerPool(shared_port, '', body_cache, metrics,
+      bandwidth=parsed_args.bandwidth)
+  for entry in entries:
+    if not isinstance(entry[0], LazyScript):
+      body_cache.preload(entry[0])
+    pool.add(*entry)
+  pool.start()
+  try:
+    pool.wait()
+  except KeyboardInterrupt:
+    pass
+  pool.stop()
+  result = pool.result()
+  for error in result['errors']:
+    print >> sys.stderr, 'ERROR: ', repr(error)
+  for i, server_result in enumerate(result['results'], 1):
+    _print_result(server_result)
+    if server_result['error']:
+      status = 'failed'
+    elif server_result['done']:
+      status = 'passed'
+    else:
+      status = 'did not finish'
+    print >> sys.stderr, 'Script %s: %s' % (i, status)
+  return {
+      'done': result['done'],
+      'error': result['error'],
+      'metrics': metrics.to_json_data() if metrics else None,
+  }
+
+
+def _serve_script_with_workers(script, parsed_args, body_cache):
+  """Forks the given number of worker processes that share the port, and
+  serves the script from them.
+
+  Returns a map with whether every worker finished its script, whether any
+  worker's script was not followed, and the metrics recorded by all workers.
+  """
+
+  num_workers = parsed_args.workers
+  workers = []
+  for worker_index in xrange(num_workers):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      # This is the worker process.
+      os.close(read_fd)
+      if parsed_args.worker_mode == 'partitioned':
+        script = _partition_script(script, worker_index, num_workers)
+      result = _serve_script(script, parsed_args, body_cache, reuse_port=True)
+      f = os.fdopen(write_fd, 'w')
+      json.dump(result, f)
+      f.close()
+      os._exit(0)
+    os.close(write_fd)
+    workers.append((pid, read_fd))
+
+  # Collect the result of each worker.
+  all_done = True
+  any_error = False
+  all_metrics = []
+  for worker_index, (pid, read_fd) in enumerate(workers, 1):
+    f = os.fdopen(read_fd, 'r')
+    result_json = f.read()
+    f.close()
+    os.waitpid(pid, 0)
+    if result_json:
+      result = json.loads(result_json)
+    else:
+      # The worker exited without reporting a result.
+      result = {'done': False, 'error': True, 'metrics': None}
+    if result['error']:
+      status = 'failed'
+    elif result['done']:
+      status = 'passed'
+    else:
+      status = 'did not finish'
+    print >> sys.stderr, 'Worker %s: %s' % (worker_index, status)
+    all_done = all_done and result['done']
+    any_error = any_error or result['error']
+    for histogram in result['metrics'] or ():
+      histogram['worker'] = worker_index
+      all_metrics.append(histogram)
+  return {'done': all_done, 'error': any_error, 'metrics': all_metrics}
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--port', type=int, required=False, default=8080,
+      help='Port the web server should run on')
+  arg_parser.add_argument('--json_filename', type=str, required=False, default='',
+      help='JSON input file for expected requests and replies')
+  arg_parser.add_argument('--yaml_filename', type=str, required=False, default='',
+      help='YAML input file for expected requests and replies')
+  arg_parser.add_argument('--jsonl_filename', type=str, required=False, default='',
+      help='JSON Lines input file for expected requests and replies, which is '
+           'read as the script is run')
+  arg_parser.add_argument('--compiled_filename', type=str, required=False,
+      default='',
+      help='Compiled input file for expected requests and replies')
+  arg_parser.add_argument('--pool_filename', type=str, required=False,
+      default='',
+      help='JSON or YAML file listing scripts to serve from one process, each on '
+           'its own port or routed by Host header or path prefix on --port')
+  arg_parser.add_argument('--record_to', type=str, required=False, default='',
+      help='Instead of serving a script, proxy requests to --upstream and record '
+           'them to this JSON, YAML, JSON Lines or compiled script file')
+  arg_parser.add_argument('--upstream', type=str, required=False, default='',
+      help='With --record_to, the host:port of the server to proxy requests to')
+  arg_parser.add_argument('--record_max_body_bytes', type=int, required=False,
+      default=RecordingProxy.DEFAULT_MAX_BODY_BYTES,
+      help='With --record_to, bodies larger than this are recorded to files')
+  arg_parser.add_argument('--compile_to', type=str, required=False, default='',
+      help='Compile the script to the given file and exit instead of serving')
+  arg_parser.add_argument('--concurrent', action='store_true', default=False,
+      help='Allow the connections of the script to be performed in parallel')
+  arg_parser.add_argument('--unordered', action='store_true', default=False,
+      help='Allow the exchanges of the script to be performed in any order and '
+           'over any connections')
+  arg_parser.add_argument('--bind_by', type=str, required=False,
+      choices=(ConcurrentDirector.BIND_BY_ORDER, ConcurrentDirector.BIND_BY_REQUEST),
+      default=ConcurrentDirector.BIND_BY_ORDER,
+      help='With --concurrent, whether connections are bound to the script by '
+           'the order they are opened or by their first request')
+  arg_parser.add_argument('--metrics_port', type=int, required=False, default=0,
+      help='If set, serve the time spent in each phase of each exchange on this '
+           'port at /metrics in the Prometheus text format')
+  arg_parser.add_argument('--metrics_json_filename', type=str, required=False,
+      default='',
+      help='If set, write the time spent in each phase of each exchange to this '
+           'file as JSON when the server finishes')
+  arg_parser.add_argument('--body_cache_bytes', type=int, required=False,
+      default=BodyCache.DEFAULT_MAX_BYTES,
+      help='Maximum number of bytes of response body files to cache')
+  arg_parser.add_argument('--body_cache_max_file_bytes', type=int, required=False,
+      default=BodyCache.DEFAULT_MAX_FILE_BYTES,
+      help='Response body files larger than this are read each time they are sent')
+  arg_parser.add_argument('--bandwidth', type=float, required=False, default=0,
+      help='If set, the maximum number of bytes per second of the bodies of all '
+           'responses together')
+  arg_parser.add_argument('--workers', type=int, required=False, default=1,
+      help='Number of worker processes that share the port')
+  arg_parser.add_argument('--worker_mode', type=str, required=False,
+      choices=('replicated', 'partitioned'), default='replicated',
+      help='With --workers, whether each worker serves the entire script, or '
+           'every Nth connection of the script')
+  parsed_args = arg_parser.parse_args()
+
+  if parsed_args.record_to:
+    if not parsed_args.upstream:
+      print >> sys.stderr, 'Must specify --upstream with --record_to.'
+      sys.exit(0)
+    _record(parsed_args)
+    sys.exit(0)
+
+  # Create the script from the provided filename.
+  script_filenames = [filename for filename in (parsed_args.json_filename,
+      parsed_args.yaml_filename, parsed_args.jsonl_filename,
+      parsed_args.compiled_filename, parsed_args.pool_filename) if filename]
+  if len(script_filenames) > 1:
+    print >> sys.stderr, ('Cannot specify more than one of --json_filename, '
+        '--yaml_filename, --jsonl_filename, --compiled_filename, and '
+        '--pool_filename.')
+    sys.exit(0)
+  elif parsed_args.json_filename:
+    script = script_from_json_file(parsed_args.json_filename)
+  elif parsed_args.yaml_filename:
+    script = script_from_yaml_file(parsed_args.yaml_filename)
+  elif parsed_args.jsonl_filename:
+    script = script_from_jsonl_file(parsed_args.jsonl_filename)
+  elif parsed_args.compiled_filename:
+    script = script_from_compiled_file(parsed_args.compiled_filename)
+  elif parsed_args.pool_filename:
+    # Each script of the pool is read when the pool is served.
+    script = None
+  else:
+    print >> sys.stderr, ('Must specify one of --json_filename, --yaml_filename, '
+        '--jsonl_filename, --compiled_filename, or --pool_filename.')
+    sys.exit(0)
+
+  if parsed_args.pool_filename and (parsed_args.compile_to or
+                                    parsed_args.workers > 1):
+    print >> sys.stderr, ('Cannot specify --compile_to or --workers with '
+        '--pool_filename.')
+    sys.exit(0)
+  if parsed_args.compile_to:
+    compile_script(script, parsed_args.compile_to)
+    sys.exit(0)
+  if parsed_args.workers > 1 and parsed_args.metrics_port:
+    print >> sys.stderr, ('Cannot specify --metrics_port with --workers, '
+        'specify --metrics_json_filename instead.')
+    sys.exit(0)
+
+  body_cache = BodyCache(
+      parsed_args.body_cache_bytes, parsed_args.body_cache_max_file_bytes)
+  if script is not None and not isinstance(script, LazyScript):
+    # Iterating over the connections of a LazyScript would consume them.
+    body_cache.preload(script)
+  if parsed_args.pool_filename:
+    # The scripts of the pool share the body cache.
+    result = _serve_pool(parsed_args, body_cache)
+  elif parsed_args.workers > 1:
+    # The workers share the preloaded body cache until they modify it.
+    result = _serve_script_with_workers(script, parsed_args, body_cache)
+  else:
+    result = _serve_script(script, parsed_args, body_cache)
+  if parsed_args.metrics_json_filename:
+    f = open(parsed_args.metrics_json_filename, 'w')
+    json.dump(result['metrics'], f, indent=2)
+    f.close()
 
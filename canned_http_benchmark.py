@@ -0,0 +1,334 @@
+"""Benchmarks for canned_http.
+
+The request benchmarks run canned_http.py as a separate process serving a
+generated script, and send it requests from a number of client threads. For
+each benchmark, the number of requests per second and the 50th and 99th
+percentile latencies are reported. The parse benchmarks report the time to
+parse scripts of different sizes, and the memory benchmark reports the memory
+used by each exchange of a parsed script.
+
+Each benchmark builds its own script, so no input files are needed. Results can
+be written to a JSON file, so that the results of two versions can be compared
+before a release.
+
+Author: Michael Parker (michael.g.parker@gmail.com)
+"""
+
+import argparse
+import gc
+import httplib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import canned_http
+
+
+_CANNED_HTTP_FILENAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'canned_http.py')
+
+
+def _exchanges_data(num_exchanges, exchanges_per_connection=10):
+  """Returns the Python objects for a script with the given number of exchanges,
+  in the form accepted by canned_http.script_from_data.
+  """
+
+  script_data = []
+  connection_data = []
+  for i in xrange(num_exchanges):
+    connection_data.append({
+        'request': {
+            'method': 'GET',
+            'url': '/page%s.html' % i,
+            'headers': {'Accept': 'text/html'}},
+        'response': {
+            'status_code': 200,
+            'content_type': 'text/html; charset=utf-8',
+            'body': '<html><body>Page %s</body></html>' % i}})
+    if len(connection_data) == exchanges_per_connection:
+      script_data.append(connection_data)
+      connection_data = []
+  if connection_data:
+    script_data.append(connection_data)
+  return script_data
+
+
+def _rss_bytes():
+  """Returns the resident set size of this process in bytes."""
+
+  f = open('/proc/self/statm')
+  resident_pages = int(f.read().split()[1])
+  f.close()
+  return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def benchmark_memory(num_exchanges):
+  """Returns the number of bytes used by each exchange of a parsed script."""
+
+  script_data = _exchanges_data(num_exchanges)
+  gc.collect()
+  rss_before = _rss_bytes()
+  script = canned_http.script_from_data(script_data)
+  gc.collect()
+  rss_after = _rss_bytes()
+  # Keep the script alive until after measuring.
+  del script
+  return float(rss_after - rss_before) / num_exchanges
+
+
+def benchmark_parse(num_exchanges):
+  """Returns the number of seconds to parse a JSON script with the given number
+  of exchanges.
+  """
+
+  json_string = json.dumps(_exchanges_data(num_exchanges))
+  start_time = time.time()
+  canned_http.script_from_json_string(json_string)
+  return time.time() - start_time
+
+
+class _Request:
+  """A request sent by a client thread, and the response it expects."""
+
+  def __init__(self, method, url, headers, body, response_body):
+    self._method = method
+    self._url = url
+    self._headers = headers
+    self._body = body
+    self._response_body = response_body
+
+
+class _RequestBenchmark:
+  """A benchmark that runs a script with canned_http.py, and sends the requests
+  of the script from a number of client threads.
+
+  Each client thread opens its own connections, so the connections of the script
+  are bound to the client threads in the order that they are opened.
+  """
+
+  def __init__(self, name, request, num_requests, requests_per_connection,
+      response_data):
+    self._name = name
+    self._request = request
+    self._num_requests = num_requests
+    self._requests_per_connection = requests_per_connection
+    self._response_data = response_data
+
+  def _num_connections(self):
+    """Returns the number of connections, rounded up so that at least
+    num_requests requests are sent.
+
+    Every connection sends requests_per_connection requests, because the
+    connections of the script are bound to the client threads in the order that
+    they are opened.
+    """
+
+    return -(-self._num_requests // self._requests_per_connection)
+
+  def _script_data(self):
+    request = self._request
+    request_data = {'method': request._method, 'url': request._url}
+    if request._headers:
+      request_data['headers'] = request._headers
+    if request._body:
+      request_data['body'] = request._body
+      if request._headers.get('Content-Type') == 'application/json':
+        request_data['body_type'] = 'json'
+    exchange_data = {'request': request_data, 'response': self._response_data}
+
+    connection_data = [exchange_data] * self._requests_per_connection
+    return [connection_data] * self._num_connections()
+
+  def _run_client(self, port, num_connections, latencies, errors):
+    request = self._request
+    try:
+      for i in xrange(num_connections):
+        connection = httplib.HTTPConnection('localhost', port)
+        for j in xrange(self._requests_per_connection):
+          start_time = time.time()
+          connection.request(
+              request._method, request._url, request._body, request._headers)
+          response = connection.getresponse()
+          response_body = response.read()
+          latencies.append(time.time() - start_time)
+          if response_body != request._response_body:
+            raise ValueError('Unexpected response body for %s' % request._url)
+        connection.close()
+    except Exception as e:
+      errors.append(e)
+
+  def run(self, script_dir, num_clients):
+    """Runs the benchmark and returns a map of its results."""
+
+    script_filename = os.path.join(script_dir, '%s.json' % self._name)
+    f = open(script_filename, 'w')
+    json.dump(self._script_data(), f)
+    f.close()
+
+    port = _unused_port()
+    server = subprocess.Popen([sys.executable, _CANNED_HTTP_FILENAME,
+        '--json_filename', script_filename, '--port', str(port), '--concurrent'],
+        stderr=open(os.devnull, 'w'))
+    try:
+      _wait_for_port(port)
+
+      # Divide the connections among the client threads.
+      num_connections = self._num_connections()
+      latencies = []
+      errors = []
+      threads = []
+      for i in xrange(num_clients):
+        client_connections = num_connections // num_clients
+        if i < num_connections % num_clients:
+          client_connections += 1
+        thread = threading.Thread(target=self._run_client,
+            args=(port, client_connections, latencies, errors))
+        threads.append(thread)
+      start_time = time.time()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      elapsed_time = time.time() - start_time
+    finally:
+      if server.poll() is None:
+        server.kill()
+      server.wait()
+    if errors:
+      raise errors[0]
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / elapsed_time,
+        'p50_ms': 1000 * _percentile(latencies, 50),
+        'p99_ms': 1000 * _percentile(latencies, 99),
+    }
+
+
+def _percentile(sorted_values, percentile):
+  index = int(round((len(sorted_values) - 1) * percentile / 100.0))
+  return sorted_values[index]
+
+
+def _unused_port():
+  """Returns a port on localhost that no server is listening on."""
+
+  s = socket.socket()
+  s.bind(('localhost', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+
+def _wait_for_port(port, timeout=10):
+  """Waits until a server has bound the given port."""
+
+  # Connecting to the server without sending a request would not follow the
+  # script, so instead wait until the port cannot be bound.
+  deadline = time.time() + timeout
+  while True:
+    s = socket.socket()
+    try:
+      s.bind(('', port))
+    except socket.error:
+      # Allow the server to begin listening after binding.
+      time.sleep(0.05)
+      return
+    finally:
+      s.close()
+    if time.time() > deadline:
+      raise RuntimeError('No server bound port %s' % port)
+    time.sleep(0.05)
+
+
+def _request_benchmarks(script_dir, num_requests, large_body_bytes):
+  """Returns the _RequestBenchmark instances to run."""
+
+  small_body = '<html><body>Small page</body></html>'
+  small_response_data = {
+      'status_code': 200,
+      'content_type': 'text/html; charset=utf-8',
+      'body': small_body}
+  small_get = _Request('GET', '/small.html', {}, None, small_body)
+
+  large_body = os.urandom(large_body_bytes)
+  large_body_filename = os.path.join(script_dir, 'large_body')
+  f = open(large_body_filename, 'wb')
+  f.write(large_body)
+  f.close()
+  large_response_data = {
+      'status_code': 200,
+      'content_type': 'application/octet-stream',
+      'body_filename': large_body_filename}
+  large_get = _Request('GET', '/large', {}, None, large_body)
+
+  json_body = json.dumps({'id': 42, 'tags': ['a', 'b', 'c'], 'nested': {'x': 1}})
+  json_post = _Request('POST', '/items', {'Content-Type': 'application/json'},
+      json_body, small_body)
+
+  return (
+      _RequestBenchmark('small_get', small_get, num_requests, 100,
+          small_response_data),
+      _RequestBenchmark('small_get_new_connections', small_get, num_requests, 1,
+          small_response_data),
+      _RequestBenchmark('large_file', large_get,
+          max(1, num_requests // 100), 10, large_response_data),
+      _RequestBenchmark('json_post', json_post, num_requests, 100,
+          small_response_data),
+  )
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--num_requests', type=int, required=False,
+      default=10000,
+      help='Minimum number of requests sent by each request benchmark')
+  arg_parser.add_argument('--num_clients', type=int, required=False, default=4,
+      help='Number of client threads sending requests')
+  arg_parser.add_argument('--large_body_bytes', type=int, required=False,
+      default=16 * 1024 * 1024,
+      help='Size of the body returned by the large file benchmark')
+  arg_parser.add_argument('--parse_sizes', type=str, required=False,
+      default='1000,100000,1000000',
+      help='Comma-separated numbers of exchanges for the parse benchmarks')
+  arg_parser.add_argument('--num_exchanges', type=int, required=False,
+      default=100000,
+      help='Number of exchanges in the script for the memory benchmark')
+  arg_parser.add_argument('--results_filename', type=str, required=False,
+      default='', help='JSON output file for the results')
+  parsed_args = arg_parser.parse_args()
+
+  results = {}
+  script_dir = tempfile.mkdtemp()
+  try:
+    for benchmark in _request_benchmarks(script_dir, parsed_args.num_requests,
+        parsed_args.large_body_bytes):
+      result = benchmark.run(script_dir, parsed_args.num_clients)
+      results[benchmark._name] = result
+      print '%s: %s requests, %.1f req/s, p50 %.2f ms, p99 %.2f ms' % (
+          benchmark._name, result['requests'], result['requests_per_second'],
+          result['p50_ms'], result['p99_ms'])
+  finally:
+    shutil.rmtree(script_dir)
+
+  for num_exchanges in (int(size) for size in parsed_args.parse_sizes.split(',')):
+    seconds = benchmark_parse(num_exchanges)
+    results['parse_%s' % num_exchanges] = {'seconds': seconds}
+    print 'parse: %s exchanges in %.3f s' % (num_exchanges, seconds)
+
+  bytes_per_exchange = benchmark_memory(parsed_args.num_exchanges)
+  results['memory'] = {'bytes_per_exchange': bytes_per_exchange}
+  print 'memory: %.0f bytes per exchange for %s exchanges' % (
+      bytes_per_exchange, parsed_args.num_exchanges)
+
+  if parsed_args.results_filename:
+    f = open(parsed_args.results_filename, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
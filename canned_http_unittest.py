@@ -1,5 +1,15 @@
+import errno
+import httplib
+import json
+import marshal
 import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import time
 import unittest
+import zlib
 
 import canned_http
 
@@ -90,6 +100,33 @@ class TestParseYaml(unittest.TestCase):
         """
     with self.assertRaises(canned_http.ScriptParseError):
       canned_http.script_from_yaml_string(raw_yaml)
+    # Raise exception if body_filename is missing for request.
+    raw_yaml = """
+        - - request:
+              method: POST
+              url: /foo.html
+              body_filename: missing_body_filename
+            response:
+              status_code: 200
+              content_type: html
+              body: <html><body></body></html>
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+    # Raise exception if body of type JSON is invalid for request.
+    raw_yaml = """
+        - - request:
+              method: POST
+              url: /foo.html
+              body_type: json
+              body: '{"abc": '
+            response:
+              status_code: 200
+              content_type: html
+              body: <html><body></body></html>
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
     # Raise exception if status code is missing in response.
     raw_yaml = """
         - - request:
@@ -141,6 +178,49 @@ class TestParseYaml(unittest.TestCase):
     with self.assertRaises(canned_http.ScriptParseError):
       canned_http.script_from_yaml_string(raw_yaml)
 
+  def test_chunks(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo.html
+            response:
+              status_code: 200
+              content_type: html
+              chunks:
+                - chunk1
+                - body: chunk2
+                  delay: 0.5
+        """
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    response = script._connections[0]._exchanges[0]._response
+    self.assertEqual((('chunk1', 0), ('chunk2', 0.5)), response._chunks)
+    # Raise exception if both body and chunks are present in response.
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo.html
+            response:
+              status_code: 200
+              content_type: html
+              body: body
+              chunks: [chunk1]
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+    # Raise exception if the body of a chunk is missing.
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo.html
+            response:
+              status_code: 200
+              content_type: html
+              chunks:
+                - delay: 1
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+
   def test_value_capitalization(self):
     url = '/foo.html'
     status_code = 200
@@ -238,6 +318,296 @@ class TestParseYaml(unittest.TestCase):
     self._assert_response(exchange, 200, 'html', delay=1000,
         body_filename=os.path.abspath('response_body_filename3'))
 
+  def test_compact_representation(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 200
+              content_type: html
+              body: response_body1
+        """
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    connection = script._connections[0]
+    exchange = connection._exchanges[0]
+    # No instance has a dictionary of attributes.
+    for instance in (script, connection, exchange,
+                     exchange._request, exchange._response):
+      self.assertFalse(hasattr(instance, '__dict__'))
+    # Requests and responses without headers share an empty dictionary.
+    self.assertIs(exchange._request._headers, exchange._response._headers)
+
+
+
+class TestCompiledScript(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_compile_script(self):
+    raw_yaml = """
+        - - request:
+              method: POST
+              url: /foo1.html
+              headers:
+                header_name1: header_value1
+              body_type: json
+              body: '{"abc": [1, 2]}'
+            response:
+              status_code: 200
+              content_type: html
+              headers:
+                header_name2: header_value2
+              delay: 0.5
+              body: body1
+          - request:
+              method: GET
+              url: /foo2.html
+            response:
+              status_code: 200
+              content_type: html
+              chunks: [chunk1, chunk2]
+          - request:
+              method: GET
+              url: /foo3.html
+        - - request:
+              method: GET
+              url: /foo4.html
+            response:
+              status_code: 404
+              content_type: html
+              body_filename: response_body_filename4
+        """
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    compiled_filename = os.path.join(self._dir, 'script.compiled')
+    canned_http.compile_script(script, compiled_filename)
+    compiled_script = canned_http.script_from_compiled_file(compiled_filename)
+    self.assertEqual(repr(script._connections), repr(compiled_script._connections))
+    request = compiled_script._connections[0]._exchanges[0]._request
+    self.assertEqual({'abc': [1, 2]}, request._expected_body)
+
+  def test_compile_stubs(self):
+    raw_yaml = """
+        connections:
+          - - request:
+                method: GET
+                url: /foo1.html
+              response:
+                status_code: 200
+                content_type: html
+                body: body1
+        stubs:
+          - request:
+              method: GET
+              url: /health
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: ok
+            count: 10
+            rate: 2.5
+        """
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    compiled_filename = os.path.join(self._dir, 'script.compiled')
+    canned_http.compile_script(script, compiled_filename)
+    compiled_script = canned_http.script_from_compiled_file(compiled_filename)
+    self.assertEqual(repr(script), repr(compiled_script))
+
+  def test_invalid_compiled_script(self):
+    # Raise exception if the file does not contain a compiled script.
+    compiled_filename = os.path.join(self._dir, 'script.compiled')
+    f = open(compiled_filename, 'wb')
+    f.write('[[]]')
+    f.close()
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_compiled_file(compiled_filename)
+    # Raise exception if the compiled script has a different version.
+    f = open(compiled_filename, 'wb')
+    marshal.dump((canned_http._COMPILED_SCRIPT_MAGIC, -1, ()), f)
+    f.close()
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_compiled_file(compiled_filename)
+
+
+class TestUnorderedDirector(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: GET
+            url: /foo1.html
+          response:
+            status_code: 200
+            content_type: html
+            body: body1
+        - request:
+            method: POST
+            url: /foo2.html
+            body: request_body1
+          response:
+            status_code: 200
+            content_type: html
+            body: body2
+      - - request:
+            method: POST
+            url: /foo2.html
+            body: request_body2
+          response:
+            status_code: 200
+            content_type: html
+            body: body3
+        - request:
+            method: GET
+            url: /foo3.html
+          response:
+            status_code: 200
+            content_type: html
+            body: body4
+      """
+
+  def test_any_order(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    director = canned_http.UnorderedDirector(script)
+    cursor1 = director.connection_opened()
+    cursor2 = director.connection_opened()
+    response = cursor1.got_request('GET', '/foo3.html')
+    self.assertEqual('body4', response._body)
+    self.assertEqual((2, 2), cursor1._exchange_indexes)
+    # The body selects between exchanges with the same method and URL.
+    response = cursor2.got_request(
+        'POST', '/foo2.html', body=StringIO.StringIO('request_body2'))
+    self.assertEqual('body3', response._body)
+    response = cursor2.got_request('POST', '/foo2.html', body='request_body1')
+    self.assertEqual('body2', response._body)
+    cursor2.connection_closed()
+    self.assertFalse(director.is_done())
+    self.assertEqual([1], [entry[0] for entry in director.unconsumed()])
+    response = cursor1.got_request('GET', '/foo1.html')
+    self.assertEqual('body1', response._body)
+    self.assertFalse(director.is_done())
+    cursor1.connection_closed()
+    self.assertTrue(director.is_done())
+    self.assertEqual([], director.unconsumed())
+
+  def test_invalid_requests(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    director = canned_http.UnorderedDirector(script)
+    cursor = director.connection_opened()
+    # Raise an exception if no exchange has the method and URL.
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/foo2.html')
+    # Raise an exception if no exchange has the body.
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('POST', '/foo2.html', body='request_body3')
+    # Raise an exception if an exchange was already matched.
+    cursor.got_request('GET', '/foo1.html')
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/foo1.html')
+    self.assertEqual([(1, 2), (2, 1), (2, 2)],
+        [entry[:2] for entry in director.unconsumed()])
+    # Raise an exception if a body is not the expected JSON.
+    script = canned_http.script_from_yaml_string("""
+        - - request:
+              method: POST
+              url: /items
+              body: '{"name": "item"}'
+              body_type: json
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: ok
+        """)
+    director = canned_http.UnorderedDirector(script)
+    cursor = director.connection_opened()
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('POST', '/items', body='plain')
+
+  def test_match_later_connection(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo.html
+              headers: {X: '1'}
+            response:
+              status_code: 200
+              content_type: html
+              body: body1
+        - - request:
+              method: GET
+              url: /foo.html
+              headers: {X: '2'}
+            response:
+              status_code: 200
+              content_type: html
+              body: body2
+        """
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    director = canned_http.UnorderedDirector(script)
+    cursor = director.connection_opened()
+    # The request matches the second connection, although an exchange of the
+    # first connection has the same method and URL.
+    response = cursor.got_request('GET', '/foo.html', {'X': '2'})
+    self.assertEqual('body2', response._body)
+    self.assertEqual((2, 1), cursor._exchange_indexes)
+    # The error of the first candidate is raised if no exchange matches.
+    with self.assertRaisesRegexp(canned_http.DirectorError, "header name 'X'"):
+      cursor.got_request('GET', '/foo.html', {'X': '3'})
+    response = cursor.got_request('GET', '/foo.html', {'X': '1'})
+    self.assertEqual('body1', response._body)
+
+
+class TestJsonLines(unittest.TestCase):
+  _RAW_JSONL = """
+[{"request": {"method": "GET", "url": "/foo1.html"},
+  "response": {"status_code": 200, "content_type": "html", "body": "body1"}}]
+
+[{"request": {"method": "GET", "url": "/foo2.html"},
+  "response": {"status_code": 200, "content_type": "html", "body": "body2"}}]
+[{"request": {"method": "GET"}}]
+""".replace('\n  ', ' ')
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._jsonl_filename = os.path.join(self._dir, 'script.jsonl')
+    f = open(self._jsonl_filename, 'w')
+    f.write(self._RAW_JSONL)
+    f.close()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_director(self):
+    script = canned_http.script_from_jsonl_file(self._jsonl_filename)
+    director = canned_http.Director(script)
+    director.connection_opened()
+    response = director.got_request('GET', '/foo1.html')
+    self.assertEqual('body1', response._body)
+    director.connection_closed()
+    director.connection_opened()
+    response = director.got_request('GET', '/foo2.html')
+    self.assertEqual('body2', response._body)
+    director.connection_closed()
+    # The invalid connection is parsed only once it is reached.
+    with self.assertRaises(canned_http.ScriptParseError):
+      director.is_done()
+
+  def test_concurrent_director(self):
+    script = canned_http.script_from_jsonl_file(self._jsonl_filename)
+    director = canned_http.ConcurrentDirector(
+        script, canned_http.ConcurrentDirector.BIND_BY_REQUEST)
+    cursor1 = director.connection_opened()
+    cursor2 = director.connection_opened()
+    response = cursor1.got_request('GET', '/foo2.html')
+    self.assertEqual('body2', response._body)
+    cursor1.connection_closed()
+    response = cursor2.got_request('GET', '/foo1.html')
+    self.assertEqual('body1', response._body)
+    cursor2.connection_closed()
+    # The invalid connection is parsed only once it is reached.
+    with self.assertRaises(canned_http.ScriptParseError):
+      director.is_done()
+
 
 class TestDirector(unittest.TestCase):
   def test_empty_script(self):
@@ -374,6 +744,89 @@ class TestDirector(unittest.TestCase):
     director.got_request('GET', '/foo1.html', body='{"d": {"e": 3}, "abc": [1, 2]}')
     director.connection_closed()
 
+  def test_request_body_filename(self):
+    body_dir = tempfile.mkdtemp()
+    try:
+      f = open(os.path.join(body_dir, 'request_body'), 'wb')
+      f.write('{"abc": [1, 2], "d": {"e": 3}}')
+      f.close()
+      raw_yaml = """
+          - - request:
+                method: POST
+                url: /foo1.html
+                body_type: json
+                body_filename: request_body
+              response:
+                status_code: 200
+                content_type: html
+                body: body1
+          """
+      script = canned_http.script_from_yaml_string(raw_yaml, body_dir)
+    finally:
+      shutil.rmtree(body_dir)
+    # The expected body was loaded and parsed with the script.
+    request = script._connections[0]._exchanges[0]._request
+    self.assertEqual({'abc': [1, 2], 'd': {'e': 3}}, request._expected_body)
+    director = canned_http.Director(script)
+    director.connection_opened()
+    director.got_request('POST', '/foo1.html', body='{"d": {"e": 3}, "abc": [1, 2]}')
+    director.connection_closed()
+
+  def test_request_body_stream(self):
+    body_dir = tempfile.mkdtemp()
+    max_loaded_body_bytes = canned_http._MAX_LOADED_BODY_BYTES
+    try:
+      f = open(os.path.join(body_dir, 'request_body'), 'wb')
+      f.write('0123456789' * 10)
+      f.close()
+      # Do not load the expected body from the file.
+      canned_http._MAX_LOADED_BODY_BYTES = 10
+      raw_yaml = """
+          - - request:
+                method: POST
+                url: /foo1.html
+                body: body1
+              response:
+                status_code: 200
+                content_type: html
+                body: body1
+            - request:
+                method: POST
+                url: /foo2.html
+                body_filename: request_body
+              response:
+                status_code: 200
+                content_type: html
+                body: body2
+          """
+      script = canned_http.script_from_yaml_string(raw_yaml, body_dir)
+      self.assertIsNone(script._connections[0]._exchanges[1]._request._expected_body)
+
+      # Compare streams to an expected body that is loaded.
+      director = canned_http.Director(script)
+      director.connection_opened()
+      director.got_request('POST', '/foo1.html', body=StringIO.StringIO('body1'))
+      director = canned_http.Director(script)
+      director.connection_opened()
+      with self.assertRaisesRegexp(canned_http.DirectorError, 'at byte 5 '):
+        director.got_request('POST', '/foo1.html', body=StringIO.StringIO('body12'))
+
+      # Compare streams and strings to an expected body that is not loaded.
+      director = canned_http.Director(script)
+      director.connection_opened()
+      director.got_request('POST', '/foo1.html', body='body1')
+      director.got_request(
+          'POST', '/foo2.html', body=StringIO.StringIO('0123456789' * 10))
+      director = canned_http.Director(script)
+      director.connection_opened()
+      director.got_request('POST', '/foo1.html', body='body1')
+      with self.assertRaisesRegexp(canned_http.DirectorError, 'at byte 53 '):
+        director.got_request(
+            'POST', '/foo2.html', body='0123456789' * 5 + '012x')
+    finally:
+      canned_http._MAX_LOADED_BODY_BYTES = max_loaded_body_bytes
+      shutil.rmtree(body_dir)
+
   def test_request_headers(self):
     raw_yaml = """
         - - request:
@@ -448,6 +901,1554 @@ class TestDirector(unittest.TestCase):
     self._assert_response(response, 200, 'html', body='body3')
     director.connection_closed()
 
+
+class TestConcurrentDirector(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: GET
+            url: /foo1.html
+          response:
+            status_code: 200
+            content_type: html
+            body: body1
+        - request:
+            method: GET
+            url: /foo2.html
+          response:
+            status_code: 200
+            content_type: html
+            body: body2
+      - - request:
+            method: GET
+            url: /bar1.html
+          response:
+            status_code: 200
+            content_type: html
+            body: body3
+      """
+
+  def test_empty_script(self):
+    script = canned_http.Script()
+    director = canned_http.ConcurrentDirector(script)
+    self.assertTrue(director.is_done())
+    # Raise an exception if connection opened after the script ended.
+    with self.assertRaises(canned_http.DirectorError):
+      director.connection_opened()
+
+  def test_bind_by_order(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    director = canned_http.ConcurrentDirector(script)
+    # Exchanges on different connections can be interleaved.
+    cursor1 = director.connection_opened()
+    cursor2 = director.connection_opened()
+    response = cursor1.got_request('GET', '/foo1.html')
+    self.assertEqual('body1', response._body)
+    response = cursor2.got_request('GET', '/bar1.html')
+    self.assertEqual('body3', response._body)
+    cursor2.connection_closed()
+    self.assertFalse(director.is_done())
+    response = cursor1.got_request('GET', '/foo2.html')
+    self.assertEqual('body2', response._body)
+    cursor1.connection_closed()
+    self.assertTrue(director.is_done())
+    # Raise an exception if connection opened after the script ended.
+    with self.assertRaises(canned_http.DirectorError):
+      director.connection_opened()
+
+  def test_bind_by_request(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    director = canned_http.ConcurrentDirector(
+        script, canned_http.ConcurrentDirector.BIND_BY_REQUEST)
+    # The first connection opened performs the second connection of the script.
+    cursor1 = director.connection_opened()
+    cursor2 = director.connection_opened()
+    response = cursor1.got_request('GET', '/bar1.html')
+    self.assertEqual('body3', response._body)
+    cursor1.connection_closed()
+    # Raise an exception if the first request begins no remaining connection.
+    with self.assertRaises(canned_http.DirectorError):
+      cursor2.got_request('GET', '/bar1.html')
+
+  def test_invalid_events(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    # Raise an exception if closed connection instead of getting a request.
+    director = canned_http.ConcurrentDirector(script)
+    cursor = director.connection_opened()
+    cursor.got_request('GET', '/foo1.html')
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.connection_closed()
+    # Raise an exception if got request instead of closing the connection.
+    director = canned_http.ConcurrentDirector(script)
+    director.connection_opened()
+    cursor = director.connection_opened()
+    cursor.got_request('GET', '/bar1.html')
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/bar2.html')
+    # Raise an exception if the wrong URL is requested.
+    director = canned_http.ConcurrentDirector(script)
+    cursor = director.connection_opened()
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/foo2.html')
+
+
+class TestStubs(unittest.TestCase):
+  _RAW_YAML = """
+      connections:
+        - - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 200
+              content_type: html
+              body: body1
+      stubs:
+        - request:
+            method: GET
+            url: /health
+          response:
+            status_code: 200
+            content_type: text/plain
+            body: ok
+        - request:
+            method: POST
+            url: /items
+            body: item
+          response:
+            status_code: 201
+            content_type: text/plain
+            body: created
+          count: 2
+      """
+
+  def test_invalid_stubs(self):
+    # Raise exception if a stub has no response.
+    raw_yaml = """
+        stubs:
+          - request:
+              method: GET
+              url: /health
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+    # Raise exception if a stub has an invalid count.
+    raw_yaml = """
+        stubs:
+          - request:
+              method: GET
+              url: /health
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: ok
+            count: 0
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+
+  def test_director(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    self.assertEqual(2, len(script._stubs))
+    director = canned_http.Director(script)
+    # Stubs can be performed between the exchanges of the script.
+    cursor = director.connection_opened()
+    response = cursor.got_request('GET', '/health')
+    self.assertEqual('ok', response._body)
+    self.assertEqual(('stub', 1), cursor._exchange_indexes)
+    response = cursor.got_request('GET', '/foo1.html')
+    self.assertEqual('body1', response._body)
+    response = cursor.got_request('GET', '/health')
+    self.assertEqual('ok', response._body)
+    cursor.connection_closed()
+    # Stubs can be performed on connections opened after the script ended.
+    cursor = director.connection_opened()
+    response = cursor.got_request(
+        'POST', '/items', body=StringIO.StringIO('item'))
+    self.assertEqual('created', response._body)
+    response = cursor.got_request('POST', '/items', body='item')
+    self.assertEqual('created', response._body)
+    # Raise an exception once a stub has been performed its count of times.
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('POST', '/items', body='item')
+    cursor.connection_closed()
+    # A stub without a count is never done.
+    self.assertFalse(director.is_done())
+
+  def test_json_stub(self):
+    raw_yaml = """
+        connections:
+          - - request:
+                method: POST
+                url: /items
+                body: plain
+              response:
+                status_code: 201
+                content_type: text/plain
+                body: created
+        stubs:
+          - request:
+              method: POST
+              url: /items
+              body: '{"name": "item"}'
+              body_type: json
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: stubbed
+        """
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    # A body that is not JSON does not match the stub, and falls through to the
+    # script.
+    response = cursor.got_request('POST', '/items', {}, 'plain')
+    self.assertEqual('created', response._body)
+    response = cursor.got_request('POST', '/items', {}, '{"name":"item"}')
+    self.assertEqual('stubbed', response._body)
+    cursor.connection_closed()
+
+  def test_count(self):
+    script = canned_http.Script(stubs=[canned_http.Stub(canned_http.Exchange(
+        canned_http.Exchange.Request('GET', '/health'),
+        canned_http.Exchange.Response.response_with_body(
+            200, 'text/plain', 'ok')), count=2)])
+    director = canned_http.ConcurrentDirector(
+        script, canned_http.ConcurrentDirector.BIND_BY_REQUEST)
+    cursor = director.connection_opened()
+    cursor.got_request('GET', '/health')
+    self.assertFalse(director.is_done())
+    cursor.got_request('GET', '/health')
+    cursor.connection_closed()
+    self.assertTrue(director.is_done())
+
+  def test_rate(self):
+    stub = canned_http.Stub(canned_http.Exchange(
+        canned_http.Exchange.Request('GET', '/health'),
+        canned_http.Exchange.Response.response_with_body(
+            200, 'text/plain', 'ok')), rate=2)
+    stubs = canned_http._StubTable([stub])
+    self.assertEqual(1, stubs.match('GET', '/health', {}, None)[0])
+    self.assertEqual(1, stubs.match('GET', '/health', {}, None)[0])
+    # A request beyond the rate does not match the stub.
+    self.assertIsNone(stubs.match('GET', '/health', {}, None))
+    time.sleep(0.6)
+    self.assertEqual(1, stubs.match('GET', '/health', {}, None)[0])
+
+  def test_unordered_director(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    director = canned_http.UnorderedDirector(script)
+    cursor = director.connection_opened()
+    response = cursor.got_request('GET', '/health')
+    self.assertEqual('ok', response._body)
+    response = cursor.got_request('GET', '/foo1.html')
+    self.assertEqual('body1', response._body)
+    cursor.connection_closed()
+    self.assertEqual([], director.unconsumed())
+    self.assertFalse(director.is_done())
+
+
+class TestPatterns(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: GET
+            url:
+              template: /items/{id}
+            headers:
+              X-Request-Id:
+                regex: '[0-9a-f]+'
+            query:
+              page: '2'
+              cb:
+                glob: '*'
+          response:
+            status_code: 200
+            content_type: html
+            body: body1
+      """
+
+  def test_pattern(self):
+    pattern = canned_http.Pattern(canned_http.Pattern.REGEX, r'/a+\.html')
+    self.assertTrue(pattern.matches('/aa.html'))
+    self.assertFalse(pattern.matches('/aa.htmlx'))
+    self.assertFalse(pattern.matches(None))
+    # Every alternative must match the entire value.
+    pattern = canned_http.Pattern(canned_http.Pattern.REGEX, '/foo|/bar')
+    self.assertTrue(pattern.matches('/foo'))
+    self.assertTrue(pattern.matches('/bar'))
+    self.assertFalse(pattern.matches('/foo/extra'))
+    pattern = canned_http.Pattern(canned_http.Pattern.GLOB, '/static/*.css?v=?')
+    self.assertTrue(pattern.matches('/static/a/b.css?v=1'))
+    self.assertFalse(pattern.matches('/static/a.js?v=1'))
+    pattern = canned_http.Pattern(canned_http.Pattern.TEMPLATE, '/items/{id}.json')
+    self.assertTrue(pattern.matches('/items/42.json'))
+    self.assertFalse(pattern.matches('/items/4/2.json'))
+    self.assertFalse(pattern.matches('/items/.json'))
+
+  def test_invalid_patterns(self):
+    # Raise exception if the pattern kind is invalid.
+    raw_yaml = """
+        - - request:
+              method: GET
+              url:
+                prefix: /items
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+    # Raise exception if the regular expression is invalid.
+    raw_yaml = """
+        - - request:
+              method: GET
+              url:
+                regex: /items/(
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+
+  def test_director(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    headers = {'X-Request-Id': '3f2a'}
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    response = cursor.got_request('GET', '/items/42?cb=123&page=2', headers)
+    self.assertEqual('body1', response._body)
+    # Raise an exception if a header does not match.
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/items/42?cb=1&page=2', {'X-Request-Id': 'xyz'})
+    # Raise an exception if a query parameter is missing.
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/items/42?page=2', headers)
+    # Raise an exception if the path does not match.
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    with self.assertRaises(canned_http.DirectorError):
+      cursor.got_request('GET', '/items/42/x?cb=1&page=2', headers)
+
+  def test_data_unchanged(self):
+    script_data = [[{
+        'request': {
+            'method': 'GET',
+            'url': {'template': '/items/{id}'},
+            'headers': {'X-Request-Id': {'regex': '[0-9a-f]+'}},
+            'query': {'page': {'glob': '*'}}},
+        'response': {
+            'status_code': 200, 'content_type': 'html', 'body': 'body1'}}]]
+    script = canned_http.script_from_data(script_data)
+    # The patterns are parsed without modifying the given data, so it can be
+    # parsed again.
+    request_data = script_data[0][0]['request']
+    self.assertEqual({'X-Request-Id': {'regex': '[0-9a-f]+'}},
+                     request_data['headers'])
+    self.assertEqual({'page': {'glob': '*'}}, request_data['query'])
+    self.assertEqual(
+        repr(script), repr(canned_http.script_from_data(script_data)))
+
+  def test_route_table(self):
+    routes = canned_http._RouteTable()
+    # Add more patterns than can be combined into one regular expression, and a
+    # pattern with a group that cannot be combined.
+    for i in xrange(250):
+      routes.add(canned_http.Exchange.Request('GET', canned_http.Pattern(
+          canned_http.Pattern.TEMPLATE, '/items%s/{id}' % i)), i)
+      if i == 150:
+        routes.add(canned_http.Exchange.Request('GET', canned_http.Pattern(
+            canned_http.Pattern.REGEX, r'/items(1\d\d)/.*')), 'group')
+    routes.add(canned_http.Exchange.Request('GET', '/items7/1'), 'exact')
+    routes.add(canned_http.Exchange.Request('GET', '/items7/1', query={}), 'query')
+    self.assertEqual(253, len(routes))
+    self.assertEqual([200], routes.candidates('GET', '/items200/1'))
+    self.assertEqual([120, 'group'], routes.candidates('GET', '/items120/1'))
+    self.assertEqual(['exact', 'query', 7], routes.candidates('GET', '/items7/1'))
+    # The path is also looked up, so candidates may still fail verification.
+    self.assertEqual(['exact', 'query', 7],
+                     routes.candidates('GET', '/items7/1?a=b'))
+    self.assertEqual([], routes.candidates('POST', '/items7/1'))
+    routes.remove(canned_http.Exchange.Request('GET', canned_http.Pattern(
+        canned_http.Pattern.TEMPLATE, '/items7/{id}')), 7)
+    routes.remove(canned_http.Exchange.Request('GET', '/items7/1'), 'exact')
+    self.assertEqual(['query'], routes.candidates('GET', '/items7/1?a=b'))
+
+  def test_route_table_alternation(self):
+    # A pattern with alternatives matches the same whether it is alone or
+    # combined with other patterns.
+    alternation = canned_http.Exchange.Request('GET', canned_http.Pattern(
+        canned_http.Pattern.REGEX, '/foo|/bar'))
+    routes = canned_http._RouteTable()
+    routes.add(alternation, 'alternation')
+    self.assertEqual(['alternation'], routes.candidates('GET', '/foo'))
+    self.assertEqual([], routes.candidates('GET', '/foo/extra'))
+    routes.add(canned_http.Exchange.Request('GET', canned_http.Pattern(
+        canned_http.Pattern.GLOB, '/foo*')), 'glob')
+    routes.add(canned_http.Exchange.Request('GET', canned_http.Pattern(
+        canned_http.Pattern.TEMPLATE, '/{name}')), 'template')
+    # Every pattern of a combined regular expression that matches is returned.
+    self.assertEqual(['alternation', 'glob', 'template'],
+                     routes.candidates('GET', '/foo'))
+    self.assertEqual(['glob'], routes.candidates('GET', '/foo/extra'))
+    self.assertEqual(['alternation', 'template'],
+                     routes.candidates('GET', '/bar'))
+    self.assertEqual([], routes.candidates('GET', '/baz/extra'))
+
+  def test_compile_script(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    temp_dir = tempfile.mkdtemp()
+    try:
+      compiled_filename = os.path.join(temp_dir, 'script.compiled')
+      canned_http.compile_script(script, compiled_filename)
+      compiled_script = canned_http.script_from_compiled_file(compiled_filename)
+    finally:
+      shutil.rmtree(temp_dir)
+    self.assertEqual(repr(script), repr(compiled_script))
+    request = compiled_script._connections[0]._exchanges[0]._request
+    self.assertTrue(request._url.matches('/items/42'))
+
+
+class TestTemplates(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: POST
+            url:
+              template: /users/{user}/items
+            query: {}
+            body: '{"tags": ["a", "b"], "item": {"name": "box"}}'
+            body_type: json
+          response:
+            status_code: 201
+            content_type: application/json
+            headers:
+              X-Correlation-Id: '{{header.X-Request-Id}}'
+            body: '{"user": "{{path.user}}", "name": "{{json.item.name}}",
+                "tags": {{json.tags}}, "tag": "{{json.tags.1}}", "page": "{{query.page}}",
+                "missing": "{{json.missing}}"}'
+            template: true
+      """
+
+  def test_render(self):
+    template = canned_http.Template('{{method}} {{ path }}?{{query.a}}')
+    context = canned_http._TemplateContext(
+        canned_http.Exchange.Request('GET', '/foo'), 'GET', '/foo?a=1&b=2', {},
+        None)
+    self.assertEqual('GET /foo?1', template.render(context))
+    template = canned_http.Template('no references')
+    self.assertEqual('no references', template.render(context))
+
+  def test_invalid_template(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo
+            response:
+              status_code: 200
+              content_type: html
+              body: '{{cookie.session}}'
+              template: true
+        """
+    with self.assertRaises(canned_http.ScriptParseError):
+      canned_http.script_from_yaml_string(raw_yaml)
+
+  def test_director(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    body = StringIO.StringIO('{"item": {"name": "box"}, "tags": ["a", "b"]}')
+    response = cursor.got_request('POST', '/users/alice/items?page=3',
+        {'X-Request-Id': 'abc123'}, body)
+    self.assertEqual({'X-Correlation-Id': 'abc123'}, response._headers)
+    self.assertEqual({'user': 'alice', 'name': 'box', 'tags': ['a', 'b'],
+                      'tag': 'b', 'page': '3', 'missing': ''},
+                     json.loads(response._body))
+    # The response of the script is not modified.
+    response = script._connections[0]._exchanges[0]._response
+    self.assertIn('{{path.user}}', response._body)
+
+  def test_non_ascii(self):
+    # A JSON script has unicode literals, while the values of references are
+    # UTF-8 byte strings.
+    json_string = json.dumps([[{
+        'request': {'method': 'GET', 'url': {'template': '/{name}'},
+                    'query': {}},
+        'response': {
+            'status_code': 200,
+            'content_type': 'text/plain; charset=utf-8',
+            'headers': {'X-Name': u'\u00e0 {{query.name}}'},
+            'body': u'\u00e0 {{path.name}} {{query.name}}',
+            'template': True}}]])
+    script = canned_http.script_from_json_string(json_string)
+    director = canned_http.Director(script)
+    cursor = director.connection_opened()
+    response = cursor.got_request('GET', '/%C3%A9?name=%C3%A9')
+    self.assertEqual('\xc3\xa0 %C3%A9 \xc3\xa9', response._body)
+    self.assertEqual({'X-Name': '\xc3\xa0 \xc3\xa9'}, response._headers)
+
+  def test_compile_script(self):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML)
+    temp_dir = tempfile.mkdtemp()
+    try:
+      compiled_filename = os.path.join(temp_dir, 'script.compiled')
+      canned_http.compile_script(script, compiled_filename)
+      compiled_script = canned_http.script_from_compiled_file(compiled_filename)
+    finally:
+      shutil.rmtree(temp_dir)
+    response = compiled_script._connections[0]._exchanges[0]._response
+    self.assertIsNotNone(response._templates)
+
+
+class TestWorkers(unittest.TestCase):
+  def test_partition_script(self):
+    connections = [canned_http.Connection() for i in xrange(5)]
+    script = canned_http.Script(connections)
+    partition = canned_http._partition_script(script, 1, 2)
+    self.assertEqual((connections[1], connections[3]), partition._connections)
+    # Partitioning a LazyScript creates the connections as they are reached.
+    script = canned_http.LazyScript(iter(connections))
+    partition = canned_http._partition_script(script, 0, 2)
+    self.assertIsInstance(partition, canned_http.LazyScript)
+    self.assertEqual([connections[0], connections[2], connections[4]],
+                     list(partition._connections))
+
+  def test_reuse_port(self):
+    server1 = canned_http._ReusePortTCPServer(
+        ('localhost', 0), canned_http.DirectorRequestHandler)
+    try:
+      # A second server can listen on the same port.
+      server2 = canned_http._ReusePortTCPServer(
+          server1.server_address, canned_http.DirectorRequestHandler)
+      server2.server_close()
+    finally:
+      server1.server_close()
+
+
+class TestDelays(unittest.TestCase):
+  class _FakeClock(object):
+    """Replaces the time module of canned_http, where each sleep advances the
+    time by its duration, and yielding by sleeping 0 advances it by 0.5 ms.
+    """
+
+    def __init__(self, now):
+      self._now = now
+      self.sleeps = []
+
+    def time(self):
+      return self._now
+
+    def sleep(self, seconds):
+      self.sleeps.append(seconds)
+      self._now += seconds or 0.0005
+
+  def test_sleep_until(self):
+    clock = TestDelays._FakeClock(100.0)
+    canned_http.time = clock
+    try:
+      canned_http._sleep_until(100.0102)
+    finally:
+      canned_http.time = time
+    # It should sleep until just before the deadline, and then yield until the
+    # deadline is reached.
+    self.assertAlmostEqual(0.0082, clock.sleeps[0])
+    self.assertEqual([0, 0, 0, 0], clock.sleeps[1:])
+    self.assertGreaterEqual(clock.time(), 100.0102)
+
+    # A deadline that has passed should not sleep at all.
+    clock = TestDelays._FakeClock(100.0)
+    canned_http.time = clock
+    try:
+      canned_http._sleep_until(99.0)
+    finally:
+      canned_http.time = time
+    self.assertEqual([], clock.sleeps)
+
+  def test_delay_drift(self):
+    delay_drift = canned_http.DelayDrift()
+    self.assertEqual('no delayed responses', repr(delay_drift))
+    delay_drift.add(0.5, 0.501)
+    delay_drift.add(1.0, 1.003)
+    self.assertEqual(
+        '2 delayed responses, mean drift 2.000 ms, max drift 3.000 ms',
+        repr(delay_drift))
+
+
+class TestThrottle(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: GET
+            url: /foo.html
+          response:
+            status_code: 200
+            content_type: text/plain
+            body: body
+            %s
+      """
+
+  def _response(self, throttle_yaml):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML % throttle_yaml)
+    return script._connections[0]._exchanges[0]._response
+
+  def test_parse(self):
+    self.assertIsNone(self._response('')._throttle)
+    self.assertEqual((1000, None, 0),
+                     self._response('bandwidth: 1000')._throttle)
+    self.assertEqual((None, 10, 0.5), self._response(
+        'drip_bytes: 10\n            drip_delay: 0.5')._throttle)
+    for throttle_yaml in ('bandwidth: 0', 'bandwidth: fast', 'drip_bytes: 0',
+                          'drip_delay: 1'):
+      self.assertRaises(canned_http.ScriptParseError,
+          canned_http.script_from_yaml_string, self._RAW_YAML % throttle_yaml)
+
+  def test_token_bucket(self):
+    bucket = canned_http._TokenBucket(1000)
+    # The bucket begins with enough tokens for one slice.
+    self.assertEqual(50, bucket._capacity)
+    now = bucket._time
+    self.assertEqual(now, bucket.take(50, now))
+    # Tokens that are taken before they are available must be waited for.
+    self.assertAlmostEqual(now + 0.1, bucket.take(100, now))
+    self.assertAlmostEqual(now + 0.15, bucket.take(50, now))
+    # The bucket does not refill past its capacity.
+    later = now + 10
+    self.assertEqual(later, bucket.take(50, later))
+    self.assertAlmostEqual(later + 0.05, bucket.take(50, later))
+
+  def test_compile_script(self):
+    script = canned_http.script_from_yaml_string(
+        self._RAW_YAML % 'bandwidth: 1000')
+    temp_dir = tempfile.mkdtemp()
+    try:
+      compiled_filename = os.path.join(temp_dir, 'script.compiled')
+      canned_http.compile_script(script, compiled_filename)
+      compiled_script = canned_http.script_from_compiled_file(compiled_filename)
+    finally:
+      shutil.rmtree(temp_dir)
+    response = compiled_script._connections[0]._exchanges[0]._response
+    self.assertEqual((1000, None, 0), response._throttle)
+
+
+class TestFaults(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: GET
+            url: /foo.html
+          response:
+            status_code: 200
+            content_type: text/plain
+            body: body
+            fault: %s
+      """
+
+  def _fault(self, fault_yaml):
+    script = canned_http.script_from_yaml_string(self._RAW_YAML % fault_yaml)
+    return script._connections[0]._exchanges[0]._response._fault
+
+  def test_parse(self):
+    self.assertEqual(('reset', 2), self._fault('{type: reset, after_bytes: 2}'))
+    self.assertEqual(('close', 0), self._fault('{type: close}'))
+    self.assertEqual(('stall', 2), self._fault('{type: stall, after_bytes: 2}'))
+    self.assertEqual(('content_length', 10),
+                     self._fault('{type: content_length, content_length: 10}'))
+    for fault_yaml in ('reset', '{type: explode}', '{after_bytes: 2}',
+                       '{type: reset, after_bytes: -1}',
+                       '{type: content_length}'):
+      self.assertRaises(canned_http.ScriptParseError,
+          canned_http.script_from_yaml_string, self._RAW_YAML % fault_yaml)
+
+
+class TestBodyCache(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _write_file(self, name, contents):
+    filename = os.path.join(self._dir, name)
+    f = open(filename, 'wb')
+    f.write(contents)
+    f.close()
+    return filename
+
+  def test_modified_file(self):
+    body_cache = canned_http.BodyCache()
+    filename = self._write_file('body1', 'contents1')
+    os.utime(filename, (1000, 1000))
+    self.assertEqual('contents1', body_cache.get(filename))
+    # Cached contents are returned while the modification time is unchanged.
+    self._write_file('body1', 'contents2')
+    os.utime(filename, (1000, 1000))
+    self.assertEqual('contents1', body_cache.get(filename))
+    # The file is read again once its modification time changes.
+    os.utime(filename, (1000, 1001))
+    self.assertEqual('contents2', body_cache.get(filename))
+
+  def test_limits(self):
+    body_cache = canned_http.BodyCache(max_bytes=20, max_file_bytes=10)
+    filename1 = self._write_file('body1', 'contents1')
+    filename2 = self._write_file('body2', 'contents2')
+    filename3 = self._write_file('body3', 'contents3')
+    large_filename = self._write_file('large_body', 'large_contents')
+    # Files larger than the maximum file size are not cached.
+    self.assertIsNone(body_cache.get(large_filename))
+    # The least recently used contents are evicted.
+    body_cache.get(filename1)
+    body_cache.get(filename2)
+    body_cache.get(filename1)
+    body_cache.get(filename3)
+    self.assertEqual([filename1, filename3], list(body_cache._entries))
+    self.assertEqual(18, body_cache._num_bytes)
+
+  def test_preload(self):
+    filename = self._write_file('body1', 'contents1')
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 200
+              content_type: html
+              body_filename: %s
+          - request:
+              method: GET
+              url: /foo2.html
+            response:
+              status_code: 200
+              content_type: html
+              body_filename: missing_body
+        """ % filename
+    script = canned_http.script_from_yaml_string(raw_yaml)
+    body_cache = canned_http.BodyCache()
+    body_cache.preload(script)
+    self.assertEqual([filename], list(body_cache._entries))
+
+  def test_compressed(self):
+    body_cache = canned_http.BodyCache()
+    filename = self._write_file('body1', 'contents1' * 100)
+    compressed = body_cache.get_compressed('gzip', filename=filename)
+    self.assertEqual('contents1' * 100,
+                     zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+    # The body is compressed only once.
+    self.assertIs(compressed, body_cache.get_compressed('gzip', filename=filename))
+    compressed = body_cache.get_compressed('gzip', body='body1')
+    self.assertIs(compressed, body_cache.get_compressed('gzip', body='body1'))
+    self.assertEqual('body1', zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+
+  def test_negotiate_encoding(self):
+    self.assertIsNone(canned_http._negotiate_encoding(None))
+    self.assertIsNone(canned_http._negotiate_encoding('identity'))
+    self.assertIsNone(canned_http._negotiate_encoding('gzip;q=0, deflate'))
+    self.assertEqual('gzip', canned_http._negotiate_encoding('deflate, gzip'))
+    self.assertEqual('gzip', canned_http._negotiate_encoding('GZIP;q=0.5'))
+    if canned_http.brotli:
+      self.assertEqual('br', canned_http._negotiate_encoding('*'))
+      self.assertEqual('gzip', canned_http._negotiate_encoding('br;q=0.5, gzip'))
+    else:
+      self.assertEqual('gzip', canned_http._negotiate_encoding('*'))
+      self.assertEqual('gzip', canned_http._negotiate_encoding('br, gzip;q=0.5'))
+
+
+class TestChunkedBodyReader(unittest.TestCase):
+  def test_read(self):
+    rfile = StringIO.StringIO(
+        '5\r\nchunk\r\n10;name=value\r\n0123456789abcdef\r\n'
+        '0\r\nTrailer: value\r\n\r\nnext request')
+    reader = canned_http._ChunkedBodyReader(rfile)
+    self.assertEqual('chu', reader.read(3))
+    self.assertEqual('nk0123', reader.read(6))
+    self.assertEqual('456789abcdef', reader.read())
+    self.assertEqual('', reader.read())
+    # The last chunk and trailer were consumed.
+    self.assertEqual('next request', rfile.read())
+
+  def test_invalid_chunk_size(self):
+    reader = canned_http._ChunkedBodyReader(StringIO.StringIO('pony\r\n'))
+    with self.assertRaises(canned_http.DirectorError):
+      reader.read()
+
+
+class TestMetrics(unittest.TestCase):
+  def test_to_prometheus(self):
+    metrics = canned_http.Metrics()
+    metrics.observe(canned_http.Metrics.DELAY, 1, 2, 0.003)
+    metrics.observe(canned_http.Metrics.DELAY, 1, 2, 20)
+    lines = metrics.to_prometheus().splitlines()
+    labels = 'phase="delay",connection="1",exchange="2"'
+    self.assertIn('# TYPE canned_http_phase_seconds histogram', lines)
+    self.assertIn('canned_http_phase_seconds_bucket{%s,le="0.0025"} 0' % labels, lines)
+    self.assertIn('canned_http_phase_seconds_bucket{%s,le="0.005"} 1' % labels, lines)
+    self.assertIn('canned_http_phase_seconds_bucket{%s,le="10"} 1' % labels, lines)
+    self.assertIn('canned_http_phase_seconds_bucket{%s,le="+Inf"} 2' % labels, lines)
+    self.assertIn('canned_http_phase_seconds_sum{%s} 20.003' % labels, lines)
+    self.assertIn('canned_http_phase_seconds_count{%s} 2' % labels, lines)
+
+  def test_to_json_data(self):
+    metrics = canned_http.Metrics()
+    metrics.observe(canned_http.Metrics.WRITE_RESPONSE, 2, 1, 0.0002)
+    histogram, = metrics.to_json_data()
+    self.assertEqual('write_response', histogram['phase'])
+    self.assertEqual(2, histogram['connection'])
+    self.assertEqual(1, histogram['exchange'])
+    self.assertEqual(1, histogram['buckets']['0.00025'])
+    self.assertEqual(0, histogram['buckets']['0.0001'])
+    self.assertEqual(1, histogram['count'])
+
+  def test_for_script(self):
+    metrics = canned_http.Metrics()
+    metrics.for_script('a').observe(canned_http.Metrics.DELAY, 1, 1, 0.003)
+    metrics.for_script('b').observe(canned_http.Metrics.DELAY, 1, 1, 0.003)
+    # The histograms of each script are kept apart, and each view exports only
+    # the histograms of its script.
+    self.assertEqual(['a', 'b'],
+                     [histogram['script'] for histogram in metrics.to_json_data()])
+    histogram, = metrics.for_script('b').to_json_data()
+    self.assertEqual('b', histogram['script'])
+    self.assertIn('canned_http_phase_seconds_count{script="a",phase="delay",'
+                  'connection="1",exchange="1"} 1',
+                  metrics.to_prometheus().splitlines())
+
+
+class TestSerializedHead(unittest.TestCase):
+  def test_serialized_head(self):
+    response = canned_http.Exchange.Response.response_with_body(
+        200, 'text/html', 'body', {'Connection': 'close'})
+    prefix, suffix, close_connection = canned_http._serialized_head(response, 4)
+    self.assertEqual('HTTP/1.1 200 OK\r\nServer: %s\r\nDate: ' %
+                     canned_http._SERVER_VERSION, prefix)
+    self.assertEqual('\r\nContent-Type: text/html\r\nContent-Length: 4\r\n'
+                     'Connection: close\r\n\r\n', suffix)
+    self.assertTrue(close_connection)
+    # The head is kept by the response until the content length changes.
+    self.assertIs(suffix, canned_http._serialized_head(response, 4)[1])
+    prefix, suffix, close_connection = canned_http._serialized_head(response, None)
+    self.assertIn('\r\nTransfer-Encoding: chunked\r\n', suffix)
+
+
+class TestRanges(unittest.TestCase):
+  def test_parse_ranges(self):
+    parse_ranges = canned_http._parse_ranges
+    self.assertEqual([(0, 10)], parse_ranges('bytes=0-9', 100))
+    self.assertEqual([(90, 10)], parse_ranges('bytes=90-', 100))
+    self.assertEqual([(80, 20)], parse_ranges('bytes=-20', 100))
+    self.assertEqual([(0, 100)], parse_ranges('bytes=-200', 100))
+    # The last byte position is limited to the end of the file.
+    self.assertEqual([(50, 50)], parse_ranges('bytes=50-500', 100))
+    self.assertEqual([(0, 1), (10, 5)], parse_ranges('bytes=0-0, 10-14', 100))
+    # Ranges that cannot be satisfied are omitted.
+    self.assertEqual([(0, 1)], parse_ranges('bytes=0-0,100-200', 100))
+    self.assertEqual([], parse_ranges('bytes=100-', 100))
+    self.assertEqual([], parse_ranges('bytes=-0', 100))
+    # Invalid headers are ignored.
+    self.assertIsNone(parse_ranges('items=0-9', 100))
+    self.assertIsNone(parse_ranges('bytes=9-0', 100))
+    self.assertIsNone(parse_ranges('bytes=a-9', 100))
+    self.assertIsNone(parse_ranges('bytes=-', 100))
+    self.assertIsNone(parse_ranges('bytes=', 100))
+
+
+class _QuietRequestHandler(canned_http.DirectorRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+class TestDirectorRequestHandler(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._server = None
+
+  def tearDown(self):
+    if self._server:
+      self._server.stop()
+    shutil.rmtree(self._dir)
+
+  def _write_file(self, name, contents):
+    filename = os.path.join(self._dir, name)
+    f = open(filename, 'wb')
+    f.write(contents)
+    f.close()
+    return filename
+
+  def _serve(self, raw_yaml, body_cache=None, metrics=None):
+    """Serves the given script in a background thread, and returns a connection
+    to the server.
+    """
+
+    script = canned_http.script_from_yaml_string(raw_yaml, self._dir)
+    self._server = canned_http.CannedServer(script, body_cache=body_cache,
+        metrics=metrics, handler_class=_QuietRequestHandler).start()
+    return httplib.HTTPConnection('localhost', self._server.port)
+
+  def test_file_body(self):
+    # Send one file from the body cache, and stream one too large to cache.
+    small_contents = 'small contents'
+    self._write_file('small_body', small_contents)
+    large_contents = ''.join(chr(i % 256) for i in xrange(1000000))
+    self._write_file('large_body', large_contents)
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /small
+            response:
+              status_code: 200
+              content_type: text/plain
+              body_filename: small_body
+          - request:
+              method: GET
+              url: /large
+            response:
+              status_code: 200
+              content_type: application/octet-stream
+              body_filename: large_body
+        """
+    body_cache = canned_http.BodyCache(max_file_bytes=1000)
+    connection = self._serve(raw_yaml, body_cache)
+    connection.request('GET', '/small')
+    response = connection.getresponse()
+    self.assertEqual(200, response.status)
+    self.assertEqual(small_contents, response.read())
+    connection.request('GET', '/large')
+    response = connection.getresponse()
+    self.assertEqual(str(len(large_contents)), response.getheader('Content-Length'))
+    self.assertEqual(large_contents, response.read())
+    connection.close()
+
+  def test_file_ranges(self):
+    contents = ''.join(chr(ord('a') + i % 26) for i in xrange(100))
+    self._write_file('body', contents)
+    exchange_yaml = """
+          - request:
+              method: GET
+              url: /body
+            response:
+              status_code: 200
+              content_type: text/plain
+              body_filename: body
+        """
+    connection = self._serve('- ' + exchange_yaml * 6)
+
+    # The entire file advertises that ranges can be requested.
+    connection.request('GET', '/body')
+    response = connection.getresponse()
+    self.assertEqual(200, response.status)
+    self.assertEqual('bytes', response.getheader('Accept-Ranges'))
+    etag = response.getheader('ETag')
+    last_modified = response.getheader('Last-Modified')
+    self.assertEqual(contents, response.read())
+
+    # A single range is the body of the response.
+    connection.request('GET', '/body', headers={'Range': 'bytes=10-19'})
+    response = connection.getresponse()
+    self.assertEqual(206, response.status)
+    self.assertEqual('bytes 10-19/100', response.getheader('Content-Range'))
+    self.assertEqual(contents[10:20], response.read())
+
+    # Multiple ranges are the parts of a multipart/byteranges body.
+    connection.request('GET', '/body', headers={'Range': 'bytes=0-4,-5'})
+    response = connection.getresponse()
+    self.assertEqual(206, response.status)
+    content_type = response.getheader('Content-Type')
+    self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+    boundary = content_type.split('=', 1)[1]
+    self.assertEqual(
+        '\r\n--%s\r\nContent-Type: text/plain\r\n'
+        'Content-Range: bytes 0-4/100\r\n\r\n%s'
+        '\r\n--%s\r\nContent-Type: text/plain\r\n'
+        'Content-Range: bytes 95-99/100\r\n\r\n%s'
+        '\r\n--%s--\r\n' % (
+            boundary, contents[:5], boundary, contents[95:], boundary),
+        response.read())
+
+    # A range past the end of the file cannot be satisfied.
+    connection.request('GET', '/body', headers={'Range': 'bytes=100-'})
+    response = connection.getresponse()
+    self.assertEqual(416, response.status)
+    self.assertEqual('bytes */100', response.getheader('Content-Range'))
+    self.assertEqual('', response.read())
+
+    # The range is sent only if the If-Range header matches the file.
+    connection.request('GET', '/body',
+        headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    response = connection.getresponse()
+    self.assertEqual(206, response.status)
+    self.assertEqual(contents[:10], response.read())
+    connection.request('GET', '/body',
+        headers={'Range': 'bytes=0-9', 'If-Range': '"changed"'})
+    response = connection.getresponse()
+    self.assertEqual(200, response.status)
+    self.assertEqual(last_modified, response.getheader('Last-Modified'))
+    self.assertEqual(contents, response.read())
+    connection.close()
+
+  def test_throttled_body(self):
+    contents = 'x' * 300
+    self._write_file('body', contents)
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /bandwidth
+            response:
+              status_code: 200
+              content_type: text/plain
+              body_filename: body
+              bandwidth: 1000
+          - request:
+              method: GET
+              url: /drip
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: '%s'
+              drip_bytes: 100
+              drip_delay: 0.05
+        """ % contents
+    connection = self._serve(raw_yaml)
+    # The first 50 bytes are sent at once, and the rest at 1000 bytes/second.
+    start_time = time.time()
+    connection.request('GET', '/bandwidth')
+    response = connection.getresponse()
+    self.assertEqual(contents, response.read())
+    self.assertGreaterEqual(time.time() - start_time, 0.25)
+    # The head is not delayed, but each of the 3 writes of the body is.
+    start_time = time.time()
+    connection.request('GET', '/drip')
+    response = connection.getresponse()
+    self.assertLess(time.time() - start_time, 0.05)
+    self.assertEqual(contents, response.read())
+    self.assertGreaterEqual(time.time() - start_time, 0.15)
+    connection.close()
+
+  def _fault_yaml(self, *faults_yaml):
+    """Returns a script with a connection for each of the given faults."""
+
+    return ''.join("""
+        - - request:
+              method: GET
+              url: /foo.html
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: body
+              fault: %s
+        """ % fault_yaml for fault_yaml in faults_yaml)
+
+  def _read_until_closed(self, port):
+    """Sends a request on a new connection, and returns what is received until
+    the connection is closed, and the error that closed it if any.
+    """
+
+    s = socket.create_connection(('localhost', port))
+    s.sendall('GET /foo.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    received = []
+    try:
+      while True:
+        data = s.recv(4096)
+        if not data:
+          return ''.join(received), None
+        received.append(data)
+    except socket.error as e:
+      return ''.join(received), e.errno
+    finally:
+      s.close()
+
+  def test_faults(self):
+    self._serve(self._fault_yaml('{type: reset, after_bytes: 2}',
+        '{type: close}', '{type: content_length, content_length: 2}',
+        '{type: stall, after_bytes: 2}'))
+    port = self._server.port
+    # The connection is reset after 2 bytes of the body.
+    received, error = self._read_until_closed(port)
+    self.assertEqual(errno.ECONNRESET, error)
+    self.assertTrue(received.endswith('\r\n\r\nbo'))
+    # The connection is closed after the head.
+    received, error = self._read_until_closed(port)
+    self.assertIsNone(error)
+    self.assertTrue(received.endswith('Content-Length: 4\r\n\r\n'))
+    # The Content-Length header does not match the body.
+    connection = httplib.HTTPConnection('localhost', port)
+    connection.request('GET', '/foo.html')
+    response = connection.getresponse()
+    self.assertEqual('2', response.getheader('Content-Length'))
+    self.assertEqual('bo', response.read())
+    connection.close()
+    # The connection stalls after 2 bytes of the body until the client closes it.
+    s = socket.create_connection(('localhost', port))
+    s.settimeout(0.2)
+    s.sendall('GET /foo.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    received = ''
+    try:
+      while True:
+        received += s.recv(4096)
+    except socket.timeout:
+      pass
+    s.close()
+    self.assertTrue(received.endswith('\r\n\r\nbo'))
+    self.assertTrue(self._server.wait(1)['done'])
+
+  def test_serialized_head(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 404
+              content_type: text/html
+              headers:
+                X-Header: value
+              body: body1
+          - request:
+              method: GET
+              url: /foo2.html
+            response:
+              status_code: 200
+              content_type: text/html
+              headers:
+                Connection: close
+              body: body2
+        """
+    connection = self._serve(raw_yaml)
+    connection.request('GET', '/foo1.html')
+    response = connection.getresponse()
+    self.assertEqual(404, response.status)
+    self.assertEqual('Not Found', response.reason)
+    self.assertEqual('text/html', response.getheader('Content-Type'))
+    self.assertEqual('value', response.getheader('X-Header'))
+    self.assertIsNotNone(response.getheader('Date'))
+    self.assertEqual('body1', response.read())
+    # The server closes the connection if the response has Connection: close.
+    connection.request('GET', '/foo2.html')
+    response = connection.getresponse()
+    self.assertEqual('body2', response.read())
+    self.assertTrue(self._server.wait(1)['done'])
+
+  def test_compressed_body(self):
+    contents = 'file contents ' * 100
+    filename = self._write_file('body1', contents)
+    self._write_file(
+        'body2.gz', canned_http._compress('gzip', 'precompressed contents'))
+    self._write_file('body2', 'uncompressed contents')
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 200
+              content_type: text/plain
+              body_filename: body1
+              compress: true
+          - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 200
+              content_type: text/plain
+              body_filename: body1
+              compress: true
+          - request:
+              method: GET
+              url: /foo2.html
+            response:
+              status_code: 200
+              content_type: text/plain
+              body_filename: body2
+              compress: true
+        """
+    connection = self._serve(raw_yaml)
+    connection.request('GET', '/foo1.html', headers={'Accept-Encoding': 'gzip'})
+    response = connection.getresponse()
+    self.assertEqual('gzip', response.getheader('Content-Encoding'))
+    self.assertEqual('Accept-Encoding', response.getheader('Vary'))
+    self.assertEqual(contents,
+                     zlib.decompress(response.read(), 16 + zlib.MAX_WBITS))
+    # The body is not compressed if the client does not accept an encoding.
+    connection.request('GET', '/foo1.html')
+    response = connection.getresponse()
+    self.assertIsNone(response.getheader('Content-Encoding'))
+    self.assertEqual(contents, response.read())
+    # A precompressed file next to the file of the body is sent.
+    connection.request('GET', '/foo2.html', headers={'Accept-Encoding': 'gzip'})
+    response = connection.getresponse()
+    self.assertEqual('gzip', response.getheader('Content-Encoding'))
+    self.assertEqual('precompressed contents',
+                     zlib.decompress(response.read(), 16 + zlib.MAX_WBITS))
+    connection.close()
+
+  def test_compressed_template(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url:
+                template: /items/{id}
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: 'item {{path.id}}'
+              template: true
+              compress: true
+        """
+    body_cache = canned_http.BodyCache()
+    connection = self._serve(raw_yaml, body_cache=body_cache)
+    connection.request('GET', '/items/42', headers={'Accept-Encoding': 'gzip'})
+    response = connection.getresponse()
+    self.assertEqual('gzip', response.getheader('Content-Encoding'))
+    self.assertEqual('item 42',
+                     zlib.decompress(response.read(), 16 + zlib.MAX_WBITS))
+    connection.close()
+    self.assertTrue(self._server.wait(1)['done'])
+    # The rendered body is not cached, as no other request would send it.
+    self.assertEqual([], list(body_cache._entries))
+
+  def test_request_body(self):
+    raw_yaml = """
+        - - request:
+              method: POST
+              url: /foo1.html
+              body: body1
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: body2
+        """
+    connection = self._serve(raw_yaml)
+    connection.request('POST', '/foo1.html', 'body1')
+    response = connection.getresponse()
+    self.assertEqual('body2', response.read())
+    connection.close()
+
+  def test_metrics(self):
+    raw_yaml = """
+        - - request:
+              method: GET
+              url: /foo1.html
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: body1
+          - request:
+              method: GET
+              url: /foo2.html
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: body2
+        """
+    metrics = canned_http.Metrics()
+    connection = self._serve(raw_yaml, metrics=metrics)
+    for url in ('/foo1.html', '/foo2.html'):
+      connection.request('GET', url)
+      connection.getresponse().read()
+    connection.close()
+    self._server.wait()
+    # Every phase of both exchanges was recorded.
+    recorded = set((histogram['phase'], histogram['connection'], histogram['exchange'])
+                   for histogram in metrics.to_json_data())
+    phases = (canned_http.Metrics.PARSE_HEADERS, canned_http.Metrics.VERIFY_REQUEST,
+              canned_http.Metrics.DELAY, canned_http.Metrics.LOAD_BODY,
+              canned_http.Metrics.WRITE_RESPONSE)
+    self.assertEqual(
+        set((phase, 1, exchange_index)
+            for phase in phases for exchange_index in (1, 2)),
+        recorded)
+
+  def test_chunked_transfer_encoding(self):
+    raw_yaml = """
+        - - request:
+              method: POST
+              url: /foo1.html
+              body: body1
+            response:
+              status_code: 200
+              content_type: text/plain
+              chunks:
+                - chunk1
+                - body: chunk2
+                  delay: 0.01
+        """
+    connection = self._serve(raw_yaml)
+    connection.putrequest('POST', '/foo1.html')
+    connection.putheader('Transfer-Encoding', 'chunked')
+    connection.endheaders()
+    connection.send('2\r\nbo\r\n3\r\ndy1\r\n0\r\n\r\n')
+    response = connection.getresponse()
+    self.assertEqual('chunked', response.getheader('Transfer-Encoding'))
+    self.assertEqual('chunk1chunk2', response.read())
+    connection.close()
+
+
+class TestCannedServer(unittest.TestCase):
+  _RAW_YAML = """
+      - - request:
+            method: GET
+            url: /foo.html
+          response:
+            status_code: 200
+            content_type: text/plain
+            body: %s
+      """
+
+  def _script(self, body):
+    return canned_http.script_from_yaml_string(self._RAW_YAML % body)
+
+  def _get(self, server, url):
+    connection = httplib.HTTPConnection('localhost', server.port)
+    connection.request('GET', url)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, body
+
+  def test_reset(self):
+    with canned_http.CannedServer(self._script('body1'),
+        handler_class=_QuietRequestHandler) as server:
+      self.assertEqual((200, 'body1'), self._get(server, '/foo.html'))
+      self.assertTrue(server.wait(1)['done'])
+      # The script begins again on the same port.
+      server.reset()
+      self.assertFalse(server.result()['done'])
+      self.assertEqual((200, 'body1'), self._get(server, '/foo.html'))
+      self.assertTrue(server.wait(1)['done'])
+      # The script is replaced on the same port.
+      server.set_script(self._script('body2'))
+      self.assertEqual((200, 'body2'), self._get(server, '/foo.html'))
+      self.assertTrue(server.wait(1)['done'])
+
+  def test_error(self):
+    with canned_http.CannedServer(self._script('body'),
+        handler_class=_QuietRequestHandler) as server:
+      connection = httplib.HTTPConnection('localhost', server.port)
+      connection.request('GET', '/bar.html')
+      self.assertRaises(httplib.HTTPException, connection.getresponse)
+      connection.close()
+      result = server.wait(1)
+    self.assertFalse(result['done'])
+    self.assertTrue(result['error'])
+    self.assertEqual(1, len(result['errors']))
+    self.assertIsInstance(result['errors'][0], canned_http.DirectorError)
+
+  def test_multiple_servers(self):
+    # Each server follows its own script.
+    server1 = canned_http.CannedServer(self._script('body1'), concurrent=True,
+        handler_class=_QuietRequestHandler).start()
+    server2 = canned_http.CannedServer(self._script('body2'), unordered=True,
+        handler_class=_QuietRequestHandler).start()
+    try:
+      self.assertEqual((200, 'body2'), self._get(server2, '/foo.html'))
+      self.assertEqual((200, 'body1'), self._get(server1, '/foo.html'))
+      self.assertTrue(server1.wait(1)['done'])
+      result2 = server2.wait(1)
+      self.assertTrue(result2['done'])
+      self.assertEqual([], result2['unconsumed'])
+    finally:
+      server1.stop()
+      server2.stop()
+
+
+class TestCannedServerPool(unittest.TestCase):
+  def _script(self, url, body):
+    return canned_http.script_from_yaml_string("""
+        - - request:
+              method: GET
+              url: %s
+            response:
+              status_code: 200
+              content_type: text/plain
+              body: %s
+        """ % (url, body))
+
+  def _get(self, port, url, host=None):
+    connection = httplib.HTTPConnection('localhost', port)
+    headers = {'Host': host} if host else {}
+    connection.request('GET', url, headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return body
+
+  def test_routes(self):
+    pool = canned_http.CannedServerPool(handler_class=_QuietRequestHandler)
+    by_port = pool.add(self._script('/foo', 'port'), port=0)
+    pool.add(self._script('/foo', 'host'), host_header='a.example.com')
+    # The prefix is removed from the URL before it is verified.
+    pool.add(self._script('/foo', 'prefix'), path_prefix='/b/')
+    with pool:
+      self.assertEqual('port', self._get(by_port.port, '/foo'))
+      self.assertEqual('host', self._get(pool.port, '/foo', 'A.example.com:80'))
+      self.assertEqual('prefix', self._get(pool.port, '/b/foo', 'b.example.com'))
+      result = pool.wait(1)
+    self.assertTrue(result['done'])
+    self.assertFalse(result['error'])
+    self.assertEqual(3, len(result['results']))
+
+  def test_no_route(self):
+    pool = canned_http.CannedServerPool(handler_class=_QuietRequestHandler)
+    pool.add(self._script('/foo', 'host'), host_header='a.example.com')
+    with pool:
+      connection = httplib.HTTPConnection('localhost', pool.port)
+      connection.request('GET', '/foo', headers={'Host': 'b.example.com'})
+      self.assertRaises(httplib.HTTPException, connection.getresponse)
+      connection.close()
+      result = pool.wait(1)
+    self.assertFalse(result['done'])
+    self.assertTrue(result['error'])
+    self.assertIsInstance(result['errors'][0], canned_http.DirectorError)
+
+  def test_metrics(self):
+    metrics = canned_http.Metrics()
+    pool = canned_http.CannedServerPool(
+        metrics=metrics, handler_class=_QuietRequestHandler)
+    pool.add(self._script('/foo', 'host'), host_header='a.example.com')
+    pool.add(self._script('/foo', 'prefix'), path_prefix='/b', name='b')
+    with pool:
+      self.assertEqual('host', self._get(pool.port, '/foo', 'a.example.com'))
+      self.assertEqual('prefix', self._get(pool.port, '/b/foo'))
+      result = pool.wait(1)
+    self.assertTrue(result['done'])
+    # The exchanges of both scripts have the same indexes, but their histograms
+    # are labeled by script.
+    recorded = set((histogram['script'], histogram['phase'],
+                    histogram['connection'], histogram['exchange'])
+                   for histogram in metrics.to_json_data())
+    self.assertEqual(
+        set((script, canned_http.Metrics.WRITE_RESPONSE, 1, 1)
+            for script in ('1', 'b')),
+        set(key for key in recorded
+            if key[1] == canned_http.Metrics.WRITE_RESPONSE))
+    for histogram in metrics.to_json_data():
+      self.assertEqual(1, histogram['count'])
+    # The result of each server has only the histograms of its script.
+    for server_result, script in zip(result['results'], ('1', 'b')):
+      self.assertEqual(set([script]), set(
+          histogram['script'] for histogram in server_result['metrics']))
+
+  def test_bandwidth(self):
+    pool = canned_http.CannedServerPool(
+        bandwidth=1000000, handler_class=_QuietRequestHandler)
+    by_port = pool.add(self._script('/foo', 'port'), port=0)
+    routed = pool.add(self._script('/foo', 'host'), host_header='a.example.com')
+    # Every script is limited by the bandwidth of the pool together.
+    self.assertIsNotNone(pool._bucket)
+    self.assertIs(pool._bucket, by_port._bucket)
+    self.assertIs(pool._bucket, routed._bucket)
+    with pool:
+      self.assertEqual('port', self._get(by_port.port, '/foo'))
+      self.assertEqual('host', self._get(pool.port, '/foo', 'a.example.com'))
+      self.assertTrue(pool.wait(1)['done'])
+
+  def test_pool_entries_from_data(self):
+    directory = tempfile.mkdtemp()
+    try:
+      f = open(os.path.join(directory, 'script.json'), 'w')
+      f.write('[]')
+      f.close()
+      entries = canned_http._pool_entries_from_data([
+          {'script': 'script.json', 'port': 9001},
+          {'script': 'script.json', 'host': 'a.example.com', 'unordered': True},
+      ], directory)
+      self.assertEqual(
+          [(9001, None, None, False, False, 'order'),
+           (None, 'a.example.com', None, False, True, 'order')],
+          [entry[1:] for entry in entries])
+      # A script cannot be on its own port and routed.
+      self.assertRaises(canned_http.ScriptParseError,
+          canned_http._pool_entries_from_data,
+          [{'script': 'script.json', 'port': 9001, 'path_prefix': '/a'}],
+          directory)
+      self.assertRaises(canned_http.ScriptParseError,
+          canned_http._pool_entries_from_data, [{'port': 9001}], directory)
+    finally:
+      shutil.rmtree(directory)
+
+
+class _QuietRecordingRequestHandler(canned_http.RecordingRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+class TestRecordingProxy(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _perform(self, port):
+    """Performs the requests of the upstream script, and returns the bodies of
+    the responses.
+    """
+
+    connection = httplib.HTTPConnection('localhost', port)
+    bodies = []
+    for method, url, body in (('POST', '/items', '{"id": 1}'),
+                              ('GET', '/large', None),
+                              ('DELETE', '/items/1', None)):
+      connection.request(method, url, body)
+      bodies.append(connection.getresponse().read())
+    connection.close()
+    return bodies
+
+  def test_record(self):
+    large_contents = ''.join(chr(i % 256) for i in xrange(1000))
+    f = open(os.path.join(self._dir, 'large_body'), 'wb')
+    f.write(large_contents)
+    f.close()
+    upstream_script = canned_http.script_from_yaml_string("""
+        - - request:
+              method: POST
+              url: /items
+              body: '{"id": 1}'
+            response:
+              status_code: 201
+              content_type: application/json
+              headers:
+                Location: /items/1
+              body: '{"id": 1}'
+          - request:
+              method: GET
+              url: /large
+            response:
+              status_code: 200
+              content_type: application/octet-stream
+              body_filename: large_body
+          - request:
+              method: DELETE
+              url: /items/1
+            response:
+              status_code: 204
+              content_type: text/plain
+              body: ''
+        """, self._dir)
+    script_filename = os.path.join(self._dir, 'recorded.json')
+    with canned_http.CannedServer(upstream_script,
+        handler_class=_QuietRequestHandler) as upstream:
+      proxy = canned_http.RecordingProxy('localhost', upstream.port,
+          script_filename, max_body_bytes=100,
+          handler_class=_QuietRecordingRequestHandler)
+      proxy.start()
+      bodies = self._perform(proxy.port)
+      proxy.stop()
+      self.assertTrue(upstream.wait(1)['done'])
+    self.assertEqual(['{"id": 1}', large_contents, ''], bodies)
+
+    # The exchanges are recorded, where the large body is in a file.
+    f = open(script_filename)
+    script_data = json.load(f)
+    f.close()
+    self.assertEqual(1, len(script_data))
+    post_exchange, large_exchange, delete_exchange = script_data[0]
+    self.assertEqual({'method': 'POST', 'url': '/items', 'body': '{"id": 1}'},
+                     post_exchange['request'])
+    self.assertEqual(201, post_exchange['response']['status_code'])
+    self.assertEqual({'Location': '/items/1'},
+                     post_exchange['response']['headers'])
+    body_filename = large_exchange['response']['body_filename']
+    self.assertFalse(os.path.isabs(body_filename))
+    f = open(os.path.join(self._dir, body_filename), 'rb')
+    self.assertEqual(large_contents, f.read())
+    f.close()
+    self.assertEqual('', delete_exchange['response']['body'])
+
+    # The recorded script is replayed.
+    with canned_http.CannedServer(canned_http.script_from_json_file(
+        script_filename), handler_class=_QuietRequestHandler) as server:
+      self.assertEqual(bodies, self._perform(server.port))
+      self.assertTrue(server.wait(1)['done'])
+
 if __name__ == '__main__':
   unittest.main()
 